@@ -0,0 +1,291 @@
+"""
+Speed Test Benchmark
+
+This script measures how fast `cfSpeedTest.py` works through its
+candidates, without touching live Cloudflare endpoints. It starts the fake
+server of `fakeCloudflare.py` in its own process, then runs the test
+pipeline of `CloudflareIPTester` once per candidate count, each in a fresh
+process, against loopback IPs whose latency, bandwidth and failure mode
+are known. For every run it reports:
+
+    wall_time_s        Time spent in the pipeline
+    ips_probed         Fake IPs the tester connected to
+    ips_per_s          IPs probed per second
+    peak_rss_mb        Peak resident memory of the tester process
+    ping_error_ms      Mean absolute error of the ping against the injected latency
+    download_error     Mean absolute relative error of the download speed against the injected bandwidth
+    upload_error       Mean absolute relative error of the upload speed against the injected bandwidth
+    *_bias             Signed mean of the same errors; positive when the tester overestimates
+    false_passes       Passing IPs whose profile has a failure mode (should be 0)
+
+A run fails when a bias is beyond its threshold (`--max-ping-bias`,
+`--max-speed-bias`) or when there are more false passes than
+`--max-false-passes`, and when the tester crashes or runs longer than
+`--timeout`; the script then exits with status 1, so it can guard
+measurement changes in CI.
+
+Usage:
+
+    python bench/benchSpeedTest.py --sizes 1000,10000,50000 --output result/bench.json
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import resource
+import statistics
+import tempfile
+import configparser
+import multiprocessing
+import queue
+from typing import Dict, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from fakeCloudflare import COLOS, fake_ip, make_certificate, profile_of, run_server
+from candidateStore import Candidate, CandidateSet
+from pinnedTransport import PinnedTransport
+
+# Regions of the fake candidates and their share of them; the first one dwarfs the others
+REGIONS = (('United States', 0.55), ('Germany', 0.15), ('Singapore', 0.15), ('Brazil', 0.15))
+
+
+class BenchTransport(PinnedTransport):
+    """
+    Pinned transport sending every request to the port of the fake server.
+    """
+    def __init__(self, port: int, **kwargs):
+        super().__init__(**kwargs)
+        self.port = port
+
+    def request(self, method, ip, host, path, port=443, **kwargs):
+        return super().request(method, ip, host, path, port=self.port, **kwargs)
+
+
+def region_of(index: int) -> str:
+    """Region of the fake candidate with the given index, following the `REGIONS` shares."""
+    position = (index * 0.6180339887) % 1
+    for region, share in REGIONS:
+        if position < share:
+            return region
+        position -= share
+    return REGIONS[-1][0]
+
+
+def write_config(path: str, args: argparse.Namespace) -> None:
+    """Write the `cfSpeedTest` configuration of a benchmark run."""
+    config = configparser.ConfigParser()
+    config['cfSpeedTest'] = {
+        'max_ips': str(args.max_ips),
+        'max_ping': str(args.max_ping),
+        'test_size': str(args.test_size),
+        'min_download_speed': '5',
+        'min_upload_speed': '2',
+        'download_warmup': str(args.download_warmup),
+        'ping_method': args.ping_method,
+        'ping_samples': str(args.ping_samples),
+        'concurrency': str(args.concurrency),
+        'ping_concurrency': str(args.ping_concurrency),
+        'region_source': 'geoip',
+        'use_domain_quota': 'False',
+        'cache_file': '',
+        'output_file': os.path.join(os.path.dirname(path), 'tested-ips.csv')
+    }
+    with open(path, 'w') as file:
+        config.write(file)
+
+
+def mean(values: List[float]):
+    """Mean of the values, or None without values."""
+    return round(statistics.fmean(values), 4) if values else None
+
+
+def run_tester(size: int, args: argparse.Namespace, cert_path: str, results: multiprocessing.Queue) -> None:
+    """
+    Run the test pipeline over `size` fake candidates; the target of each run's process.
+
+    :param size: Number of candidates
+    :param args: Benchmark arguments
+    :param cert_path: Certificate of the fake server, trusted by the transport
+    :param results: Queue the run's metrics are put on
+    """
+    from cfSpeedTest import CloudflareIPTester
+
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.CRITICAL)
+    with tempfile.TemporaryDirectory() as directory:
+        config_path = os.path.join(directory, 'config.ini')
+        write_config(config_path, args)
+        tester = CloudflareIPTester(config_path)
+        tester.transport = BenchTransport(
+            args.port, timeout=tester.max_ping / 1000, max_pools=tester.concurrency * 4, ca_certs=cert_path
+        )
+
+        candidates = CandidateSet(
+            Candidate(ip=fake_ip(index), port=args.port, tls='YES', asn='13335', region=region_of(index))
+            for index in range(size)
+        )
+        started = time.perf_counter()
+        passed = tester.test_candidates(candidates.by_region())
+        wall_time = time.perf_counter() - started
+
+    ping_errors, download_errors, upload_errors = [], [], []
+    false_passes = 0
+    for result in passed:
+        truth = profile_of(result.ip, args.seed, args.fail_share)
+        if not truth.ok:
+            false_passes += 1
+            continue
+        ping_errors.append(result.ping - truth.latency)
+        download_errors.append((result.download_speed * 1_000_000 - truth.bandwidth) / truth.bandwidth)
+        upload_errors.append((result.upload_speed * 1_000_000 - truth.bandwidth) / truth.bandwidth)
+
+    results.put({
+        'candidates': size,
+        'passed': len(passed),
+        'wall_time_s': round(wall_time, 3),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'ping_error_ms': mean([abs(error) for error in ping_errors]),
+        'ping_bias_ms': mean(ping_errors),
+        'download_error': mean([abs(error) for error in download_errors]),
+        'download_bias': mean(download_errors),
+        'upload_error': mean([abs(error) for error in upload_errors]),
+        'upload_bias': mean(upload_errors),
+        'false_passes': false_passes
+    })
+
+
+def check_run(run: Dict[str, object], args: argparse.Namespace) -> List[str]:
+    """
+    Check the measurement quality of a run against the thresholds.
+
+    :param run: Metrics of the run
+    :param args: Benchmark arguments with the thresholds
+    :return: Descriptions of the thresholds the run exceeds; empty if it passes
+    """
+    failures = []
+    if run['passed'] == 0:
+        failures.append("no IP passed, so the measurements could not be checked")
+    if run['ping_bias_ms'] is not None and abs(run['ping_bias_ms']) > args.max_ping_bias:
+        failures.append(f"ping bias {run['ping_bias_ms']} ms beyond {args.max_ping_bias} ms")
+    for name in ('download_bias', 'upload_bias'):
+        if run[name] is not None and abs(run[name]) > args.max_speed_bias:
+            failures.append(f"{name.replace('_', ' ')} {run[name]:+.1%} beyond {args.max_speed_bias:.0%}")
+    if run['false_passes'] > args.max_false_passes:
+        failures.append(f"{run['false_passes']} false passes, more than {args.max_false_passes}")
+    return failures
+
+
+def wait_for_run(tester: multiprocessing.Process, results: multiprocessing.Queue, timeout: float) -> dict:
+    """
+    Wait for the metrics of a tester process.
+
+    :param tester: Started tester process
+    :param results: Queue the tester puts its metrics on
+    :param timeout: Seconds the run may take
+    :return: Metrics of the run
+    :raises RuntimeError: If the tester exits without metrics or takes longer than `timeout`
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            run = results.get(timeout=1)
+        except queue.Empty:
+            if tester.is_alive():
+                continue
+            # Metrics put just before the process exited may still be in transit
+            try:
+                run = results.get(timeout=1)
+            except queue.Empty:
+                raise RuntimeError(f"the tester exited with code {tester.exitcode} without results")
+        tester.join()
+        return run
+    tester.terminate()
+    tester.join()
+    raise RuntimeError(f"the tester did not finish within {timeout:.0f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark cfSpeedTest against a local fake speed.cloudflare.com.")
+    parser.add_argument('--sizes', default='1000,10000,50000', help="Comma-separated candidate counts")
+    parser.add_argument('--port', type=int, default=18443, help="Port of the fake server")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the fake IP profiles")
+    parser.add_argument('--fail-share', type=float, default=0.95, help="Share of fake IPs with a failure mode")
+    parser.add_argument('--ping-method', default='https', choices=('https', 'tcp'), help="Latency test of the tester")
+    parser.add_argument('--ping-samples', type=int, default=3)
+    parser.add_argument('--max-ips', type=int, default=100, help="Passing IPs needed, and speed tests allowed, per region")
+    parser.add_argument('--max-ping', type=int, default=150)
+    parser.add_argument('--test-size', type=int, default=5120, help="Download and upload size in KB, as in config.ini")
+    parser.add_argument('--download-warmup', type=int, default=200, help="Download warm-up in ms, as in config.ini")
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--ping-concurrency', type=int, default=32)
+    parser.add_argument('--max-ping-bias', type=float, default=10, help="Largest accepted ping bias in ms")
+    parser.add_argument('--max-speed-bias', type=float, default=0.05, help="Largest accepted download and upload bias, as a share")
+    parser.add_argument('--max-false-passes', type=int, default=0, help="Largest accepted number of false passes")
+    parser.add_argument('--timeout', type=float, default=1800, help="Seconds a run may take before it is stopped and failed")
+    parser.add_argument('--output', help="JSON file the report is written to")
+    parser.add_argument('--verbose', action='store_true', help="Keep the tester's logs")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+    context = multiprocessing.get_context('spawn')
+    report: Dict[str, object] = {'arguments': vars(args), 'colos': [colo for colo, _ in COLOS], 'runs': []}
+
+    with tempfile.TemporaryDirectory() as directory:
+        cert_path, key_path = make_certificate(directory)
+        ready = context.Event()
+        control, server_control = context.Pipe()
+        server = context.Process(
+            target=run_server,
+            args=(cert_path, key_path, args.port, args.seed, args.fail_share, ready, server_control),
+            name='fake-cloudflare',
+            daemon=True
+        )
+        server.start()
+        # Only the server holds its end, so a server that died fails `recv` instead of blocking it
+        server_control.close()
+        try:
+            if not ready.wait(10):
+                raise RuntimeError("The fake server did not start.")
+            for size in sizes:
+                control.send('stats')
+                control.recv()
+                results = context.Queue()
+                tester = context.Process(target=run_tester, args=(size, args, cert_path, results), name=f"bench-{size}")
+                tester.start()
+                try:
+                    run = wait_for_run(tester, results, args.timeout)
+                except RuntimeError as e:
+                    run = {'candidates': size, 'failures': [str(e)]}
+                    report['runs'].append(run)
+                    print(json.dumps(run))
+                    continue
+                control.send('stats')
+                stats = control.recv()
+                run['ips_probed'] = stats['ips']
+                run['ips_per_s'] = round(stats['ips'] / run['wall_time_s'], 1) if run['wall_time_s'] else None
+                run['requests'] = stats['requests']
+                run['failures'] = check_run(run, args)
+                report['runs'].append(run)
+                print(json.dumps(run))
+        finally:
+            control.close()
+            server.join(5)
+            if server.is_alive():
+                server.terminate()
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"Report written to {args.output}")
+
+    failed = [run for run in report['runs'] if run['failures']]
+    for run in failed:
+        print(f"FAILED with {run['candidates']} candidates: {'; '.join(run['failures'])}", file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+"""
+Fake speed.cloudflare.com
+
+This module serves a local stand-in of the endpoints `cfSpeedTest.py`
+talks to: `/__down`, `/__up`, `/generate_204` and `/cdn-cgi/trace`, over
+TLS with a self-signed certificate for `speed.cloudflare.com`. It listens
+on every address but only answers connections made to 127.0.0.0/8, and
+every loopback address behaves as its own fake Cloudflare IP: its latency,
+bandwidth, colo and failure mode are derived from a hash of the address,
+so the benchmark driver knows the ground truth without talking to the
+server.
+
+Failure modes:
+
+    ok      Answers normally
+    reset   Closes the connection before reading a request
+    stall   Reads requests but never answers
+    error   Answers every request with `503 Service Unavailable`
+"""
+
+import os
+import ssl
+import time
+import asyncio
+import hashlib
+import logging
+import subprocess
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+SPEED_TEST_HOST = 'speed.cloudflare.com'
+
+# Fake colos handed out to the IPs, with the region `cfSpeedTest.py` maps them to
+COLOS = (('SIN', 'Asia Pacific'), ('FRA', 'Europe'), ('IAD', 'North America'), ('GRU', 'South America'))
+
+# Bytes written or read between two pacing checks
+CHUNK_SIZE = 64 * 1024
+
+# Seconds a transfer may fall behind its bandwidth and still make up for
+MAX_LAG = 0.010
+
+
+@dataclass(frozen=True)
+class FakeProfile:
+    """
+    Data class to store the injected behaviour of one fake IP.
+    """
+    latency: float
+    bandwidth: float
+    colo: str
+    failure: str
+
+    @property
+    def ok(self) -> bool:
+        """Whether the IP answers normally."""
+        return self.failure == 'ok'
+
+
+def profile_of(ip: str, seed: int = 0, fail_share: float = 0.5) -> FakeProfile:
+    """
+    Derive the behaviour of a fake IP from its address.
+
+    :param ip: Loopback IP address
+    :param seed: Seed mixed into the hash, to get another set of profiles
+    :param fail_share: Share of IPs with a failure mode
+    :return: Profile of the IP
+    """
+    digest = hashlib.blake2b(f"{seed}:{ip}".encode(), digest_size=8).digest()
+    draw = int.from_bytes(digest[:2], 'big') / 0x10000
+    if draw < fail_share:
+        failure = ('reset', 'stall', 'error')[digest[2] % 3]
+    else:
+        failure = 'ok'
+    return FakeProfile(
+        latency=5 + digest[3] % 60,                   # 5-64 ms
+        bandwidth=(20 + digest[4] % 181) * 1_000_000,  # 20-200 Mbps
+        colo=COLOS[digest[5] % len(COLOS)][0],
+        failure=failure
+    )
+
+
+def fake_ip(index: int) -> str:
+    """
+    Address of the fake IP with the given index, skipping 127.0.0.0/16.
+
+    :param index: Index of the IP, below 2**24 - 2**16
+    :return: Loopback IP address
+    """
+    value = index + 0x10000
+    return f"127.{value >> 16 & 0xFF}.{value >> 8 & 0xFF}.{value & 0xFF}"
+
+
+def make_certificate(directory: str) -> Tuple[str, str]:
+    """
+    Create a self-signed certificate for `speed.cloudflare.com` with the `openssl` command.
+
+    :param directory: Directory the certificate and key are written to
+    :return: Paths of the certificate and key
+    :raises RuntimeError: If `openssl` is not available or failed
+    """
+    cert_path = os.path.join(directory, 'fake-cloudflare.pem')
+    key_path = os.path.join(directory, 'fake-cloudflare.key')
+    command = [
+        'openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-nodes', '-days', '1',
+        '-subj', f"/CN={SPEED_TEST_HOST}", '-addext', f"subjectAltName=DNS:{SPEED_TEST_HOST}",
+        '-keyout', key_path, '-out', cert_path
+    ]
+    try:
+        subprocess.run(command, check=True, capture_output=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise RuntimeError(f"Failed to create the fake certificate with openssl: {e}")
+    return cert_path, key_path
+
+
+class Pacer:
+    """
+    Holds a transfer to a bandwidth. Time lost while the event loop was busy
+    is made up for, up to `MAX_LAG`: without catching up, every late wake-up
+    is lost for good and fast IPs deliver well below their bandwidth, and
+    the bounded lag keeps catch-up bursts too short to skew a measurement.
+    """
+    def __init__(self, bandwidth: float):
+        """
+        :param bandwidth: Bandwidth in bits per second
+        """
+        self.bandwidth = bandwidth
+        self.next_time = time.perf_counter()
+
+    async def pace(self, size: int) -> None:
+        """
+        Wait until `size` more bytes fit in the bandwidth.
+
+        :param size: Bytes just transferred
+        """
+        self.next_time = max(self.next_time, time.perf_counter() - MAX_LAG) + size * 8 / self.bandwidth
+        delay = self.next_time - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class FakeCloudflare:
+    """
+    Asyncio TLS server answering as a different Cloudflare IP on every loopback address.
+    """
+    def __init__(self, cert_path: str, key_path: str, seed: int = 0, fail_share: float = 0.5):
+        """
+        Initialize the server.
+
+        :param cert_path: Path of the server certificate
+        :param key_path: Path of the server key
+        :param seed: Seed of the IP profiles
+        :param fail_share: Share of IPs with a failure mode
+        """
+        self.seed = seed
+        self.fail_share = fail_share
+        self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.ssl_context.load_cert_chain(cert_path, key_path)
+        self.ips = set()
+        self.connections = 0
+        self.requests = 0
+
+    def stats(self) -> dict:
+        """Counters since the last call: distinct fake IPs connected to, connections and requests."""
+        stats = {'ips': len(self.ips), 'connections': self.connections, 'requests': self.requests}
+        self.ips = set()
+        self.connections = self.requests = 0
+        return stats
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[Tuple[str, str, dict]]:
+        """Read the request line and headers; None at the end of the connection."""
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            return None
+        lines = head.decode('latin-1').split('\r\n')
+        method, path, _ = lines[0].split(' ', 2)
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        return method, path, headers
+
+    async def _read_body(self, reader: asyncio.StreamReader, headers: dict, bandwidth: float) -> int:
+        """Read a request body at most at the given bandwidth, in bits per second."""
+        pacer = Pacer(bandwidth)
+        size = 0
+
+        async def read(remaining: int):
+            nonlocal size
+            while remaining:
+                read = len(await reader.readexactly(min(remaining, CHUNK_SIZE)))
+                remaining -= read
+                size += read
+                await pacer.pace(read)
+
+        if headers.get('transfer-encoding', '').lower() != 'chunked':
+            await read(int(headers.get('content-length', 0)))
+            return size
+        while True:
+            length = int((await reader.readline()).split(b';')[0].strip(), 16)
+            await read(length)
+            # CRLF after the chunk data, or after the last (empty) chunk
+            await reader.readline()
+            if length == 0:
+                return size
+
+    @staticmethod
+    def _head(status: str, length: int, content_type: str = 'text/plain') -> bytes:
+        """Response status line and headers."""
+        return (
+            f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {length}\r\n"
+            f"Connection: keep-alive\r\n\r\n"
+        ).encode()
+
+    async def _send_body(self, writer: asyncio.StreamWriter, size: int, bandwidth: float) -> None:
+        """Write a zero-filled body at most at the given bandwidth, in bits per second."""
+        chunk = bytes(CHUNK_SIZE)
+        pacer = Pacer(bandwidth)
+        sent = 0
+        while sent < size:
+            part = min(CHUNK_SIZE, size - sent)
+            writer.write(chunk[:part])
+            await writer.drain()
+            sent += part
+            await pacer.pace(part)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Serve the requests of one connection as the fake IP it was made to."""
+        ip = writer.get_extra_info('sockname')[0]
+        if not ip.startswith('127.'):
+            writer.close()
+            return
+        self.ips.add(ip)
+        self.connections += 1
+        profile = profile_of(ip, self.seed, self.fail_share)
+        try:
+            if profile.failure == 'reset':
+                return
+            while (request := await self._read_request(reader)) is not None:
+                method, path, headers = request
+                self.requests += 1
+                if method == 'POST':
+                    await self._read_body(reader, headers, profile.bandwidth)
+                if profile.failure == 'stall':
+                    continue
+                # One round trip before the response headers
+                await asyncio.sleep(profile.latency / 1000)
+                if profile.failure == 'error':
+                    writer.write(self._head('503 Service Unavailable', 0))
+                elif path.startswith('/__down'):
+                    size = int(path.split('bytes=', 1)[1].split('&')[0]) if 'bytes=' in path else 0
+                    writer.write(self._head('200 OK', size, 'application/octet-stream'))
+                    await self._send_body(writer, size, profile.bandwidth)
+                elif path.startswith('/__up'):
+                    writer.write(self._head('200 OK', 0))
+                elif path.startswith('/generate_204'):
+                    writer.write(b"HTTP/1.1 204 No Content\r\nConnection: keep-alive\r\n\r\n")
+                elif path.startswith('/cdn-cgi/trace'):
+                    body = f"fl=1f1\nh={SPEED_TEST_HOST}\nip=127.0.0.1\ncolo={profile.colo}\nhttp=http/1.1\ntls=TLSv1.3\n".encode()
+                    writer.write(self._head('200 OK', len(body)) + body)
+                else:
+                    writer.write(self._head('404 Not Found', 0))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            logging.debug(f"Fake connection to {ip} ended: {e}")
+        except asyncio.CancelledError:
+            # Connections still open when the server stops; asyncio would log each one as an error
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, port: int, ready=None, control=None) -> None:
+        """
+        Serve until cancelled, or until the control connection is closed.
+
+        :param port: TCP port to listen on
+        :param ready: Event set once the server listens (optional)
+        :param control: Connection answering each `stats` message with `stats()` (optional)
+        """
+        server = await asyncio.start_server(self._handle, host='0.0.0.0', port=port, ssl=self.ssl_context, backlog=4096)
+        if ready is not None:
+            ready.set()
+        async with server:
+            if control is None:
+                await server.serve_forever()
+                return
+            loop = asyncio.get_running_loop()
+            while True:
+                try:
+                    message = await loop.run_in_executor(None, control.recv)
+                except EOFError:
+                    return
+                if message == 'stats':
+                    control.send(self.stats())
+
+
+def run_server(
+    cert_path: str,
+    key_path: str,
+    port: int,
+    seed: int,
+    fail_share: float,
+    ready=None,
+    control=None
+) -> None:
+    """
+    Run the fake server in the current process; the target of the benchmark's server process.
+
+    :param cert_path: Path of the server certificate
+    :param key_path: Path of the server key
+    :param port: TCP port to listen on
+    :param seed: Seed of the IP profiles
+    :param fail_share: Share of IPs with a failure mode
+    :param ready: Event set once the server listens (optional)
+    :param control: Connection the counters are requested on (optional)
+    """
+    server = FakeCloudflare(cert_path, key_path, seed, fail_share)
+    try:
+        asyncio.run(server.serve(port, ready, control))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,58 @@
+"""
+Atomic File Writes
+
+This module writes files through a temporary file in the same directory
+that is renamed over the target once complete, so readers never see a
+partial file. Each process and thread writes its own temporary file:
+shards run as local processes share files such as the colo list and the
+fetch cache, and two of them refreshing one at the same time must not
+write to, or rename, each other's temporary file.
+"""
+
+import os
+import threading
+from contextlib import contextmanager
+from typing import IO, Iterator
+
+
+def temp_path_of(path: str) -> str:
+    """
+    Path of the temporary file the current process and thread write a file through.
+
+    :param path: Path of the file
+    :return: Path of its temporary file
+    """
+    return f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+
+
+@contextmanager
+def atomic_write(path: str, mode: str = 'w', sync: bool = False, **kwargs) -> Iterator[IO]:
+    """
+    Open a file to be replaced atomically once the block completes.
+
+    The directory of the file is created if needed. If the block raises,
+    the temporary file is removed and the file is left as it was.
+
+    :param path: Path of the file
+    :param mode: Write mode, `w` or `wb`
+    :param sync: Sync the file to disk before renaming it
+    :param kwargs: Further arguments of `open`, e.g. `newline`
+    :return: File object of the temporary file
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = temp_path_of(path)
+    try:
+        with open(temp_path, mode, **kwargs) as file:
+            yield file
+            if sync:
+                file.flush()
+                os.fsync(file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
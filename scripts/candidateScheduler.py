@@ -0,0 +1,162 @@
+"""
+Adaptive Candidate Scheduler
+
+This module ranks candidate IPs by their results in earlier runs, so a
+region's test budget is spent on IPs that are likely to pass first. A
+share of the schedule is kept for IPs without history (bandit-style
+exploration), which keeps newly listed IPs from never being tested.
+"""
+
+import csv
+import time
+import random
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from probeCache import ProbeRecord
+from candidateStore import Candidate
+
+# Weights of the score components; they add up to 1
+WEIGHT_IP = 0.5
+WEIGHT_RECENCY = 0.2
+WEIGHT_ASN = 0.2
+WEIGHT_REGION = 0.1
+
+
+@dataclass
+class RankedCandidate:
+    """
+    Data class to store a candidate with its scheduling score.
+    """
+    candidate: Candidate
+    score: float
+    attempts: int
+    successes: int
+
+    @property
+    def seen(self) -> bool:
+        """Whether the candidate was tested in an earlier run."""
+        return self.attempts > 0
+
+
+def success_rate(successes: int, attempts: int) -> float:
+    """Success rate smoothed with a uniform prior, so unseen groups score 0.5."""
+    return (successes + 1) / (attempts + 2)
+
+
+class CandidateScheduler:
+    """
+    Ranks and orders candidate IPs using the probe history.
+    """
+    def __init__(
+        self,
+        history: Dict[Tuple[str, int], ProbeRecord],
+        exploration: float = 0.1,
+        half_life: float = 24.0,
+        rng: Optional[random.Random] = None
+    ):
+        """
+        Initialize the scheduler.
+
+        :param history: Cached probe records keyed by (IP, port)
+        :param exploration: Share of the schedule given to IPs without history
+        :param half_life: Hours after which the weight of a past success halves
+        :param rng: Random generator used for exploration (optional)
+        """
+        self.history = history
+        self.exploration = exploration
+        self.half_life = half_life
+        self.rng = rng or random.Random()
+
+    def _recency(self, record: ProbeRecord, now: float) -> float:
+        """Weight of the last success, halving every `half_life` hours."""
+        if not record.last_success:
+            return 0.0
+        age_hours = max(now - record.last_success, 0) / 3600
+        return 0.5 ** (age_hours / self.half_life)
+
+    def rank(self, region_candidates: Dict[str, List[Candidate]]) -> List[RankedCandidate]:
+        """
+        Score every candidate.
+
+        :param region_candidates: Dictionary mapping regions to candidates
+        :return: Candidates sorted by descending score
+        """
+        now = time.time()
+        asn_stats: Dict[Optional[str], List[int]] = {}
+        region_stats: Dict[str, List[int]] = {}
+        entries = []
+
+        for region, candidates in region_candidates.items():
+            for candidate in candidates:
+                record = self.history.get((candidate.ip, candidate.port))
+                if record and record.attempts:
+                    for stats in (asn_stats.setdefault(candidate.asn, [0, 0]), region_stats.setdefault(region, [0, 0])):
+                        stats[0] += record.successes
+                        stats[1] += record.attempts
+                entries.append((region, candidate, record))
+
+        ranked = []
+        for region, candidate, record in entries:
+            attempts = record.attempts if record else 0
+            successes = record.successes if record else 0
+            score = (
+                WEIGHT_IP * success_rate(successes, attempts)
+                + WEIGHT_RECENCY * (self._recency(record, now) if record else 0.0)
+                + WEIGHT_ASN * success_rate(*asn_stats.get(candidate.asn, (0, 0)))
+                + WEIGHT_REGION * success_rate(*region_stats.get(region, (0, 0)))
+            )
+            ranked.append(RankedCandidate(candidate, round(score, 4), attempts, successes))
+
+        ranked.sort(key=lambda candidate: candidate.score, reverse=True)
+        return ranked
+
+    def order(self, ranked: List[RankedCandidate]) -> List[Candidate]:
+        """
+        Build the test order of one region.
+
+        Candidates are taken best first, and each slot goes to the best
+        untested IP instead with probability `exploration`. Untested IPs with
+        equal scores are taken in random order.
+
+        :param ranked: Candidates of the region sorted by descending score
+        :return: Candidates in test order
+        """
+        seen = [candidate for candidate in ranked if candidate.seen]
+        unseen = [candidate for candidate in ranked if not candidate.seen]
+        self.rng.shuffle(unseen)
+        unseen.sort(key=lambda candidate: candidate.score, reverse=True)
+
+        order = []
+        seen_index = unseen_index = 0
+        while seen_index < len(seen) or unseen_index < len(unseen):
+            explore = unseen_index < len(unseen) and (
+                seen_index >= len(seen)
+                or unseen[unseen_index].score > seen[seen_index].score
+                or self.rng.random() < self.exploration
+            )
+            if explore:
+                order.append(unseen[unseen_index].candidate)
+                unseen_index += 1
+            else:
+                order.append(seen[seen_index].candidate)
+                seen_index += 1
+        return order
+
+    @staticmethod
+    def export_ranking(ranked: List[RankedCandidate], path: str) -> None:
+        """
+        Write the ranking to a CSV file for inspection.
+
+        :param ranked: Ranked candidates
+        :param path: Output CSV path
+        """
+        with open(path, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(['IP', 'Port', 'Region', 'ASN', 'Score', 'Attempts', 'Successes'])
+            for entry in ranked:
+                candidate = entry.candidate
+                writer.writerow([
+                    candidate.ip, candidate.port, candidate.region, candidate.asn,
+                    f"{entry.score:.4f}", entry.attempts, entry.successes
+                ])
@@ -0,0 +1,488 @@
+"""
+Candidate Store
+
+This module holds the candidate IPs read from the IP file in compact
+`__slots__` records, indexed by IP address, so every stage of the speed
+test shares one structure instead of lists of dicts and parallel maps.
+
+It also reads and writes the binary candidate file. The file is a
+16-byte header followed by one column per field, all little-endian:
+
+    header   magic b'CFIP', uint16 version, uint16 flags, uint32 count, uint32 reserved
+    ip       count x 16 bytes, IPv6 or IPv4-mapped IPv6 address
+    asn      count x uint32, 0 when unknown
+    port     count x uint16
+    tls      count x uint8, 0 = NO, 1 = YES, 2 = Unknown
+    country  count x 2 bytes, ISO country code, zero bytes when unknown
+    sources  count x uint32, bit i set when the IP was listed by source i
+    names    uint16 number of sources, then per source a uint8 length and
+             its UTF-8 name
+
+Fixed-width columns let readers memory-map the file and decode records
+lazily instead of parsing it up front. Version 1 files have no `sources`
+and `names` sections and are still read.
+"""
+
+import sys
+import json
+import mmap
+import shutil
+import socket
+import struct
+import tempfile
+import logging
+import argparse
+from array import array
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from atomicFile import atomic_write
+
+
+@dataclass(slots=True)
+class Candidate:
+    """
+    Data class to store a candidate IP and what is known about it.
+    """
+    ip: str
+    port: Optional[int]
+    tls: Optional[str]
+    asn: Optional[str]
+    country: Optional[str] = None
+    region: Optional[str] = None
+    asn_name: Optional[str] = None
+    sources: Optional[Tuple[str, ...]] = None
+    colo: Optional[str] = None
+
+
+class CandidateSet:
+    """
+    Candidates indexed by IP address and port, in file order.
+    """
+    def __init__(self, candidates: Iterable[Candidate] = ()):
+        """
+        Build the index; the first candidate of a duplicated IP:port wins.
+
+        :param candidates: Candidates to index
+        """
+        self._by_address: Dict[Tuple[str, Optional[int]], Candidate] = {}
+        for candidate in candidates:
+            self._by_address.setdefault((candidate.ip, candidate.port), candidate)
+
+    def __len__(self) -> int:
+        return len(self._by_address)
+
+    def __iter__(self) -> Iterator[Candidate]:
+        return iter(self._by_address.values())
+
+    def __contains__(self, address: Tuple[str, Optional[int]]) -> bool:
+        return address in self._by_address
+
+    def get(self, ip: str, port: Optional[int]) -> Optional[Candidate]:
+        """
+        Look up a candidate by IP address and port.
+
+        :param ip: IP address
+        :param port: Port
+        :return: Candidate or None
+        """
+        return self._by_address.get((ip, port))
+
+    def by_region(self) -> Dict[str, List[Candidate]]:
+        """
+        Group the candidates with a known region.
+
+        :return: Dictionary mapping regions to candidates
+        """
+        regions: Dict[str, List[Candidate]] = {}
+        for candidate in self._by_address.values():
+            if candidate.region:
+                regions.setdefault(candidate.region, []).append(candidate)
+        return regions
+
+
+MAGIC = b'CFIP'
+VERSION = 2
+SUPPORTED_VERSIONS = (1, 2)
+HEADER = struct.Struct('<4sHHII')
+
+# Prefix of IPv4 addresses stored as IPv4-mapped IPv6 addresses
+IPV4_MAPPED_PREFIX = b'\x00' * 10 + b'\xff\xff'
+
+TLS_CODES = {'NO': 0, 'YES': 1}
+TLS_NAMES = {0: 'NO', 1: 'YES', 2: 'Unknown'}
+TLS_UNKNOWN = 2
+
+# Number of distinct sources a candidate file can record
+MAX_SOURCES = 32
+
+
+def pack_ip(ip: str) -> bytes:
+    """
+    Pack an IP address into 16 bytes.
+
+    :param ip: IPv4 or IPv6 address
+    :return: IPv6 or IPv4-mapped IPv6 address bytes
+    :raises OSError: If the address is not valid
+    :raises ValueError: If the address contains null characters
+    """
+    if ':' in ip:
+        return socket.inet_pton(socket.AF_INET6, ip)
+    return IPV4_MAPPED_PREFIX + socket.inet_pton(socket.AF_INET, ip)
+
+
+def unpack_ip(packed: Union[bytes, memoryview]) -> str:
+    """
+    Unpack 16 bytes into an IP address string.
+
+    :param packed: IPv6 or IPv4-mapped IPv6 address bytes
+    :return: IPv4 or IPv6 address
+    """
+    packed = bytes(packed)
+    if packed[:12] == IPV4_MAPPED_PREFIX:
+        return socket.inet_ntop(socket.AF_INET, packed[12:])
+    return socket.inet_ntop(socket.AF_INET6, packed)
+
+
+def address_key(ip: str, port: Optional[int]) -> int:
+    """
+    Pack an IP address and port into one integer.
+
+    :param ip: IPv4 or IPv6 address
+    :param port: Port, or None when unknown
+    :return: The 16 address bytes as an integer, shifted left by 16 bits and or-ed with the port
+    :raises OSError: If the address is not valid
+    :raises ValueError: If the address contains null characters
+    """
+    return int.from_bytes(pack_ip(ip), 'big') << 16 | (port or 0)
+
+
+class CandidateMerger:
+    """
+    Merges the candidates of several sources, keyed on packed (IP, port) integers.
+
+    Records are kept in compact columns instead of `Candidate` objects. The
+    same IP on another port is a separate candidate. A duplicated IP:port
+    keeps the first known ASN, TLS flag and country, and the names of every
+    source listing it.
+    """
+    def __init__(self):
+        self._index: Dict[int, int] = {}
+        self._keys: List[int] = []
+        self._asns = array('I')
+        self._tls = bytearray()
+        self._countries = bytearray()
+        self._sources = array('I')
+        self._source_bits: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def add(self, candidate: Candidate, source: str) -> bool:
+        """
+        Add a candidate listed by a source.
+
+        :param candidate: Candidate to add
+        :param source: Name of the source listing it
+        :return: True if the IP:port was new, False if it was merged into an earlier record
+        :raises ValueError: If the address is not valid or there are too many sources
+        """
+        try:
+            key = address_key(candidate.ip, candidate.port)
+        except OSError as e:
+            raise ValueError(f"Invalid IP address: {candidate.ip!r}") from e
+
+        if source not in self._source_bits:
+            if len(self._source_bits) == MAX_SOURCES:
+                raise ValueError(f"A candidate file records at most {MAX_SOURCES} sources")
+            self._source_bits[source] = len(self._source_bits)
+        source_bit = 1 << self._source_bits[source]
+
+        asn = int(candidate.asn) if candidate.asn else 0
+        tls = TLS_CODES.get(candidate.tls, TLS_UNKNOWN)
+        country = (candidate.country or '').encode('ascii')[:2].ljust(2, b'\x00')
+
+        index = self._index.get(key)
+        if index is None:
+            self._index[key] = len(self._keys)
+            self._keys.append(key)
+            self._asns.append(asn)
+            self._tls.append(tls)
+            self._countries += country
+            self._sources.append(source_bit)
+            return True
+
+        if not self._asns[index]:
+            self._asns[index] = asn
+        if self._tls[index] == TLS_UNKNOWN:
+            self._tls[index] = tls
+        if self._countries[2 * index:2 * index + 2] == b'\x00\x00':
+            self._countries[2 * index:2 * index + 2] = country
+        self._sources[index] |= source_bit
+        return False
+
+    def __iter__(self) -> Iterator[Candidate]:
+        """Decode the merged records in the order they were first seen."""
+        names = list(self._source_bits)
+        for index, key in enumerate(self._keys):
+            asn = self._asns[index]
+            country = bytes(self._countries[2 * index:2 * index + 2]).rstrip(b'\x00').decode('ascii')
+            mask = self._sources[index]
+            yield Candidate(
+                ip=unpack_ip((key >> 16).to_bytes(16, 'big')),
+                port=key & 0xFFFF or None,
+                tls=TLS_NAMES[self._tls[index]],
+                asn=str(asn) if asn else None,
+                country=country or None,
+                sources=tuple(name for bit, name in enumerate(names) if mask >> bit & 1)
+            )
+
+
+ASN_FIELD = struct.Struct('<I')
+PORT_FIELD = struct.Struct('<H')
+SOURCES_FIELD = struct.Struct('<I')
+
+
+def write_candidates(path: str, candidates: Iterable[Candidate]) -> int:
+    """
+    Write candidates to a binary candidate file.
+
+    Each column is spooled to its own temporary file while the candidates
+    are consumed, so a generator of any length is written in constant
+    memory. The columns are then joined into a temporary path that is
+    renamed into place, so readers never see a partial file.
+
+    :param path: Output file path
+    :param candidates: Candidates to write
+    :return: Number of candidates written
+    """
+    columns = [tempfile.TemporaryFile() for _ in range(6)]
+    ips, asns, ports, tls_flags, countries, sources = columns
+    source_bits: Dict[str, int] = {}
+    count = 0
+    try:
+        for candidate in candidates:
+            try:
+                packed = pack_ip(candidate.ip)
+            except (OSError, ValueError):
+                logging.warning(f"Skipping invalid IP address: {candidate.ip!r}")
+                continue
+            ips.write(packed)
+            asns.write(ASN_FIELD.pack(int(candidate.asn) if candidate.asn else 0))
+            ports.write(PORT_FIELD.pack(candidate.port or 0))
+            tls_flags.write(bytes((TLS_CODES.get(candidate.tls, TLS_UNKNOWN),)))
+            countries.write((candidate.country or '').encode('ascii')[:2].ljust(2, b'\x00'))
+            mask = 0
+            for name in candidate.sources or ():
+                if name not in source_bits:
+                    if len(source_bits) == MAX_SOURCES:
+                        raise ValueError(f"A candidate file records at most {MAX_SOURCES} sources")
+                    source_bits[name] = len(source_bits)
+                mask |= 1 << source_bits[name]
+            sources.write(SOURCES_FIELD.pack(mask))
+            count += 1
+
+        with atomic_write(path, 'wb') as file:
+            file.write(HEADER.pack(MAGIC, VERSION, 0, count, 0))
+            for column in columns:
+                column.seek(0)
+                shutil.copyfileobj(column, file)
+            file.write(struct.pack('<H', len(source_bits)))
+            for name in source_bits:
+                encoded = name.encode('utf-8')
+                file.write(struct.pack('<B', len(encoded)) + encoded)
+    finally:
+        for column in columns:
+            column.close()
+    return count
+
+
+class CandidateFile:
+    """
+    Memory-mapped reader of a binary candidate file.
+    """
+    def __init__(self, path: str):
+        """
+        Map the file and locate its columns.
+
+        :param path: Path to the binary candidate file
+        :raises ValueError: If the file is not a supported candidate file
+        """
+        with open(path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, _, count, _ = HEADER.unpack_from(self._map)
+        if magic != MAGIC or version not in SUPPORTED_VERSIONS:
+            self._map.close()
+            raise ValueError(f"Not a supported candidate file: {path}")
+
+        self.count = count
+        self._views: List[memoryview] = []
+        offset = HEADER.size
+        self._ips = self._slice(offset, 16 * count)
+        offset += 16 * count
+        self._asns = self._column(offset, count, 'I')
+        offset += 4 * count
+        self._ports = self._column(offset, count, 'H')
+        offset += 2 * count
+        self._tls = self._slice(offset, count)
+        offset += count
+        self._countries = self._slice(offset, 2 * count)
+        offset += 2 * count
+
+        self._sources = None
+        self.source_names: List[str] = []
+        if version >= 2:
+            self._sources = self._column(offset, count, 'I')
+            offset += 4 * count
+            (names,) = struct.unpack_from('<H', self._map, offset)
+            offset += 2
+            for _ in range(names):
+                length = self._map[offset]
+                self.source_names.append(self._map[offset + 1:offset + 1 + length].decode('utf-8'))
+                offset += 1 + length
+
+    def _slice(self, offset: int, size: int) -> memoryview:
+        """View a byte range of the file without copying it."""
+        view = memoryview(self._map)[offset:offset + size]
+        self._views.append(view)
+        return view
+
+    def _column(self, offset: int, count: int, typecode: str):
+        """View a little-endian column as integers, copying only on big-endian hosts."""
+        data = self._slice(offset, count * array(typecode).itemsize)
+        if sys.byteorder == 'big':
+            values = array(typecode, data.tobytes())
+            values.byteswap()
+            return values
+        view = data.cast(typecode)
+        self._views.append(view)
+        return view
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self) -> Iterator[Candidate]:
+        """Decode the records one at a time."""
+        source_sets: Dict[int, Tuple[str, ...]] = {}
+        for index in range(self.count):
+            sources = None
+            if self._sources is not None and self._sources[index]:
+                mask = self._sources[index]
+                if mask not in source_sets:
+                    source_sets[mask] = tuple(name for bit, name in enumerate(self.source_names) if mask >> bit & 1)
+                sources = source_sets[mask]
+            asn = self._asns[index]
+            country = bytes(self._countries[2 * index:2 * index + 2]).rstrip(b'\x00').decode('ascii')
+            yield Candidate(
+                ip=unpack_ip(self._ips[16 * index:16 * index + 16]),
+                port=self._ports[index] or None,
+                tls=TLS_NAMES[self._tls[index]],
+                asn=str(asn) if asn else None,
+                country=country or None,
+                sources=sources
+            )
+
+    def close(self) -> None:
+        """Release the column views and unmap the file."""
+        for view in reversed(self._views):
+            view.release()
+        self._map.close()
+
+    def __enter__(self) -> 'CandidateFile':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def is_candidate_file(path: str) -> bool:
+    """
+    Check whether a file is a binary candidate file.
+
+    :param path: File path
+    :return: True if the file starts with the candidate file magic
+    """
+    with open(path, 'rb') as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+def read_json_candidates(path: str) -> Iterator[Candidate]:
+    """
+    Read candidates from the legacy JSON IP file.
+
+    :param path: Path to the JSON file
+    :return: Iterator of candidates
+    """
+    with open(path, 'r') as file:
+        for ip_obj in json.load(file):
+            if ip_obj.get('ip'):
+                yield Candidate(
+                    ip=ip_obj['ip'],
+                    port=ip_obj.get('port'),
+                    tls=ip_obj.get('tls'),
+                    asn=ip_obj.get('asn'),
+                    country=ip_obj.get('country'),
+                    sources=tuple(ip_obj['sources']) if ip_obj.get('sources') else None
+                )
+
+
+def read_candidates(path: str) -> Iterator[Candidate]:
+    """
+    Read candidates from a binary or legacy JSON IP file.
+
+    :param path: Path to the IP file
+    :return: Iterator of candidates
+    """
+    if is_candidate_file(path):
+        with CandidateFile(path) as candidate_file:
+            yield from candidate_file
+    else:
+        yield from read_json_candidates(path)
+
+
+def export_json(path: str, output_path: str) -> int:
+    """
+    Export an IP file in the legacy JSON format.
+
+    :param path: Path to the binary or JSON IP file
+    :param output_path: Path of the JSON file to write
+    :return: Number of candidates exported
+    """
+    records = [
+        {
+            'ip': candidate.ip,
+            'asn': candidate.asn,
+            'tls': candidate.tls,
+            'port': candidate.port,
+            **({'country': candidate.country} if candidate.country else {}),
+            **({'sources': list(candidate.sources)} if candidate.sources else {})
+        }
+        for candidate in read_candidates(path)
+    ]
+    with open(output_path, 'w') as file:
+        json.dump(records, file, indent=2)
+    return len(records)
+
+
+def main():
+    """Convert IP files between the binary and the legacy JSON format."""
+    parser = argparse.ArgumentParser(description="Convert candidate IP files.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export', help="Export an IP file as JSON")
+    export_parser.add_argument('input')
+    export_parser.add_argument('output')
+    pack_parser = subparsers.add_parser('pack', help="Pack an IP file into the binary format")
+    pack_parser.add_argument('input')
+    pack_parser.add_argument('output')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        count = export_json(args.input, args.output)
+    else:
+        count = write_candidates(args.output, read_candidates(args.input))
+    print(f"Wrote {count} candidates to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
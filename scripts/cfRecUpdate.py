@@ -1,24 +1,43 @@
 import os
+import time
 import requests
 import csv
 import configparser
 from typing import List, Dict, Any, Optional
 import logging
+from runMetrics import RunMetrics, configure_logging
 
-# Configure logging
+# Configure logging; the level is then set from `[metrics] log_level`
 logging.basicConfig(level=logging.DEBUG, format="%(asctime)s [%(levelname)s] %(message)s")
 logger = logging.getLogger(__name__)
 
 class CloudflareDNSUpdater:
-    def __init__(self, api_token, zone_id):
+    def __init__(self, api_token, zone_id, metrics: Optional[RunMetrics] = None):
         self.base_url = "https://api.cloudflare.com/client/v4"
         self.headers = {
             "Authorization": f"Bearer {api_token}",
             "Content-Type": "application/json"
         }
         self.zone_id = zone_id
+        self.metrics = metrics or RunMetrics('cfRecUpdate')
         logger.info("CloudflareDNSUpdater initialized")
 
+    def _call(self, method: str, url: str, **kwargs) -> Dict[str, Any]:
+        """Send an API request, timing and counting it, and return its JSON body."""
+        started = time.perf_counter()
+        try:
+            response = requests.request(method, url, headers=self.headers, **kwargs)
+            response_data = response.json()
+        except (requests.RequestException, ValueError):
+            self.metrics.count('api_requests', method=method, outcome='error')
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            self.metrics.add_time('api', elapsed)
+            self.metrics.observe('request_ms', elapsed * 1000, method=method)
+        self.metrics.count('api_requests', method=method, outcome='success' if response_data.get('success') else 'failed')
+        return response_data
+
     def get_dns_records(self, record_name: Optional[str] = None, record_type: Optional[str] = None) -> List[Dict[str, Any]]:
         logger.info("Retrieving DNS records")
         params = {}
@@ -27,12 +46,11 @@ class CloudflareDNSUpdater:
         if record_type:
             params['type'] = record_type
 
-        response = requests.get(
+        response_data = self._call(
+            'GET',
             f"{self.base_url}/zones/{self.zone_id}/dns_records",
-            headers=self.headers,
             params=params
         )
-        response_data = response.json()
 
         if not response_data['success']:
             logger.error(f"Failed to retrieve DNS records: {response_data['errors']}")
@@ -61,6 +79,7 @@ class CloudflareDNSUpdater:
             if (ip, record_name, record_type) not in existing_set
         ]
         logger.debug(f"Filtered new content (non-duplicates): {new_content_filtered}")
+        self.metrics.count('dns_records', len(new_content) - len(new_content_filtered), action='unchanged', domain=record_name)
 
         # Skip processing records already present in existing records
         remaining_existing_records = [
@@ -82,6 +101,7 @@ class CloudflareDNSUpdater:
                     ttl=ttl
                 )
                 updated_records.append(updated_record)
+                self.metrics.count('dns_records', action='updated', domain=record_name)
             else:
                 logger.info(f"Creating new record with content: {content}")
                 new_record = self.create_dns_record(
@@ -92,11 +112,13 @@ class CloudflareDNSUpdater:
                     ttl=ttl
                 )
                 updated_records.append(new_record)
+                self.metrics.count('dns_records', action='created', domain=record_name)
 
         # Delete extra records not in the new content
         for extra_record in remaining_existing_records[len(new_content_filtered):]:
             logger.info(f"Deleting extra record with content: {extra_record['content']}")
             self.delete_dns_record(extra_record['id'])
+            self.metrics.count('dns_records', action='deleted', domain=record_name)
 
         logger.info(f"Completed updating DNS records for {record_name}")
         return updated_records
@@ -111,12 +133,11 @@ class CloudflareDNSUpdater:
             "ttl": ttl
         }
 
-        response = requests.put(
+        response_data = self._call(
+            'PUT',
             f"{self.base_url}/zones/{self.zone_id}/dns_records/{record_id}",
-            headers=self.headers,
             json=payload
         )
-        response_data = response.json()
 
         if not response_data['success']:
             logger.error(f"Failed to update DNS record: {response_data['errors']}")
@@ -134,12 +155,11 @@ class CloudflareDNSUpdater:
             "ttl": ttl
         }
 
-        response = requests.post(
+        response_data = self._call(
+            'POST',
             f"{self.base_url}/zones/{self.zone_id}/dns_records",
-            headers=self.headers,
             json=payload
         )
-        response_data = response.json()
 
         if not response_data['success']:
             logger.error(f"Failed to create DNS record: {response_data['errors']}")
@@ -149,11 +169,10 @@ class CloudflareDNSUpdater:
 
     def delete_dns_record(self, record_id: str) -> bool:
         logger.info(f"Deleting record ID {record_id}")
-        response = requests.delete(
-            f"{self.base_url}/zones/{self.zone_id}/dns_records/{record_id}",
-            headers=self.headers
+        response_data = self._call(
+            'DELETE',
+            f"{self.base_url}/zones/{self.zone_id}/dns_records/{record_id}"
         )
-        response_data = response.json()
 
         if not response_data['success']:
             logger.error(f"Failed to delete DNS record: {response_data['errors']}")
@@ -185,6 +204,15 @@ def read_input_csv(input_csv: str) -> Dict[str, List[str]]:
 def main():
     # Load configuration
     config = load_config()
+    configure_logging(config)
+    metrics = RunMetrics.from_config(config, 'cfRecUpdate')
+    try:
+        update_records(config, metrics)
+    finally:
+        metrics.write()
+
+
+def update_records(config: configparser.ConfigParser, metrics: RunMetrics):
     input_csv = config.get('cfRecUpdate', 'input_csv')
     zone_id = config.get('cfRecUpdate', 'zone_id')
     api_token = os.getenv('CLOUDFLARE_API_TOKEN')
@@ -193,19 +221,20 @@ def main():
         logger.critical("API Token is not provided via environment variable.")
         raise ValueError("Please provide the CLOUDFLARE_API_TOKEN environment variable.")
 
-    dns_updater = CloudflareDNSUpdater(api_token, zone_id)
+    dns_updater = CloudflareDNSUpdater(api_token, zone_id, metrics)
 
     # Read input CSV and process DNS records
     domain_ips = read_input_csv(input_csv)
     for domain, ips in domain_ips.items():
         logger.info(f"Updating records for domain: {domain}")
-        dns_updater.update_multiple_dns_records(
-            record_name=domain,
-            record_type="A",  # Assuming "A" records, can be changed to another type if needed
-            new_content=ips,
-            proxied=False,
-            ttl=1
-        )
+        with metrics.stage('update'):
+            dns_updater.update_multiple_dns_records(
+                record_name=domain,
+                record_type="A",  # Assuming "A" records, can be changed to another type if needed
+                new_content=ips,
+                proxied=False,
+                ttl=1
+            )
 
     logger.info("DNS records updated successfully.")
 
@@ -7,23 +7,35 @@ including ping, upload, and download speeds across different regions.
 """
 
 import os
+import re
 import csv
-import ssl
+import mmap
 import time
-import random
+import asyncio
+import argparse
+import threading
 import typing
 import logging
 import ipaddress
 import configparser
-from io import StringIO
-from dataclasses import dataclass
-from typing import List, Dict, Optional, Tuple
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import geoip2.database
-import json
-from geoip2fast import GeoIP2Fast
-
-import requests
+from collections import deque
+from dataclasses import asdict, dataclass
+from typing import List, Dict, Optional, Set, Tuple, Iterator
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+from pinnedTransport import PinnedTransport, TRANSPORT_ERRORS
+from probeCache import ProbeCache, ProbeRecord
+from candidateScheduler import CandidateScheduler
+from mapDomain import load_domain_map
+from geoEnrich import GeoEnricher
+from coloData import ColoTable
+from resultStore import FAILURES_COLUMN, TESTED_AT_COLUMN, format_time, merge_results, write_results
+from resultJournal import ResultJournal
+from sharding import parse_shard, shard_name, shard_of, shard_path
+from runMetrics import RunMetrics, configure_logging
+from latencyProbe import LatencyProber, LatencyResult, LatencyStats
+from candidateStore import Candidate, CandidateSet, is_candidate_file, read_candidates, read_json_candidates
 
 # Logging configuration
 logging.basicConfig(
@@ -39,6 +51,70 @@ except ImportError:
     PING_AVAILABLE = False
     logging.warning("ping3 module not found. Ping functionality will be limited.")
 
+# Hostname sent in SNI and the Host header of every speed test probe
+SPEED_TEST_HOST = 'speed.cloudflare.com'
+
+# Size of the buffer download bodies are read into
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Interval between throughput estimates used for the convergence check
+DOWNLOAD_SAMPLE_INTERVAL = 0.1
+
+# Size of each chunk of the upload body
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+class UploadPayload:
+    """
+    Zero-filled upload body shared read-only by every upload test.
+
+    The payload is an anonymous memory map, so it is allocated once per run
+    and its untouched pages cost no resident memory.
+    """
+    def __init__(self, size: int):
+        """
+        Allocate the payload.
+
+        :param size: Payload size in bytes
+        """
+        self.size = size
+        self._map = mmap.mmap(-1, max(size, 1))
+        self._view = memoryview(self._map)[:size].toreadonly()
+
+    def chunks(self, started: List[float]) -> Iterator[memoryview]:
+        """
+        Iterate over the payload in chunks without copying it.
+
+        :param started: List the time the first chunk is handed out is appended to
+        :return: Iterator of read-only chunks
+        """
+        for offset in range(0, self.size, UPLOAD_CHUNK_SIZE):
+            if not started:
+                started.append(time.perf_counter())
+            yield self._view[offset:offset + UPLOAD_CHUNK_SIZE]
+
+@dataclass
+class DownloadMeasurement:
+    """
+    Data class to store the result of a streaming download test.
+    """
+    speed: float
+    ttfb: int
+    bytes_read: int
+    converged: bool
+
+# Columns of `IPPerformanceMetrics.to_csv_row`
+CSV_HEADER = [
+    'IP', 'Region', 'Ping (ms)', 'Upload (Mbps)', 'Download (Mbps)', 'Port', 'TLS', 'ASN', 'ASN Name', 'TTFB (ms)', 'Colo',
+    'Ping Min (ms)', 'Ping P95 (ms)', 'Jitter (ms)', 'Loss (%)', 'Vantage'
+]
+
+def csv_value(value) -> str:
+    """CSV cell of a value; unknown values, such as a missing ASN or port, are left empty."""
+    return '' if value is None else str(value)
+
+# Version of the `IPPerformanceMetrics` fields stored in the result journal; bump it when they change
+JOURNAL_VERSION = 1
+
 @dataclass
 class IPPerformanceMetrics:
     """
@@ -53,6 +129,14 @@ class IPPerformanceMetrics:
     tls: str
     asn: str
     asn_name: str
+    ttfb: int
+    colo: Optional[str] = None
+    ping_min: Optional[int] = None
+    ping_p95: Optional[int] = None
+    jitter: Optional[float] = None
+    loss: Optional[float] = None
+    tested_at: Optional[float] = None
+    vantage: Optional[str] = None
 
     def to_csv_row(self) -> List[str]:
         """Convert metrics to CSV row format."""
@@ -65,34 +149,238 @@ class IPPerformanceMetrics:
             self.port,
             self.tls,
             self.asn,
-            self.asn_name
+            self.asn_name,
+            str(self.ttfb),
+            self.colo or '',
+            '' if self.ping_min is None else str(self.ping_min),
+            '' if self.ping_p95 is None else str(self.ping_p95),
+            '' if self.jitter is None else f"{self.jitter:.1f}",
+            '' if self.loss is None else f"{self.loss * 100:.0f}",
+            self.vantage or ''
         ]
 
+class RegionWorkQueue:
+    """
+    Candidates of every region, handed out while the region still needs passing IPs.
+
+    Regions are interleaved by smooth weighted round-robin, so a region with
+    weight 2 gets two candidates for every one of a region with weight 1,
+    whatever their sizes.
+    """
+    def __init__(
+        self,
+        region_candidates: Dict[str, List[Candidate]],
+        quotas: Dict[str, int],
+        max_attempts: int,
+        weights: Optional[Dict[str, float]] = None
+    ):
+        """
+        Initialize the queue.
+
+        :param region_candidates: Dictionary mapping regions to candidates in test order
+        :param quotas: Passing IPs needed per region (defaults to `max_attempts`),
+            including regions IPs may be moved to by `rehome`
+        :param max_attempts: Maximum number of IPs speed-tested per region
+        :param weights: Share of the candidates handed out per region (defaults to 1)
+        """
+        self._pending = {region: deque(candidates) for region, candidates in region_candidates.items()}
+        self._configured_quotas = quotas
+        self.quotas = {region: quotas.get(region, max_attempts) for region in region_candidates}
+        self.max_attempts = max_attempts
+        self.passed = dict.fromkeys(region_candidates, 0)
+        self.in_flight = dict.fromkeys(region_candidates, 0)
+        self.attempts = dict.fromkeys(region_candidates, 0)
+        weights = weights or {}
+        self.weights = {region: weights.get(region, 1.0) for region in region_candidates}
+        self._credit = dict.fromkeys(region_candidates, 0.0)
+        self._changed = asyncio.Condition()
+
+    def needs(self, region: str) -> bool:
+        """Whether the region may still speed-test another IP."""
+        return (
+            self.passed[region] + self.in_flight[region] < self.quotas[region]
+            and self.attempts[region] < self.max_attempts
+        )
+
+    def _next_region(self) -> Optional[str]:
+        """Pick the eligible region with the most credit, by smooth weighted round-robin."""
+        eligible = [region for region, pending in self._pending.items() if pending and self.needs(region)]
+        if not eligible:
+            return None
+        for region in eligible:
+            self._credit[region] += self.weights[region]
+        chosen = max(eligible, key=self._credit.__getitem__)
+        self._credit[chosen] -= sum(self.weights[region] for region in eligible)
+        return chosen
+
+    async def get(self) -> Optional[Candidate]:
+        """
+        Get the next candidate to ping.
+
+        Waits while the only regions left are those whose IPs under test may
+        still fail and reopen their quota.
+
+        :return: Candidate, or None when no region needs more IPs
+        """
+        async with self._changed:
+            while True:
+                region = self._next_region()
+                if region is not None:
+                    return self._pending[region].popleft()
+                if not any(pending and self.in_flight[region] for region, pending in self._pending.items()):
+                    return None
+                await self._changed.wait()
+
+    def admit(self, region: str) -> bool:
+        """
+        Admit an IP that passed the ping test to the speed tests.
+
+        :param region: Region of the IP
+        :return: True if admitted, False if the region needs no more IPs
+        """
+        if not self.needs(region):
+            return False
+        self.in_flight[region] += 1
+        self.attempts[region] += 1
+        return True
+
+    async def rehome(self, region: str, new_region: str) -> bool:
+        """
+        Move an admitted IP to the region it turned out to belong to, e.g. the
+        region of the colo its trace reported.
+
+        :param region: Region the IP was admitted under
+        :param new_region: Region the IP is reported under
+        :return: True if moved, False if the new region needs no more IPs;
+            the IP is then no longer in flight for either region
+        """
+        async with self._changed:
+            if new_region not in self.quotas:
+                # A region none of the candidates were grouped under before their trace
+                self._pending[new_region] = deque()
+                self.quotas[new_region] = self._configured_quotas.get(new_region, self.max_attempts)
+                self.passed[new_region] = self.in_flight[new_region] = self.attempts[new_region] = 0
+                self.weights[new_region] = 1.0
+                self._credit[new_region] = 0.0
+            self.in_flight[region] -= 1
+            self.attempts[region] -= 1
+            self._changed.notify_all()
+            return self.admit(new_region)
+
+    def add_passed(self, region: str) -> None:
+        """Count an IP that passed without being tested, e.g. from the probe cache."""
+        self.passed[region] += 1
+        self.attempts[region] += 1
+
+    async def resolve(self, region: str, passed: bool) -> None:
+        """
+        Finish an admitted IP.
+
+        :param region: Region of the IP
+        :param passed: Whether the IP passed every test
+        """
+        async with self._changed:
+            self.in_flight[region] -= 1
+            if passed:
+                self.passed[region] += 1
+            self._changed.notify_all()
+
 class CloudflareIPTester:
     """
     Main class for testing Cloudflare IP addresses.
     """
-    def __init__(self, config_path: str = 'config.ini'):
+    def __init__(self, config_path: str = 'config.ini', shard: Optional[str] = None, vantage: Optional[str] = None):
         """
         Initialize the tester with configuration settings.
 
         :param config_path: Path to the configuration file
+        :param shard: Shard of the candidates to test as `INDEX/COUNT` (defaults to `shard` in the configuration)
+        :param vantage: Name of the place the tests run from (defaults to `vantage` in the configuration)
         """
         self.config = configparser.ConfigParser()
         self.config.read(config_path)
 
+        # Share of the candidates this run tests, and where it tests them from
+        self.shard = parse_shard(shard if shard is not None else self.config.get('cfSpeedTest', 'shard', fallback=''))
+        self.vantage = vantage if vantage is not None else self.config.get('cfSpeedTest', 'vantage', fallback='')
+
+        # Run report and log level; per-IP lines are only logged at DEBUG
+        configure_logging(self.config)
+        self.metrics = RunMetrics.from_config(self.config, shard_name('cfSpeedTest', self.shard))
+
         # Configuration parsing with type conversion and validation
         self.max_ips = self._get_config_int('cfSpeedTest', 'max_ips', 10)
         self.max_ping = self._get_config_int('cfSpeedTest', 'max_ping', 100)
         self.test_size = self._get_config_int('cfSpeedTest', 'test_size', 1024)
         self.min_download_speed = self._get_config_float('cfSpeedTest', 'min_download_speed', 5.0)
         self.min_upload_speed = self._get_config_float('cfSpeedTest', 'min_upload_speed', 2.0)
+        self.download_time_limit = self._get_config_float('cfSpeedTest', 'download_time_limit', 4.0)
+        self.download_warmup = self._get_config_int('cfSpeedTest', 'download_warmup', 200)
+        self.download_converge_tolerance = self._get_config_float('cfSpeedTest', 'download_converge_tolerance', 0.05)
         self.output_file = self._get_config_str('cfSpeedTest', 'output_file', 'ip_performance.csv')
+
+        # Results merged across runs; times are in hours
+        self.incremental_results = self._get_config_bool('cfSpeedTest', 'incremental_results', True)
+        self.results_half_life = self._get_config_float('cfSpeedTest', 'results_half_life', 6.0)
+        self.results_max_age = self._get_config_float('cfSpeedTest', 'results_max_age', 48.0)
+        self.results_max_failures = self._get_config_int('cfSpeedTest', 'results_max_failures', 2)
+        self.failed: Set[Tuple[str, str]] = set()
+
+        # Journal every tested IP is streamed to, resumed by the next run if this one is interrupted
+        self.journal_file = shard_path(self._get_config_str('cfSpeedTest', 'journal_file', ''), self.shard)
+        self.journal_fsync_interval = self._get_config_float('cfSpeedTest', 'journal_fsync_interval', 5.0)
+        self.journal_max_age = self._get_config_float('cfSpeedTest', 'journal_max_age', 6.0)
+        self.journal: Optional[ResultJournal] = None
         self.ip_file = self._get_config_str('cfSpeedTest', 'file_ips', 'ips.txt')
         self.force_ping_fallback = self._get_config_bool('cfSpeedTest', 'force_ping_fallback', False)
 
-        # Check OpenSSL availability
-        self.openssl_available = bool(ssl.OPENSSL_VERSION)
+        # Latency test: `tcp` or `icmp` sample every IP from the event loop, `https` and `ping3` are the per-thread methods
+        self.ping_method = self._get_config_str(
+            'cfSpeedTest', 'ping_method', 'https' if self.force_ping_fallback else 'ping3'
+        ).strip().lower()
+        self.ping_samples = self._get_config_int('cfSpeedTest', 'ping_samples', 3)
+
+        # Probe cache shared between runs; TTLs are in hours
+        self.cache_file = shard_path(self._get_config_str('cfSpeedTest', 'cache_file', ''), self.shard)
+        self.cache_ttl_good = self._get_config_float('cfSpeedTest', 'cache_ttl_good', 6.0)
+        self.cache_ttl_dead = self._get_config_float('cfSpeedTest', 'cache_ttl_dead', 24.0)
+
+        # Candidate scheduling from the probe history
+        self.exploration_share = self._get_config_float('cfSpeedTest', 'exploration_share', 0.1)
+        self.history_half_life = self._get_config_float('cfSpeedTest', 'history_half_life', 24.0)
+        self.ranking_file = self._get_config_str('cfSpeedTest', 'ranking_file', '')
+
+        # GeoIP data file reused for `geoip_max_age` hours; lookups are kept with it, in a directory cached between runs
+        self.geoip_data_file = self._get_config_str('cfSpeedTest', 'geoip_data_file', 'geoip2fast-city-asn.dat.gz')
+        self.geoip_data_dir = self._get_config_str('cfSpeedTest', 'geoip_data_dir', '.cache')
+        self.geoip_max_age = self._get_config_float('cfSpeedTest', 'geoip_max_age', 24.0)
+        self.geoip_cache_file = self._get_config_str('cfSpeedTest', 'geoip_cache_file', '') or os.path.join(
+            self.geoip_data_dir, f"{os.path.splitext(os.path.basename(self.ip_file))[0]}.geo.json"
+        )
+
+        # Local Cloudflare colo dataset, refreshed in the background
+        self.colo_file = self._get_config_str('cfSpeedTest', 'colo_file', '.cache/cloudflare-colos.csv')
+        self.colo_table = ColoTable(self.colo_file)
+
+        # Region of an IP: its GeoIP country, or the region of the colo its trace reports
+        self.region_source = self._get_config_str('cfSpeedTest', 'region_source', 'geoip').strip().lower()
+
+        # Stop testing a region once mapDomain has enough IPs for it
+        self.use_domain_quota = self._get_config_bool('cfSpeedTest', 'use_domain_quota', True)
+        self.quota_margin = self._get_config_int('cfSpeedTest', 'quota_margin', 3)
+
+        # Pipeline concurrency: a global cap on in-flight connections plus a worker count per stage
+        self.concurrency = self._get_config_int('cfSpeedTest', 'concurrency', 64)
+        self.ping_concurrency = self._get_config_int('cfSpeedTest', 'ping_concurrency', 32)
+        self.download_concurrency = self._get_config_int('cfSpeedTest', 'download_concurrency', 4)
+        self.upload_concurrency = self._get_config_int('cfSpeedTest', 'upload_concurrency', 4)
+
+        # Every probe dials the candidate IP directly and reuses its connection
+        self.transport = PinnedTransport(timeout=self.max_ping / 1000, max_pools=self.concurrency * 4)
+
+        # Download buffers are reused by each worker thread, the upload body by all of them
+        self._buffers = threading.local()
+        self.upload_payload = UploadPayload(self.test_size * 1024)
 
     def _get_config_int(self, section: str, key: str, default: int) -> int:
         """Safely get integer configuration value."""
@@ -127,21 +415,21 @@ class CloudflareIPTester:
             return default
 
     @staticmethod
-    def read_ips(file_path: str) -> List[str]:
+    def read_ips(file_path: str) -> CandidateSet:
         """
         Read and validate IP addresses from a file.
 
         :param file_path: Path to the file containing IP addresses
-        :return: List of valid IP addresses
+        :return: Set of candidates with a valid IP address
         """
         try:
-            ips = []
-            with open(file_path, 'r') as file:
-                ips_list = json.load(file)
-                ips = list(
-                    filter(
-                        lambda ip_obj: ip_obj.get('ip') and CloudflareIPTester.validate_ip(ip_obj.get('ip')), ips_list
-                    )
+            if is_candidate_file(file_path):
+                # Binary candidate files only hold packed, hence valid, addresses
+                ips = CandidateSet(read_candidates(file_path))
+            else:
+                ips = CandidateSet(
+                    candidate for candidate in read_json_candidates(file_path)
+                    if CloudflareIPTester.validate_ip(candidate.ip)
                 )
 
             if not ips:
@@ -168,71 +456,60 @@ class CloudflareIPTester:
             logging.warning(f"Invalid IP address: {ip}")
             return False
 
-    def fetch_cloudflare_colo_data(self) -> List[Dict[str, str]]:
+    def get_trace(self, ip: str, port: int = 443, tls: bool = True) -> Optional[Dict[str, str]]:
         """
-        Fetch Cloudflare colo data from a remote CSV.
+        Get the Cloudflare trace of an IP address.
 
-        :return: List of colo data dictionaries
+        The request goes over the pinned transport, so it reuses the
+        connection opened by the ping test, or opens the one reused by the
+        speed tests.
+
+        :param ip: IP address to trace
+        :param port: Port of the IP, as listed in the candidate file
+        :param tls: Whether the port serves TLS; plain-HTTP ports are requested without it
+        :return: Trace fields such as `colo` and `loc`, or None on failure
         """
         try:
-            csv_url = "https://raw.githubusercontent.com/Netrvin/cloudflare-colo-list/refs/heads/main/DC-Colos.csv"
-            response = requests.get(csv_url, timeout=4)
-            response.raise_for_status()
-
-            return list(csv.DictReader(StringIO(response.text)))
-        except requests.RequestException as e:
-            logging.error(f"Error fetching Cloudflare colo data: {e}")
-            return []
-
-    # def get_colo_from_ip(self, ip: str) -> Optional[str]:
-    #     """
-    #     Fetch the colo code for a given IP address.
-
-    #     :param ip: IP address to check
-    #     :return: Colo code or None
-    #     """
-    #     try:
-    #         url = f"https://speed.cloudflare.com/cdn-cgi/trace"
-    #         headers = {'Host': 'speed.cloudflare.com'}
-
-    #         params = {
-    #             'resolve': f"speed.cloudflare.com:443:{ip}",
-    #             **({"alpn": "h2,http/1.1", "utls": "random"} if self.openssl_available else {})
-    #         }
-
-    #         response = requests.get(url, headers=headers, params=params, timeout=4)
-    #         response.raise_for_status()
+            response = self.transport.request(
+                'GET', ip, SPEED_TEST_HOST, '/cdn-cgi/trace', port=port, tls=tls, timeout=self.max_ping/1000
+            )
+            if response.status != 200:
+                logging.debug(f"Trace of IP {ip} failed with status {response.status}")
+                return None
+            trace = dict(line.split('=', 1) for line in response.data.decode('utf-8', 'replace').splitlines() if '=' in line)
+            logging.debug(f"Trace of IP {ip}: colo {trace.get('colo')}, loc {trace.get('loc')}")
+            return trace
+        except TRANSPORT_ERRORS as e:
+            logging.debug(f"Trace of IP {ip} failed: {e}")
+            return None
+
+    def colo_region(self, colo: Optional[str]) -> Optional[str]:
+        """
+        Map a Cloudflare colo to a region.
 
-    #         for line in response.text.splitlines():
-    #             if line.startswith("loc="):
-    #                 return line.split("=")[1]
-    #     except requests.RequestException as e:
-    #         logging.error(f"Error fetching colo for IP {ip}: {e}")
+        The region of the colo in the colo dataset is normalized to the
+        `[mapDomain.map]` naming, e.g. "Asia Pacific" becomes "Asia_Pacific".
 
-    #     return None
+        :param colo: Colo code
+        :return: Region, or None if the colo is not in the dataset
+        """
+        row = self.colo_table.get(colo)
+        if not row or not row.get('region'):
+            return None
+        return self._region_name(row['region'])
 
-    def get_country_from_ip(self, ip: str, geoip) -> Optional[str]:
+    def colo_regions(self) -> Set[str]:
         """
-        Fetch the colo code for a given IP address.
+        Get the regions of every colo in the colo dataset.
 
-        :param ip: IP address to check
-        :return: Colo code or None
+        :return: Set of regions, named as by `colo_region`
         """
-        try:
-            if geo_data := geoip.lookup(ip):
-                return geo_data.country_code, geo_data.country_name, geo_data.asn_name
-            # with geoip2.database.Reader('./Country.mmdb') as ip_reader:
-            #     try:
-            #         response = ip_reader.country(ip)
-            #         country_code = response.country.iso_code
-            #         country_name = response.country.name
-            #         return country_code, country_name
-            #     except Exception:
-            #         return None, None
-        except requests.RequestException as e:
-            logging.error(f"Error fetching colo for IP {ip}: {e}")
-
-        return None, None, None
+        return {self._region_name(row['region']) for row in self.colo_table if row.get('region')}
+
+    @staticmethod
+    def _region_name(region: str) -> str:
+        """Normalize a region of the colo dataset to the `[mapDomain.map]` naming."""
+        return re.sub(r'[^0-9A-Za-z]+', '_', region.strip()).strip('_')
 
     def get_ping(self, ip: str) -> int:
         """
@@ -242,265 +519,788 @@ class CloudflareIPTester:
         :return: Ping time in milliseconds
         """
         try:
-            start_time = time.time()
             response_time = ping3.ping(ip, timeout=self.max_ping/1000)
 
-            if response_time is not None and response_time > 0:
-                logging.info(f"Ping time for IP {ip}: {int(response_time * 1000)} ms")
-                return int(response_time * 1000)
+            # `ping3` returns None on timeout and False on error
+            if response_time:
+                logging.debug(f"Ping time for IP {ip}: {response_time * 1000:.1f} ms")
+                return max(int(response_time * 1000), 1)
 
-            logging.info(f"Ping time for IP {ip}: {(time.time() - start_time) * 1000} ms")
-            return int((time.time() - start_time) * 1000)
+            logging.debug(f"Ping for IP {ip} got no reply")
+            return -1
         except Exception as e:
             logging.error(f"Ping failed for {ip}: {e}")
             return -1
 
-    def get_ping_fallback(self, ip: str) -> int:
+    def get_ping_fallback(self, ip: str, port: int = 443, tls: bool = True) -> int:
         """
-        Get ping for an IP address. Fallback method using requests.
+        Get ping for an IP address. Fallback method using an HTTPS request,
+        or plain HTTP on ports without TLS, over the pinned transport, which also opens the connection reused by
+        the speed tests.
+
+        The request goes to the speed test host rather than a connectivity
+        check host such as `cp.cloudflare.com`, so the ping is taken with the
+        same SNI and Host header the download and upload use, and an IP that
+        does not serve that host fails here instead of in the speed tests.
+        An empty download keeps the request as cheap as the 204 response.
 
         :param ip: IP address to ping
-        :return: Ping time in milliseconds
+        :param port: Port of the IP, as listed in the candidate file
+        :param tls: Whether the port serves TLS; plain-HTTP ports are requested without it
+        :return: Ping time in milliseconds, or -1 on failure
         """
-        url = "https://cp.cloudflare.com/generate_204"
-        headers = {'Host': 'cp.cloudflare.com'}
-
-        params = {
-            'resolve': f"cp.cloudflare.com:443:{ip}",
-            **({"alpn": "h2,http/1.1", "utls": "random"} if self.openssl_available else {})
-        }
-
         try:
             start_time = time.time()
-            response = requests.get(url, headers=headers, params=params, timeout=self.max_ping/1000)
+            self.transport.request('GET', ip, SPEED_TEST_HOST, '/__down?bytes=0', port=port, tls=tls, timeout=self.max_ping/1000)
             end_time = time.time()
 
-            rtt = int((end_time - start_time) * 1000)  # Convert to milliseconds
-            logging.info(f"HTTP-based ping for IP {ip}: {rtt} ms")
+            rtt = max(int((end_time - start_time) * 1000), 1)  # Convert to milliseconds
+            logging.debug(f"HTTP-based ping for IP {ip}: {rtt} ms")
             return rtt
-        except requests.RequestException as e:
-            logging.error(f"HTTP-based ping failed for IP {ip}: {e}")
+        except TRANSPORT_ERRORS as e:
+            logging.debug(f"HTTP-based ping failed for IP {ip}: {e}")
             return -1
 
-    def get_download_speed(self, ip: str) -> float:
+    def _get_download_buffer(self) -> memoryview:
+        """Get the download buffer of the current thread."""
+        buffer = getattr(self._buffers, 'download', None)
+        if buffer is None:
+            buffer = self._buffers.download = memoryview(bytearray(DOWNLOAD_CHUNK_SIZE))
+        return buffer
+
+    def _has_converged(self, estimates: List[float]) -> bool:
+        """Check whether the last three throughput estimates agree within the tolerance."""
+        if self.download_converge_tolerance <= 0 or len(estimates) < 3:
+            return False
+        recent = estimates[-3:]
+        return max(recent) - min(recent) <= self.download_converge_tolerance * max(recent)
+
+    def get_download_speed(self, ip: str, port: int = 443, tls: bool = True) -> DownloadMeasurement:
         """
         Test download speed for an IP.
 
+        The body is streamed into a reused buffer. Time to first byte is
+        taken when the response headers arrive, and throughput is computed
+        only over the bytes received after the `download_warmup` window that
+        follows them. The test stops early
+        once the throughput estimate converges or `download_time_limit` passes.
+
         :param ip: IP address to test
-        :return: Download speed in Mbps
+        :param port: Port of the IP, as listed in the candidate file
+        :param tls: Whether the port serves TLS; plain-HTTP ports are requested without it
+        :return: Download measurement with the speed in Mbps
         """
         download_size = self.test_size * 1024
-        url = f"https://speed.cloudflare.com/__down?bytes={download_size}"
-        headers = {'Host': 'speed.cloudflare.com'}
-
-        params = {
-            'resolve': f"speed.cloudflare.com:443:{ip}",
-            **({"alpn": "h2,http/1.1", "utls": "random"} if self.openssl_available else {})
-        }
+        buffer = self._get_download_buffer()
+        failed = DownloadMeasurement(speed=0.0, ttfb=-1, bytes_read=0, converged=False)
 
         try:
-            start_time = time.time()
-            response = requests.get(url, headers=headers, params=params, timeout=1)
-            download_time = time.time() - start_time
-
-            logging.info(f"Download speed: {round(download_size / download_time * 8 / 1_000_000, 2)} Mbps")
-            return round(download_size / download_time * 8 / 1_000_000, 2)
-        except requests.RequestException:
-            return 0.0
-
-    def get_upload_speed(self, ip: str) -> float:
+            start_time = time.perf_counter()
+            response = self.transport.request(
+                'GET', ip, SPEED_TEST_HOST, f"/__down?bytes={download_size}", port=port, tls=tls, timeout=1, preload_content=False
+            )
+            # The request returns with the response headers, before any of the body is read
+            first_byte_time = time.perf_counter()
+        except TRANSPORT_ERRORS:
+            return failed
+        ttfb = int((first_byte_time - start_time) * 1000)
+
+        bytes_read = 0
+        drained = converged = False
+        try:
+            read = response.readinto(buffer)
+            bytes_read += read
+
+            warmup_end = first_byte_time + self.download_warmup / 1000
+            deadline = first_byte_time + self.download_time_limit
+            window_start, window_bytes = first_byte_time, 0
+            end_time = first_byte_time
+            in_warmup = True
+            next_sample = warmup_end + DOWNLOAD_SAMPLE_INTERVAL
+            estimates: List[float] = []
+
+            while read:
+                read = response.readinto(buffer)
+                now = end_time = time.perf_counter()
+                bytes_read += read
+
+                if in_warmup:
+                    if now < warmup_end:
+                        window_bytes += read
+                        continue
+                    # Steady-state window starts with the first read after the warm-up
+                    in_warmup = False
+                    window_start, window_bytes = now, 0
+                    continue
+
+                window_bytes += read
+                if now >= next_sample:
+                    estimates.append(window_bytes / (now - window_start))
+                    next_sample = now + DOWNLOAD_SAMPLE_INTERVAL
+                    if self._has_converged(estimates):
+                        converged = True
+                        break
+                if now >= deadline:
+                    break
+            drained = not read
+        except TRANSPORT_ERRORS:
+            return failed
+        finally:
+            if not drained:
+                # Unread body left on the connection: it can not go back to the pool
+                response.close()
+            response.release_conn()
+
+        elapsed = end_time - window_start
+        if elapsed <= 0 or window_bytes <= 0:
+            # Body too small for a steady-state window: time the whole request instead
+            window_bytes, elapsed = bytes_read, end_time - start_time
+
+        speed = round(window_bytes / elapsed * 8 / 1_000_000, 2)
+        logging.debug(f"Download speed for IP {ip}: {speed} Mbps (TTFB {ttfb} ms, {bytes_read} bytes)")
+        return DownloadMeasurement(speed=speed, ttfb=ttfb, bytes_read=bytes_read, converged=converged)
+
+    def get_upload_speed(self, ip: str, port: int = 443, tls: bool = True, rtt: Optional[float] = None) -> float:
         """
         Test upload speed for an IP.
 
+        The shared payload is streamed with chunked transfer encoding, and the
+        upload is timed from the first chunk sent to the response headers,
+        less the round trip the headers take after the last chunk.
+
         :param ip: IP address to test
+        :param port: Port of the IP, as listed in the candidate file
+        :param tls: Whether the port serves TLS; plain-HTTP ports are requested without it
+        :param rtt: Round-trip time of the IP in milliseconds (optional)
         :return: Upload speed in Mbps
         """
-        upload_size = int(self.test_size * 1024)
-        url = 'https://speed.cloudflare.com/__up'
-        headers = {
-            'Content-Type': 'multipart/form-data',
-            'Host': 'speed.cloudflare.com'
-        }
+        upload_size = self.upload_payload.size
+        started: List[float] = []
 
-        params = {
-            'resolve': f"speed.cloudflare.com:443:{ip}",
-            **({"alpn": "h2,http/1.1", "utls": "random"} if self.openssl_available else {})
-        }
+        try:
+            response = self.transport.request(
+                'POST', ip, SPEED_TEST_HOST, '/__up', port=port, tls=tls,
+                body=self.upload_payload.chunks(started),
+                headers={'Content-Type': 'application/octet-stream'},
+                timeout=1,
+                preload_content=False,
+                chunked=True
+            )
+            upload_time = time.perf_counter() - started[0]
+            if rtt and upload_time > 2 * rtt / 1000:
+                upload_time -= rtt / 1000
+            response.drain_conn()
+            response.release_conn()
+        except TRANSPORT_ERRORS:
+            return 0.0
 
-        files = {'file': ('sample.bin', b"\x00" * upload_size)}
+        logging.debug(f"Upload speed for IP {ip}: {round(upload_size / upload_time * 8 / 1_000_000, 2)} Mbps")
+        return round(upload_size / upload_time * 8 / 1_000_000, 2)
 
-        try:
-            start_time = time.time()
-            requests.post(url, headers=headers, params=params, files=files, timeout=1)
-            upload_time = time.time() - start_time
+    def map_ips_to_regions(self, candidates: CandidateSet, enricher: GeoEnricher) -> Dict[str, List[Candidate]]:
+        """
+        Map IPs to their corresponding regions.
 
-            logging.info(f"Upload speed: {round(upload_size / upload_time * 8 / 1_000_000, 2)} Mbps")
-            return round(upload_size / upload_time * 8 / 1_000_000, 2)
-        except requests.RequestException:
-            return 0.0
+        Sets the region and ASN name of every candidate that could be located.
 
-    def map_ips_to_regions(self, ip_list: List[str], geoip) -> Dict[str, List[str]]:
+        :param candidates: Set of candidates
+        :param enricher: GeoIP enricher
+        :return: Dictionary mapping regions to candidates
         """
-        Map IPs to their corresponding regions using multithreading.
+        enricher.enrich(candidates)
+        if not logging.getLogger().isEnabledFor(logging.DEBUG):
+            return candidates.by_region()
+        for candidate in candidates:
+            if candidate.region:
+                logging.debug(f"IP: {candidate.ip}; Region: {candidate.region}; ASN Name: {candidate.asn_name}")
+        return candidates.by_region()
+
+    def apply_cached_colos(
+        self,
+        candidates: CandidateSet,
+        cached: Dict[Tuple[str, int], ProbeRecord]
+    ) -> Dict[str, List[Candidate]]:
+        """
+        Group IPs by the region of the colo their last trace reported.
+
+        IPs never traced, or whose colo is not in the colo dataset, keep their GeoIP region.
 
-        :param ip_list: List of IP addresses
-        :return: Dictionary mapping regions to IPs
+        :param candidates: Set of candidates with their GeoIP region
+        :param cached: Records loaded from the probe cache
+        :return: Dictionary mapping regions to candidates
         """
-        logging.info("Fetching Cloudflare colo data.")
-        colo_data = self.fetch_cloudflare_colo_data()
-        if not colo_data:
-            raise RuntimeError("Critical error: Failed to fetch Cloudflare colo data.")
+        moved = 0
+        for candidate in candidates:
+            record = cached.get((candidate.ip, candidate.port))
+            if record and record.colo:
+                candidate.colo = record.colo
+                if region := self.colo_region(record.colo):
+                    candidate.region = region
+                    moved += 1
+        logging.info(f"Grouped {moved} IPs by the colo of their last trace.")
+        return candidates.by_region()
+
+    def ping_ip(self, ip: str, port: int = 443, tls: bool = True) -> int:
+        """
+        Ping an IP address with the configured per-thread method.
 
-        region_ip_map = {}
-        ip_to_asn_name_map = {}
+        :param ip: IP address to ping
+        :param port: Port of the IP, used by the HTTPS ping
+        :param tls: Whether the port serves TLS; plain-HTTP ports are requested without it
+        :return: Ping time in milliseconds, or -1 on failure
+        """
+        if self.ping_method == 'https' or not PING_AVAILABLE:
+            # Force fallback method if configured or `ping3` is unavailable
+            return self.get_ping_fallback(ip, port, tls)
+        return self.get_ping(ip)
 
-        def process_ip(ip):
-            # colo = self.get_colo_from_ip(ip)
-            
-            # region = self.get_region_from_colo(colo, colo_data)
-            colo, region, asn_name = self.get_country_from_ip(ip, geoip)
-            if not colo:
-                return None, None
-            logging.info(f"IP: {ip}; Colo: {colo}; Region: {region}; ASN Name: {asn_name}")
-            return region, ip, asn_name
+    def sample_latency(self, ip: str, port: int = 443, tls: bool = True) -> LatencyResult:
+        """
+        Ping an IP address `ping_samples` times with the configured per-thread method.
 
-        with ThreadPoolExecutor(max_workers=20) as executor:
-            future_to_ip = {executor.submit(process_ip, ip): ip for ip in ip_list}
+        :param ip: IP address to ping
+        :param port: Port of the IP, used by the HTTPS ping
+        :param tls: Whether the port serves TLS; plain-HTTP ports are requested without it
+        :return: Latency samples; failed pings are kept as lost samples
+        """
+        result = LatencyResult(ip, port)
+        for _ in range(max(self.ping_samples, 1)):
+            ping = self.ping_ip(ip, port, tls)
+            result.samples.append(ping if ping > 0 else None)
+        return result
 
-            for future in as_completed(future_to_ip):
-                try:
-                    region, ip, asn_name = future.result()
-                    if region and ip:
-                        region_ip_map.setdefault(region, []).append(ip)
-                        ip_to_asn_name_map.setdefault(ip, asn_name)
-                except Exception as e:
-                    logging.error(f"Error processing IP {future_to_ip[future]}: {e}")
+    def get_region_quotas(self, regions: List[str]) -> Dict[str, int]:
+        """
+        Get the number of passing IPs needed per region.
 
-        return region_ip_map, ip_to_asn_name_map
+        Regions mapped in `[mapDomain.map]` need their `max ip` plus the
+        configured safety margin; other regions need `max_ips`. A shard
+        needs its share of the quota.
 
-    def filter_ips_by_ping(self, ip_list: List[str]) -> List[Tuple[str, int]]:
+        :param regions: Regions to get the quota of
+        :return: Dictionary mapping regions to quotas
+        """
+        if not self.use_domain_quota or not self.config.has_section('mapDomain.map'):
+            return {region: self.shard_share(self.max_ips) for region in regions}
+
+        _, domain_max_ips = load_domain_map(self.config)
+        self.warn_unmatched_regions('[mapDomain.map]', domain_max_ips, regions)
+        quotas = {}
+        for region in regions:
+            domain_max = domain_max_ips.get(region.strip().lower())
+            quotas[region] = self.shard_share(self.max_ips if domain_max is None else domain_max + self.quota_margin)
+        logging.info(f"Region quotas: {quotas}")
+        return quotas
+
+    def warn_unmatched_regions(self, section: str, keys: typing.Iterable[str], regions: List[str]) -> List[str]:
         """
-        Filter IPs based on ping response using multithreading.
+        Warn about configured region names that match none of the candidates' regions.
 
-        :param ip_list: List of IP addresses
-        :return: List of tuples (IP, ping) for the top `max_ips` based on lowest ping
+        Such a region gets no quota, weight or domain, usually because the
+        candidates are grouped by GeoIP country while the configuration names
+        colo regions (or the other way round).
+
+        :param section: Configuration section the names come from
+        :param keys: Configured region names, lower-cased
+        :param regions: Regions of the candidates
+        :return: Configured names that match no region
+        """
+        known = {region.strip().lower() for region in regions}
+        unmatched = sorted(key for key in keys if key not in known)
+        if unmatched:
+            logging.warning(
+                f"Regions {unmatched} of {section} match none of the {len(known)} candidate regions "
+                f"(region_source = {self.region_source}); the unconfigured candidate regions fall back to the defaults."
+            )
+        return unmatched
+
+    def shard_share(self, value: int) -> int:
         """
-        def ping_ip(ip):
-            if self.force_ping_fallback or not PING_AVAILABLE:
-                # Force fallback method if configured or `ping3` is unavailable
-                return ip, self.get_ping_fallback(ip)
-            return ip, self.get_ping(ip)
+        Share of a per-region count that falls to this run's shard, rounded up.
 
-        ip_ping_results = []
-        with ThreadPoolExecutor(max_workers=20) as executor:
-            future_to_ip = {executor.submit(ping_ip, ip): ip for ip in ip_list}
+        :param value: Count for all shards together
+        :return: Count for this shard
+        """
+        return -(-value // self.shard[1])
 
-            for future in as_completed(future_to_ip):
-                try:
-                    ip, ping_time = future.result()
-                    if ping_time > 0 and ping_time <= self.max_ping:
-                        ip_ping_results.append((ip, ping_time))
-                except Exception as e:
-                    logging.error(f"Error pinging IP {future_to_ip[future]}: {e}")
+    def get_region_weights(self, regions: List[str]) -> Dict[str, float]:
+        """
+        Get the fairness weight of each region from `[cfSpeedTest.region_weights]`.
 
-        # Sort by ping time and select the top `max_ips`
-        ip_ping_results.sort(key=lambda x: x[1])
-        return ip_ping_results[:self.max_ips]
+        Region names are matched case-insensitively; unlisted regions weigh 1.
+
+        :param regions: Regions to get the weight of
+        :return: Dictionary mapping regions to weights
+        """
+        if not self.config.has_section('cfSpeedTest.region_weights'):
+            return {}
+
+        configured = {}
+        for region, weight in self.config.items('cfSpeedTest.region_weights'):
+            try:
+                configured[region.strip().lower()] = float(weight)
+                if configured[region.strip().lower()] <= 0:
+                    raise ValueError(weight)
+            except ValueError:
+                configured.pop(region.strip().lower(), None)
+                logging.warning(f"Ignoring invalid weight '{weight}' of region '{region}'")
+        self.warn_unmatched_regions('[cfSpeedTest.region_weights]', configured, regions)
+        weights = {region: configured.get(region.strip().lower(), 1.0) for region in regions}
+        logging.info(f"Region weights: {weights}")
+        return weights
 
     def run_tests(self) -> List[IPPerformanceMetrics]:
         """
         Run comprehensive IP performance tests.
 
-        :param stdscr: Curses window for display (optional)
         :return: List of successful IP performance metrics
         """
-        # Read and shuffle IPs
+        # Read IPs
         try:
-            ip_obj_list = self.read_ips(self.ip_file)
-            random.shuffle(ip_obj_list)
+            with self.metrics.stage('read_ips'):
+                candidates = self.read_ips(self.ip_file)
         except Exception as e:
             raise ValueError(f"Failed to read 'ip_list': {e}")
+        index, count = self.shard
+        if count > 1:
+            candidates = CandidateSet(candidate for candidate in candidates if shard_of(candidate.ip, count) == index)
+            logging.info(f"Testing shard {index + 1} of {count}: {len(candidates)} candidates.")
+        self.metrics.count('candidates', len(candidates))
+
+        # The colo table is loaded from disk and refreshed alongside the tests;
+        # without a local copy it is downloaded first, as regions depend on it
+        if self.colo_table.load() or self.region_source != 'colo':
+            self.colo_table.refresh_in_background()
+        else:
+            with self.metrics.stage('colo_data'):
+                self.colo_table.refresh()
 
-        ip_list = list(map(lambda x: x.get('ip'), ip_obj_list))
-
-        # download mmdb
-        # url = 'https://raw.githubusercontent.com/Loyalsoldier/geoip/release/Country.mmdb'
-        # response = requests.get(url)
-        # with open('./Country.mmdb', 'wb') as file:
-        #     file.write(response.content)
-        geoip = GeoIP2Fast()
-        update_result = geoip.update_file('geoip2fast-city-asn.dat.gz',verbose=False)
-        geo_db_path = update_result.get('file_destination')
-        geoip = GeoIP2Fast(geoip2fast_data_file=geo_db_path)
+        enricher = GeoEnricher(self.geoip_data_file, self.geoip_data_dir, self.geoip_max_age * 3600, self.geoip_cache_file)
 
         # Get map of corresponding region for each ip
         logging.info("Getting region for each IPs.")
-        ip_region_map, ip_to_asn_name_map = self.map_ips_to_regions(ip_list, geoip)
-        if not ip_region_map:
+        with self.metrics.stage('geoip'):
+            region_candidates = self.map_ips_to_regions(candidates, enricher)
+        if not region_candidates:
             raise RuntimeError("Can not get regions of IPs")
 
-        # Perform tests
-        successful_ips: List[IPPerformanceMetrics] = []
-        for region, ips in ip_region_map.items():
-            # Filter IPs by ping
-            logging.info(f"Starting ping tests to filter IPs in region {region}.")
-            filtered_ip = self.filter_ips_by_ping(ips)
-            if not filtered_ip:
-                logging.warning("No IPs passed the ping filter.")
-                continue
-
-            # Testing IPs
-            for ip, ping in filtered_ip:
-                logging.info(f"Testing IP: {ip}")
+        cache = ProbeCache(self.cache_file, self.cache_ttl_good * 3600, self.cache_ttl_dead * 3600) if self.cache_file else None
+        if self.journal_file:
+            self.journal = ResultJournal(
+                self.journal_file, self.journal_fsync_interval, self.journal_max_age * 3600, JOURNAL_VERSION
+            )
+        try:
+            cached = cache.load() if cache else {}
+            if self.region_source == 'colo':
+                region_candidates = self.apply_cached_colos(candidates, cached)
+
+            # Order each region's IPs by their past results
+            schedule_started = time.perf_counter()
+            scheduler = CandidateScheduler(cached, self.exploration_share, self.history_half_life)
+            ranked = scheduler.rank(region_candidates)
+            if self.ranking_file:
+                scheduler.export_ranking(ranked, self.ranking_file)
+                logging.info(f"Candidate ranking exported to {self.ranking_file}")
+            ranked_by_region: Dict[str, list] = {}
+            for entry in ranked:
+                ranked_by_region.setdefault(entry.candidate.region, []).append(entry)
+            region_candidates = {region: scheduler.order(entries) for region, entries in ranked_by_region.items()}
+            self.metrics.add_time('schedule', time.perf_counter() - schedule_started)
+
+            # Perform tests; traced IPs may move to any region of the colo dataset
+            regions = list(region_candidates)
+            if self.region_source == 'colo':
+                regions += sorted(self.colo_regions() - set(regions))
+            quotas = self.get_region_quotas(regions)
+            weights = self.get_region_weights(regions)
+            return self.test_candidates(region_candidates, cache, cached, quotas, weights)
+        finally:
+            if cache:
+                cache.close()
+            if self.journal:
+                self.journal.close()
+            # Give a refresh still running the chance to save the new colo data
+            self.colo_table.wait_for_refresh(self.colo_table.timeout)
+
+    def test_candidates(
+        self,
+        region_candidates: Dict[str, List[Candidate]],
+        cache: Optional[ProbeCache] = None,
+        cached: Optional[Dict[Tuple[str, int], ProbeRecord]] = None,
+        quotas: Optional[Dict[str, int]] = None,
+        weights: Optional[Dict[str, float]] = None
+    ) -> List[IPPerformanceMetrics]:
+        """
+        Test candidates that are already grouped by region and ordered.
+
+        `run_tests` reads, locates and schedules the candidates of the IP file
+        before calling this; the benchmark calls it with its own candidates.
 
+        :param region_candidates: Dictionary mapping regions to candidates in test order
+        :param cache: Probe cache results are recorded to (optional)
+        :param cached: Records loaded from the probe cache
+        :param quotas: Passing IPs needed per region (defaults to `max_ips`)
+        :param weights: Fairness weight of each region in the ping stage (defaults to 1)
+        :return: List of successful IP performance metrics
+        """
+        with self.metrics.stage('pipeline'):
+            return asyncio.run(self._run_pipeline(region_candidates, cache, cached, quotas, weights))
+
+    async def _run_pipeline(
+        self,
+        region_candidates: Dict[str, List[Candidate]],
+        cache: Optional[ProbeCache] = None,
+        cached: Optional[Dict[Tuple[str, int], ProbeRecord]] = None,
+        quotas: Optional[Dict[str, int]] = None,
+        weights: Optional[Dict[str, float]] = None
+    ) -> List[IPPerformanceMetrics]:
+        """
+        Run ping, download and upload tests as one pipeline.
+
+        Each stage has its own workers connected to the next stage by a queue,
+        and every probe holds a slot of the global connection limit while it runs.
+        A region stops feeding the ping stage once its quota of IPs passed every
+        test, or once `max_ips` of its IPs were speed-tested.
+        IPs with a fresh result in the probe cache are not probed again: recent
+        passes are reused as they are and recent failures are skipped.
+        The outcome of every IP is streamed to the result journal, if any, and
+        IPs already in the journal of an interrupted run are taken over from it.
+
+        :param region_candidates: Dictionary mapping regions to candidates in test order
+        :param cache: Probe cache results are recorded to (optional)
+        :param cached: Records loaded from the probe cache
+        :param quotas: Passing IPs needed per region (defaults to `max_ips`)
+        :param weights: Fairness weight of each region in the ping stage (defaults to 1)
+        :return: List of successful IP performance metrics
+        """
+        loop = asyncio.get_running_loop()
+        connection_slots = asyncio.Semaphore(self.concurrency)
+        download_queue: asyncio.Queue = asyncio.Queue(maxsize=self.download_concurrency * 2)
+        upload_queue: asyncio.Queue = asyncio.Queue(maxsize=self.upload_concurrency * 2)
+        work = RegionWorkQueue(region_candidates, quotas or {}, self.shard_share(self.max_ips), weights)
+        successful_ips: List[IPPerformanceMetrics] = []
+        cached = cached or {}
+        # The prober's connects count against the same global connection limit as the other probes
+        prober = LatencyProber(
+            self.ping_method, timeout=self.max_ping / 1000, samples=self.ping_samples, slots=connection_slots
+        ) if self.ping_method in ('tcp', 'icmp') else None
+        reused = skipped = resumed = 0
+        metrics = self.metrics
+        journal = self.journal
+
+        def add_result(
+            candidate: Candidate,
+            latency: LatencyStats,
+            download_speed: float,
+            upload_speed: float,
+            ttfb: int,
+            tested_at: Optional[float] = None
+        ):
+            result = IPPerformanceMetrics(
+                ip=candidate.ip,
+                region=self.colo_region(candidate.colo) or candidate.region,
+                ping=latency.ping,
+                upload_speed=upload_speed,
+                download_speed=download_speed,
+                port=candidate.port,
+                tls=candidate.tls,
+                asn=candidate.asn,
+                asn_name=candidate.asn_name,
+                ttfb=ttfb,
+                colo=candidate.colo,
+                ping_min=latency.ping_min,
+                ping_p95=latency.ping_p95,
+                jitter=latency.jitter,
+                loss=latency.loss,
+                tested_at=tested_at or time.time(),
+                vantage=self.vantage or None
+            )
+            successful_ips.append(result)
+            if journal:
+                journal.append(candidate.ip, candidate.port, True, asdict(result))
+
+        def record_failure(candidate: Candidate, *results):
+            self.failed.add((candidate.ip, csv_value(candidate.port)))
+            if journal:
+                journal.append(candidate.ip, candidate.port, False)
+            if cache:
+                cache.record_failure(candidate.ip, candidate.port, *results)
+
+        def cached_state(candidate: Candidate) -> Optional[str]:
+            record = cached.get((candidate.ip, candidate.port))
+            state = cache.freshness(record) if cache else None
+            if state == ProbeCache.GOOD and (
+                record.download_speed < self.min_download_speed or record.upload_speed < self.min_upload_speed
+            ):
+                # Passed under older thresholds: test it again
+                return None
+            return state
+
+        def count_probe(candidate: Candidate, stage: str, outcome: str):
+            metrics.count('probes', stage=stage, outcome=outcome, region=candidate.region)
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            async def probe(func, candidate: Candidate, stage: str):
+                # Every probe dials the port the candidate was listed with
+                async with connection_slots:
+                    with metrics.stage(stage):
+                        return await loop.run_in_executor(
+                            executor, partial(func, candidate.ip, candidate.port or 443, tls=candidate.tls != 'NO')
+                        )
+
+            async def trace(candidate: Candidate):
                 try:
-                    # Speed tests
-                    download_speed = self.get_download_speed(ip)
-                    if download_speed < self.min_download_speed:
-                        logging.info(f"IP {ip} download speed too low: {download_speed}")
+                    trace = await probe(self.get_trace, candidate, 'trace')
+                except Exception as e:
+                    logging.error(f"Error tracing IP {candidate.ip}: {e}")
+                    count_probe(candidate, 'trace', 'error')
+                    return
+                count_probe(candidate, 'trace', 'passed' if trace and trace.get('colo') else 'failed')
+                if trace and trace.get('colo'):
+                    candidate.colo = trace['colo']
+                    if cache:
+                        cache.record_colo(candidate.ip, candidate.port, candidate.colo)
+
+            async def ping_worker():
+                nonlocal reused, skipped, resumed
+                while (candidate := await work.get()) is not None:
+                    entry = journal.get(candidate.ip, candidate.port) if journal else None
+                    try:
+                        resumed_result = IPPerformanceMetrics(**entry['result']) if entry and entry['passed'] else None
+                    except (TypeError, KeyError) as e:
+                        logging.warning(f"Testing {candidate.ip}:{candidate.port} again, its journal entry is unreadable: {e}")
+                        entry = None
+                    if entry is not None:
+                        # Tested by the interrupted run this one resumes
+                        resumed += 1
+                        count_probe(candidate, 'journal', 'passed' if entry['passed'] else 'failed')
+                        if resumed_result is not None:
+                            work.add_passed(candidate.region)
+                            successful_ips.append(resumed_result)
+                        else:
+                            self.failed.add((candidate.ip, csv_value(candidate.port)))
                         continue
 
-                    upload_speed = self.get_upload_speed(ip)
-                    if upload_speed < self.min_upload_speed:
-                        logging.info(f"IP {ip} upload speed too low: {upload_speed}")
+                    state = cached_state(candidate)
+                    if state == ProbeCache.DEAD:
+                        # Still failing as far as the results are concerned
+                        skipped += 1
+                        count_probe(candidate, 'cache', 'skipped')
+                        self.failed.add((candidate.ip, csv_value(candidate.port)))
+                        continue
+                    if state == ProbeCache.GOOD:
+                        record = cached[(candidate.ip, candidate.port)]
+                        work.add_passed(candidate.region)
+                        reused += 1
+                        count_probe(candidate, 'cache', 'reused')
+                        latency = LatencyStats(
+                            record.ping,
+                            record.ping_min if record.ping_min is not None else record.ping,
+                            record.ping_p95 if record.ping_p95 is not None else record.ping,
+                            record.jitter or 0.0,
+                            record.loss or 0.0
+                        )
+                        add_result(
+                            candidate, latency, record.download_speed, record.upload_speed, record.ttfb, record.last_success
+                        )
                         continue
 
-                    # Save successful metrics
-                    ip_obj = list(filter(lambda x: x.get('ip') == ip, ip_obj_list))
-                    successful_ips.append(IPPerformanceMetrics(
-                        ip=ip,
-                        region=region,
-                        ping=ping,
-                        upload_speed=upload_speed,
-                        download_speed=download_speed,
-                        port=ip_obj[0].get('port') if ip_obj else None,
-                        tls=ip_obj[0].get('tls') if ip_obj else None,
-                        asn=ip_obj[0].get('asn') if ip_obj else None,
-                        asn_name=ip_to_asn_name_map.get(ip)
-                    ))
-
-                except Exception as e:
-                    logging.error(f"Unexpected error testing IP {ip}: {e}")
-
+                    try:
+                        if prober:
+                            with metrics.stage('ping'):
+                                samples = await prober.probe(candidate.ip, candidate.port)
+                        else:
+                            samples = await probe(self.sample_latency, candidate, 'ping')
+                        latency = samples.stats()
+                        outcome = 'timeout' if latency is None else 'passed' if latency.ping <= self.max_ping else 'failed'
+                    except Exception as e:
+                        logging.error(f"Error pinging IP {candidate.ip}: {e}")
+                        latency, outcome = None, 'error'
+                    count_probe(candidate, 'ping', outcome)
+                    if latency:
+                        metrics.observe('ping_ms', latency.ping, region=candidate.region)
+                        logging.debug(
+                            f"Latency of {candidate.ip}:{candidate.port}: {latency.ping} ms "
+                            f"(min {latency.ping_min} ms, p95 {latency.ping_p95} ms, "
+                            f"jitter {latency.jitter:.1f} ms, loss {latency.loss:.0%})"
+                        )
+                    if outcome != 'passed':
+                        record_failure(candidate)
+                        self.transport.release(candidate.ip)
+                    elif work.admit(candidate.region):
+                        if self.region_source == 'colo':
+                            await trace(candidate)
+                            region = self.colo_region(candidate.colo)
+                            if region and region != candidate.region:
+                                # The IP is reported under its colo's region, so it counts against that region's quota
+                                if not await work.rehome(candidate.region, region):
+                                    logging.debug(f"Skipping IP {candidate.ip}: region {region} of its colo needs no more IPs")
+                                    self.transport.release(candidate.ip)
+                                    continue
+                                candidate.region = region
+                        await download_queue.put((candidate, latency))
+                    else:
+                        # Enough IPs of this region passed or are being tested meanwhile
+                        self.transport.release(candidate.ip)
+
+            async def download_worker():
+                while (item := await download_queue.get()) is not None:
+                    candidate, latency = item
+                    ip = candidate.ip
+                    ping = latency.ping
+                    # The IP stays in flight for its region until resolved, whatever happens below
+                    passed: Optional[bool] = False
+                    try:
+                        logging.debug(f"Testing IP: {ip}")
+                        try:
+                            download = await probe(self.get_download_speed, candidate, 'download')
+                        except Exception as e:
+                            logging.error(f"Unexpected error testing IP {ip}: {e}")
+                            count_probe(candidate, 'download', 'error')
+                            record_failure(candidate, ping)
+                            continue
+                        metrics.count('bytes', download.bytes_read, direction='download')
+                        if download.ttfb >= 0:
+                            metrics.observe('ttfb_ms', download.ttfb, region=candidate.region)
+                            metrics.observe('download_mbps', download.speed, region=candidate.region)
+                        if download.speed < self.min_download_speed:
+                            count_probe(candidate, 'download', 'timeout' if download.ttfb < 0 else 'failed')
+                            logging.debug(f"IP {ip} download speed too low: {download.speed}")
+                            record_failure(candidate, ping, download.speed)
+                            continue
+                        count_probe(candidate, 'download', 'passed')
+                        await upload_queue.put((candidate, latency, download))
+                        # Resolved by the upload stage
+                        passed = None
+                    finally:
+                        if passed is not None:
+                            self.transport.release(ip)
+                            await work.resolve(candidate.region, passed)
+
+            async def upload_worker():
+                while (item := await upload_queue.get()) is not None:
+                    candidate, latency, download = item
+                    ip = candidate.ip
+                    ping = latency.ping
+                    passed = False
+                    try:
+                        try:
+                            upload_speed = await probe(partial(self.get_upload_speed, rtt=latency.ping_min), candidate, 'upload')
+                        except Exception as e:
+                            logging.error(f"Unexpected error testing IP {ip}: {e}")
+                            count_probe(candidate, 'upload', 'error')
+                            record_failure(candidate, ping, download.speed)
+                            continue
+                        if upload_speed > 0:
+                            metrics.count('bytes', self.upload_payload.size, direction='upload')
+                            metrics.observe('upload_mbps', upload_speed, region=candidate.region)
+                        if upload_speed < self.min_upload_speed:
+                            count_probe(candidate, 'upload', 'timeout' if upload_speed <= 0 else 'failed')
+                            logging.debug(f"IP {ip} upload speed too low: {upload_speed}")
+                            record_failure(candidate, ping, download.speed, upload_speed)
+                            continue
+
+                        # Save successful metrics
+                        count_probe(candidate, 'upload', 'passed')
+                        if cache:
+                            cache.record_success(
+                                ip, candidate.port, ping, download.speed, upload_speed, download.ttfb,
+                                latency.ping_min, latency.ping_p95, latency.jitter, latency.loss
+                            )
+                        add_result(candidate, latency, download.speed, upload_speed, download.ttfb)
+                        passed = True
+                    finally:
+                        self.transport.release(ip)
+                        await work.resolve(candidate.region, passed)
+
+            ping_tasks = [asyncio.create_task(ping_worker()) for _ in range(self.ping_concurrency)]
+            download_tasks = [asyncio.create_task(download_worker()) for _ in range(self.download_concurrency)]
+            upload_tasks = [asyncio.create_task(upload_worker()) for _ in range(self.upload_concurrency)]
+            workers = ping_tasks + download_tasks + upload_tasks
+
+            async def drain():
+                # Drain the stages in order, then stop their workers with one sentinel each
+                await asyncio.gather(*ping_tasks)
+                for _ in download_tasks:
+                    await download_queue.put(None)
+                await asyncio.gather(*download_tasks)
+                for _ in upload_tasks:
+                    await upload_queue.put(None)
+                await asyncio.gather(*upload_tasks)
+
+            # A worker that dies would leave the others waiting on it forever: stop them all instead
+            drained = asyncio.create_task(drain())
+            await asyncio.wait([drained, *workers], return_when=asyncio.FIRST_EXCEPTION)
+            failed = next((task for task in workers if task.done() and not task.cancelled() and task.exception()), None)
+            if failed is not None:
+                for task in [drained, *workers]:
+                    task.cancel()
+                await asyncio.gather(drained, *workers, return_exceptions=True)
+                if prober:
+                    prober.close()
+                self.transport.close()
+                raise failed.exception()
+
+        if prober:
+            prober.close()
+        if cache:
+            logging.info(f"Reused {reused} cached results and skipped {skipped} IPs that failed recently.")
+        if resumed:
+            logging.info(f"Took over {resumed} IPs tested by the interrupted run.")
+        self.transport.close()
         return successful_ips
 
     def export_results(self, results: List[IPPerformanceMetrics]) -> None:
         """
         Export test results to CSV.
 
+        With `incremental_results`, the results are merged into those of earlier runs
+        instead of replacing them. A shard of a sharded run writes its results, and
+        the IPs that failed, to its own file for `mergeShards.py` instead.
+
         :param results: List of IP performance metrics
         """
-        try:
-            with open(self.output_file, 'w', newline='') as csvfile:
-                writer = csv.writer(csvfile)
-                # Write headers
-                writer.writerow(['IP', 'Region', 'Ping (ms)', 'Upload (Mbps)', 'Download (Mbps)', 'Port', 'TLS', 'ASN', 'ASN Name'])
-
-                # Write results
-                for result in results:
-                    writer.writerow(result.to_csv_row())
+        now = time.time()
+        rows = []
+        for result in results:
+            row = dict(zip(CSV_HEADER, map(csv_value, result.to_csv_row())))
+            row[TESTED_AT_COLUMN] = format_time(result.tested_at or now)
+            rows.append(row)
 
-            logging.info(f"Results exported to {self.output_file}")
+        try:
+            if self.shard[1] > 1:
+                output_file = shard_path(self.output_file, self.shard)
+                for row in rows:
+                    row[FAILURES_COLUMN] = '0'
+                rows += [
+                    {'IP': ip, 'Port': port, 'Vantage': self.vantage, TESTED_AT_COLUMN: format_time(now), FAILURES_COLUMN: '1'}
+                    for ip, port in sorted(self.failed)
+                ]
+                write_results(output_file, CSV_HEADER, rows)
+            elif self.incremental_results:
+                output_file = self.output_file
+                merge_results(
+                    self.output_file,
+                    CSV_HEADER,
+                    rows,
+                    self.failed,
+                    self.results_half_life * 3600,
+                    self.results_max_age * 3600,
+                    self.results_max_failures,
+                    now
+                )
+            else:
+                output_file = self.output_file
+                with open(self.output_file, 'w', newline='') as csvfile:
+                    writer = csv.writer(csvfile)
+                    # Write headers
+                    writer.writerow(CSV_HEADER)
+
+                    # Write results
+                    for result in results:
+                        writer.writerow(result.to_csv_row())
+
+            logging.info(f"Results exported to {output_file}")
         except Exception as e:
             raise IOError(f"Critical error: Failed to export results: {e}")
 
@@ -508,10 +1308,20 @@ def main():
     """
     Main execution function with optional curses display.
     """
+    parser = argparse.ArgumentParser(description="Test the speed of Cloudflare IPs.")
+    parser.add_argument('--shard', help="Test only shard INDEX/COUNT of the candidates, e.g. 0/4 (overrides `shard`)")
+    parser.add_argument('--vantage', help="Name of the place the tests run from (overrides `vantage`)")
+    args = parser.parse_args()
+
+    tester = None
     try:
-        tester = CloudflareIPTester()
+        tester = CloudflareIPTester(shard=args.shard, vantage=args.vantage)
         results = tester.run_tests()
-        tester.export_results(results)
+        with tester.metrics.stage('export'):
+            tester.export_results(results)
+        # The results are safe in the output file: the next run starts over
+        if tester.journal:
+            tester.journal.discard()
         if results:
             print("\nSuccessful IPs:")
             for result in results:
@@ -521,6 +1331,9 @@ def main():
     except Exception as e:
         logging.critical(f"Critical error occurred: {e}")
         raise  # Re-raise to terminate with a stack trace
+    finally:
+        if tester:
+            tester.metrics.write()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,133 @@
+"""
+Cloudflare Colo Dataset
+
+This module keeps the list of Cloudflare data centers (colos) as a local
+CSV file, indexed by colo code once it is loaded. The file is refreshed
+with a conditional request in a background thread, so a slow or failing
+download never delays or breaks a run, and the index is reloaded once a
+refresh updated the file; the validators of the last download are kept
+next to the file.
+"""
+
+import os
+import csv
+import logging
+import threading
+from typing import Dict, Iterator, Optional
+
+import requests
+
+from atomicFile import atomic_write
+from fetchCache import FetchCache, sha256_digest
+
+COLO_DATA_URL = "https://raw.githubusercontent.com/Netrvin/cloudflare-colo-list/refs/heads/main/DC-Colos.csv"
+
+# Columns that may hold the colo code, by priority
+CODE_COLUMNS = ('colo', 'iata', 'code')
+
+
+class ColoTable:
+    """
+    Local Cloudflare colo dataset indexed by colo code.
+    """
+    def __init__(self, path: str, url: str = COLO_DATA_URL, timeout: float = 10.0):
+        """
+        Initialize the table.
+
+        :param path: Path to the local CSV file
+        :param url: URL the CSV file is refreshed from
+        :param timeout: Timeout of the refresh request in seconds
+        """
+        self.path = path
+        self.url = url
+        self.timeout = timeout
+        self.fetch_cache = FetchCache(f"{path}.fetch.json")
+        self._by_code: Dict[str, Dict[str, str]] = {}
+        self._lock = threading.Lock()
+        self._refresh_thread: Optional[threading.Thread] = None
+
+    def load(self) -> int:
+        """
+        Load the local CSV file into the index.
+
+        :return: Number of colos loaded; 0 when the file does not exist yet
+        """
+        try:
+            with open(self.path, 'r', newline='', encoding='utf-8') as file:
+                rows = list(csv.DictReader(file))
+        except OSError:
+            logging.warning(f"Cloudflare colo data not found at {self.path}; it is downloaded in the background.")
+            return 0
+
+        by_code = {}
+        for row in rows:
+            normalized = {key.strip().lower(): (value or '').strip() for key, value in row.items() if key}
+            code = next((normalized[column] for column in CODE_COLUMNS if normalized.get(column)), None)
+            if code:
+                by_code[code.upper()] = normalized
+        with self._lock:
+            self._by_code = by_code
+        logging.info(f"Loaded {len(by_code)} Cloudflare colos from {self.path}")
+        return len(by_code)
+
+    def __len__(self) -> int:
+        return len(self._by_code)
+
+    def __contains__(self, code: str) -> bool:
+        return code.upper() in self._by_code
+
+    def __iter__(self) -> Iterator[Dict[str, str]]:
+        return iter(self._by_code.values())
+
+    def get(self, code: Optional[str]) -> Optional[Dict[str, str]]:
+        """
+        Look up a colo by code.
+
+        :param code: Colo (IATA) code, e.g. `SIN`
+        :return: CSV row of the colo with lowercased column names, or None
+        """
+        return self._by_code.get(code.upper()) if code else None
+
+    def refresh(self) -> bool:
+        """
+        Download the CSV file if it changed upstream, and load it into the index.
+
+        :return: True if the local file was updated
+        """
+        if not os.path.exists(self.path):
+            self.fetch_cache.forget(self.url)
+
+        try:
+            response = requests.get(self.url, headers=self.fetch_cache.headers(self.url), timeout=self.timeout)
+            if response.status_code == 304:
+                return False
+            response.raise_for_status()
+        except requests.RequestException as e:
+            logging.warning(f"Failed to refresh Cloudflare colo data: {e}")
+            return False
+
+        digest = sha256_digest(response.content)
+        if self.fetch_cache.unchanged(self.url, digest):
+            return False
+
+        with atomic_write(self.path, 'wb') as file:
+            file.write(response.content)
+        self.fetch_cache.update(self.url, response.headers, digest)
+        self.fetch_cache.save()
+        logging.info(f"Cloudflare colo data updated at {self.path}")
+        self.load()
+        return True
+
+    def refresh_in_background(self) -> None:
+        """Start refreshing the CSV file without waiting for it."""
+        self._refresh_thread = threading.Thread(target=self.refresh, name='colo-refresh', daemon=True)
+        self._refresh_thread.start()
+
+    def wait_for_refresh(self, timeout: Optional[float] = None) -> None:
+        """
+        Wait for a background refresh to finish.
+
+        :param timeout: Seconds to wait at most
+        """
+        if self._refresh_thread is not None:
+            self._refresh_thread.join(timeout)
@@ -0,0 +1,102 @@
+"""
+Upstream Fetch Cache
+
+This module remembers the validators (ETag, Last-Modified) and the
+SHA-256 hash of the last download of every upstream source, so later
+runs can send conditional requests and tell whether a source changed
+even when the server ignores them.
+"""
+
+import json
+import hashlib
+import logging
+import threading
+from typing import Dict, Mapping, Optional
+
+from atomicFile import atomic_write
+
+
+class FetchCache:
+    """
+    JSON store of the last seen state of each upstream source.
+    """
+    def __init__(self, path: str):
+        """
+        Load the cache file if it exists.
+
+        :param path: Path to the JSON cache file
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, 'r') as file:
+                self._entries: Dict[str, Dict[str, Optional[str]]] = json.load(file)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def headers(self, key: str) -> Dict[str, str]:
+        """
+        Build the conditional request headers of a source.
+
+        :param key: Source key
+        :return: `If-None-Match` and `If-Modified-Since` headers, when known
+        """
+        with self._lock:
+            entry = self._entries.get(key, {})
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def unchanged(self, key: str, digest: str) -> bool:
+        """
+        Check whether downloaded content matches the last download.
+
+        :param key: Source key
+        :param digest: SHA-256 hex digest of the downloaded content
+        :return: True if the content is the same as last time
+        """
+        with self._lock:
+            return self._entries.get(key, {}).get('sha256') == digest
+
+    def update(self, key: str, response_headers: Mapping[str, str], digest: str) -> None:
+        """
+        Remember the state of a downloaded source.
+
+        :param key: Source key
+        :param response_headers: Headers of the response
+        :param digest: SHA-256 hex digest of the downloaded content
+        """
+        with self._lock:
+            self._entries[key] = {
+                'etag': response_headers.get('ETag'),
+                'last_modified': response_headers.get('Last-Modified'),
+                'sha256': digest
+            }
+
+    def forget(self, key: str) -> None:
+        """
+        Drop a source, so its next download is unconditional.
+
+        :param key: Source key
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def save(self) -> None:
+        """Write the cache file atomically."""
+        with self._lock, atomic_write(self.path) as file:
+            json.dump(self._entries, file, indent=2, sort_keys=True)
+        logging.debug(f"Saved the fetch cache to {self.path}")
+
+
+def sha256_digest(content: bytes) -> str:
+    """
+    Hash downloaded content.
+
+    :param content: Content bytes
+    :return: SHA-256 hex digest
+    """
+    return hashlib.sha256(content).hexdigest()
@@ -0,0 +1,167 @@
+"""
+GeoIP Enrichment
+
+This module locates candidate IPs with the GeoIP2Fast database. The data
+file is downloaded only when the local copy is older than the configured
+age, and lookups are made once per /24 (IPv4) or /48 (IPv6) prefix, in
+address order. The results are kept in a JSON file next to the candidate
+file and reused until the data file changes, so the database is only
+loaded when a prefix is new.
+"""
+
+import os
+import json
+import time
+import logging
+import ipaddress
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from geoip2fast import GeoIP2Fast
+
+from atomicFile import atomic_write
+from candidateStore import Candidate
+
+# Prefix lengths sharing one lookup
+IPV4_PREFIX = 24
+IPV6_PREFIX = 48
+
+# Country code, country name and ASN name of a prefix, or None when not found
+GeoResult = Optional[Tuple[str, str, str]]
+
+
+def network_of(ip: str) -> Optional[ipaddress._BaseNetwork]:
+    """
+    Get the lookup prefix of an IP address.
+
+    :param ip: IPv4 or IPv6 address
+    :return: /24 or /48 network, or None if the address is not valid
+    """
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return None
+    length = IPV4_PREFIX if address.version == 4 else IPV6_PREFIX
+    return ipaddress.ip_network((address, length), strict=False)
+
+
+class GeoEnricher:
+    """
+    Sets the region and ASN name of candidates from a cached GeoIP lookup.
+    """
+    def __init__(self, data_file: str, data_dir: str, max_age: float, cache_path: str):
+        """
+        Initialize the enricher.
+
+        :param data_file: Name of the GeoIP2Fast data file (e.g., `geoip2fast-city-asn.dat.gz`)
+        :param data_dir: Directory keeping the downloaded data file
+        :param max_age: Seconds after which the data file is downloaded again
+        :param cache_path: Path of the JSON file keeping the lookup results per prefix
+        """
+        self.data_file = data_file
+        self.data_dir = data_dir
+        self.max_age = max_age
+        self.cache_path = cache_path
+        self.geoip: Optional[GeoIP2Fast] = None
+        self.data_path: Optional[str] = None
+        self.database = ''
+
+    def _data_path(self) -> Optional[str]:
+        """Path of a fresh data file, downloading it when missing or stale."""
+        path = os.path.join(self.data_dir, self.data_file)
+        if os.path.exists(path) and time.time() - os.path.getmtime(path) < self.max_age:
+            logging.info(f"Reusing GeoIP data file {path}")
+            return path
+
+        os.makedirs(self.data_dir, exist_ok=True)
+        result = GeoIP2Fast().update_file(self.data_file, destination=os.path.join(self.data_dir, ''), verbose=False)
+        if result.get('error'):
+            logging.warning(f"Failed to update the GeoIP data file: {result['error']}")
+            return path if os.path.exists(path) else None
+        return result.get('file_destination') or path
+
+    def prepare(self) -> None:
+        """Pick the data file, falling back to the bundled country database, without loading it yet."""
+        self.data_path = self._data_path()
+        if self.data_path is None:
+            logging.warning("Using the bundled GeoIP country database.")
+            self.database = 'bundled'
+        else:
+            stat = os.stat(self.data_path)
+            self.database = f"{os.path.basename(self.data_path)}:{stat.st_size}:{int(stat.st_mtime)}"
+
+    def load(self) -> None:
+        """Load the GeoIP database; it is only needed when a prefix is not cached."""
+        if not self.database:
+            self.prepare()
+        self.geoip = GeoIP2Fast(geoip2fast_data_file=self.data_path or '')
+
+    def _load_cache(self) -> Dict[str, GeoResult]:
+        """Load the cached lookups, unless they were made with another database."""
+        try:
+            with open(self.cache_path, 'r') as file:
+                cache = json.load(file)
+        except (OSError, ValueError):
+            return {}
+        if cache.get('database') != self.database:
+            return {}
+        return {prefix: tuple(result) if result else None for prefix, result in cache.get('prefixes', {}).items()}
+
+    def _save_cache(self, prefixes: Dict[str, GeoResult]) -> None:
+        """Write the cached lookups atomically."""
+        # Shards run as local processes share the cache
+        with atomic_write(self.cache_path) as file:
+            json.dump({'database': self.database, 'prefixes': prefixes}, file, indent=0, sort_keys=True)
+
+    def lookup(self, ip: str) -> GeoResult:
+        """
+        Look up one IP address in the database.
+
+        :param ip: IP address
+        :return: Country code, country name and ASN name, or None if not found
+        """
+        if self.geoip is None:
+            self.load()
+        geo_data = self.geoip.lookup(ip)
+        if not geo_data or not geo_data.country_code:
+            return None
+        return geo_data.country_code, geo_data.country_name, geo_data.asn_name
+
+    def enrich(self, candidates: Iterable[Candidate]) -> int:
+        """
+        Set the region (country name) and ASN name of the candidates.
+
+        :param candidates: Candidates to locate
+        :return: Number of candidates located
+        """
+        if not self.database:
+            self.prepare()
+
+        by_network: Dict[ipaddress._BaseNetwork, List[Candidate]] = {}
+        for candidate in candidates:
+            network = network_of(candidate.ip)
+            if network is not None:
+                by_network.setdefault(network, []).append(candidate)
+
+        cached = self._load_cache()
+        prefixes: Dict[str, GeoResult] = {}
+        looked_up = 0
+        # Sorted lookups walk the database's range index in order
+        for network in sorted(by_network, key=lambda network: (network.version, int(network.network_address))):
+            key = str(network)
+            if key in cached:
+                result = cached[key]
+            else:
+                result = self.lookup(by_network[network][0].ip)
+                looked_up += 1
+            prefixes[key] = result
+            if result is None:
+                continue
+            _, region, asn_name = result
+            for candidate in by_network[network]:
+                candidate.region = region
+                candidate.asn_name = asn_name
+
+        self._save_cache(prefixes)
+        located = sum(len(by_network[network]) for network in by_network if prefixes[str(network)])
+        logging.info(f"Located {located} IPs in {len(prefixes)} prefixes ({looked_up} looked up, {len(prefixes) - looked_up} cached).")
+        return located
@@ -1,193 +1,217 @@
-import requests
-import zipfile
-import io
-import fnmatch
-import configparser
+import os
 import json
-import re
-
-countries = {
-    "ID": "Indonesia",
-    "SG": "Singapore",
-    "JP": "Japan",
-    "AT": "Austria",
-    "US": "United States",
-    "MY": "Malaysia",
-    "CA": "Canada",
-    "GB": "United Kingdom",
-    "IN": "India",
-    "IR": "Iran",
-    "AE": "United Arab Emirates",
-    "FI": "Finland",
-    "TR": "Turkey",
-    "MD": "Moldova",
-    "TW": "Taiwan",
-    "CH": "Switzerland",
-    "SE": "Sweden",
-    "NL": "Netherlands",
-    "ES": "Spain",
-    "RU": "Russia",
-    "RO": "Romania",
-    "PL": "Poland",
-    "MX": "Mexico",
-    "AL": "Albania",
-    "IT": "Italy",
-    "DE": "Germany",
-    "NZ": "New Zealand",
-    "FR": "France",
-    "AM": "Armenia",
-    "CY": "Cyprus",
-    "DK": "Denmark",
-    "BR": "Brazil",
-    "KR": "South Korea",
-    "VN": "Vietnam",
-    "TH": "Thailand",
-    "HK": "Hong Kong",
-    "CN": "China",
-    "AU": "Australia",
-    "AR": "Argentina",
-    "BE": "Belgium",
-    "BG": "Bulgaria",
-    "AZ": "Azerbaijan",
-    "CO": "Colombia",
-    "CZ": "Czech Republic",
-    "EE": "Estonia",
-    "GI": "Gibraltar",
-    "IE": "Ireland",
-    "HU": "Hungary",
-    "IL": "Israel",
-    "KZ": "Kazakhstan",
-    "LT": "Lithuania",
-    "LU": "Luxembourg",
-    "LV": "Latvia",
-    "PH": "Philippines",
-    "PT": "Portugal",
-    "PR": "Puerto Rico",
-    "QA": "Qatar",
-    "RS": "Serbia",
-    "SC": "Seychelles",
-    "SA": "Saudi Arabia",
-    "SK": "Slovakia",
-    "UA": "Ukraine",
-    "UZ": "Uzbekistan",
-    "T1": "Unknown"
-}
-tls_ports = {
-    443,
-    2053,
-    2083,
-    2087,
-    2096,
-    8443
-}
-nontls_ports = {
-    80,
-    2052,
-    2082,
-    2086,
-    2095,
-    8080
-}
-added_ips = set()
-
-def download_zip_file(url):
-    """Download the ZIP file from the specified URL."""
-    try:
-        response = requests.get(url)
+import time
+import hashlib
+import argparse
+import configparser
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from candidateStore import CandidateMerger, read_candidates, write_candidates
+from fetchCache import FetchCache
+from ipSources import load_feeds, parse_feed
+from runMetrics import RunMetrics
+
+def create_session(retries=3, pool_size=16):
+    """Create a pooled session that retries failed requests with exponential backoff."""
+    retry = Retry(
+        total=retries,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=('GET',)
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def feed_cache_path(cache_dir, feed):
+    """Path of the candidate file caching the IPs of a feed."""
+    return os.path.join(cache_dir, f"{feed.name}.bin")
+
+def fetch_feed(session, feed, fetch_cache, download_dir, timeout=None, chunk_size=256*1024, metrics=None):
+    """
+    Fetch a feed from its URL or local path.
+
+    Returns the path of the fetched content, or None when the feed did not
+    change since the fetch recorded in `fetch_cache`. Downloaded bytes and
+    request times are added to `metrics` when given.
+    """
+    metrics = metrics or RunMetrics('getIPs')
+    digest = hashlib.sha256()
+    if not feed.url.startswith(('http://', 'https://')):
+        with open(feed.url, 'rb') as file:
+            for chunk in iter(lambda: file.read(chunk_size), b''):
+                digest.update(chunk)
+        if fetch_cache.unchanged(feed.cache_key, digest.hexdigest()):
+            return None
+        fetch_cache.update(feed.cache_key, {}, digest.hexdigest())
+        return feed.url
+
+    download_path = os.path.join(download_dir, f"{feed.name}.download")
+    headers = fetch_cache.headers(feed.cache_key)
+    started = time.perf_counter()
+    size = 0
+    with session.get(feed.url, timeout=timeout, stream=True, headers=headers) as response:
+        if response.status_code == 304:
+            metrics.observe('request_ms', (time.perf_counter() - started) * 1000, source=feed.source)
+            return None
         response.raise_for_status()
-        return io.BytesIO(response.content)
-    except requests.exceptions.RequestException as e:
-        raise SystemExit(f"Error during file download: {e}")
-
-def extract_and_combine_files(zip_file, file_pattern):
-    """Extract and combine content of files matching the pattern."""
-    global added_ips
-    matching_files = fnmatch.filter(zip_file.namelist(), file_pattern)
-    if not matching_files:
-        raise FileNotFoundError(f"No files matching {file_pattern} found in the ZIP archive.")
-
-    combined_content = []
-    for file_name in matching_files:
-        pattern = r"(\d+)-([0-1])-(\d+)\.txt"
-        match = re.match(pattern, file_name)
-        asn, tls, port = match.groups()
-        with zip_file.open(file_name) as file:
-            lines = file.read().decode('utf-8').splitlines()
-            for line in lines:
-                ip = line.strip()
-                if ip and ip not in added_ips:
-                    combined_content.append({'ip': ip, 'asn': asn, 'tls': 'YES' if tls == '1' else 'NO', 'port': int(port)})
-                    added_ips.add(ip)
-
-    return combined_content
-
-def save_to_file(content, output_file):
-    """Save the combined content to a file."""
-    with open(output_file, 'w') as file:
-        file.write(content)
-    print(f"Combined content saved to: {output_file}")
-
-def get_country_based_ips():
-    global added_ips
-    location_ips_data = []
-    base_url = 'https://cfip.ashrvpn.v6.army/?country='
-    for con in countries:
-        try:
-            response = requests.get(base_url + con)
-            response.raise_for_status()
-            if response.text:
-                for line in response.text.split('\n'):
-                    ip, port = line.split('|')[0].strip().split(':')
-                    if ip not in added_ips:
-                        location_ips_data.append({
-                            'ip': ip,
-                            'port': int(port),
-                            'country': con
-                        })
-                        added_ips.add(ip)
-        except requests.exceptions.RequestException as e:
-            raise SystemExit(f"Error during access to {base_url+con}: {e}")
-        except Exception as e:
-            print(f"Error during parsing '{base_url+con}' content: {e}")
-    return location_ips_data
-
-def process_zip_file(url, file_pattern, output_file):
-    """Main function to download, process, and save the combined content."""
-    print(f"Downloading ZIP file from: {url}")
-    zip_data = download_zip_file(url)
-    country_based_ips_data = get_country_based_ips()
-
-    with zipfile.ZipFile(zip_data) as zip_file:
-        print("Extracting and combining files...")
-        combined_content = extract_and_combine_files(zip_file, file_pattern)
-        for item in country_based_ips_data:
-            combined_content.append({
-                'ip': item.get('ip'),
-                'asn': None,
-                'tls': 'YES' if item.get('port') in tls_ports else 'NO' if item.get('port') in nontls_ports else 'Unknown',
-                'port': item.get('port'),
-            })
-        print("Saving combined content to file...")
-        save_to_file(json.dumps(combined_content, indent=2), output_file)
+        with open(download_path, 'wb') as file:
+            for chunk in response.iter_content(chunk_size):
+                file.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+    elapsed = time.perf_counter() - started
+    metrics.add_time('download', elapsed)
+    metrics.observe('request_ms', elapsed * 1000, source=feed.source)
+    metrics.count('bytes', size, direction='download', source=feed.source)
+
+    if fetch_cache.unchanged(feed.cache_key, digest.hexdigest()):
+        os.remove(download_path)
+        return None
+    fetch_cache.update(feed.cache_key, response.headers, digest.hexdigest())
+    return download_path
+
+def update_feeds(feeds, session, fetch_cache, cache_dir, timeout=None, workers=16, parse_workers=None, metrics=None):
+    """
+    Fetch the feeds concurrently and parse the changed ones in a process pool.
+
+    A feed that fails keeps its previously cached IPs, or is dropped if it has none.
+    The outcome of every feed is counted in `metrics` when given.
+
+    :return: Number of feeds whose cached IPs were rewritten
+    """
+    metrics = metrics or RunMetrics('getIPs')
+    download_dir = os.path.join(cache_dir, 'downloads')
+    os.makedirs(download_dir, exist_ok=True)
+    for feed in feeds:
+        # Without cached IPs to fall back to, the feed must be fetched in full
+        if not os.path.exists(feed_cache_path(cache_dir, feed)):
+            fetch_cache.forget(feed.cache_key)
+
+    changed = 0
+    with ThreadPoolExecutor(max_workers=workers) as fetchers, ProcessPoolExecutor(max_workers=parse_workers) as parsers:
+        fetches = {fetchers.submit(fetch_feed, session, feed, fetch_cache, download_dir, timeout, metrics=metrics): feed for feed in feeds}
+        parses = {}
+        # Feeds are parsed as soon as they are fetched, while other feeds are still downloading
+        for future in as_completed(fetches):
+            feed = fetches[future]
+            try:
+                path = future.result()
+            except (requests.exceptions.RequestException, OSError) as e:
+                print(f"Error during access to {feed.url}: {e}")
+                metrics.count('feeds', outcome='fetch_failed', source=feed.source)
+                fetch_cache.forget(feed.cache_key)
+                continue
+            if path is None:
+                metrics.count('feeds', outcome='unchanged', source=feed.source)
+            else:
+                parses[parsers.submit(parse_feed, feed.parser, path, feed.options, feed_cache_path(cache_dir, feed))] = (feed, path)
+
+        for future in as_completed(parses):
+            feed, path = parses[future]
+            try:
+                parsed = future.result()
+                print(f"Parsed {parsed} IPs from {feed.url}")
+                metrics.count('feeds', outcome='parsed', source=feed.source)
+                metrics.count('candidates', parsed, source=feed.source)
+                changed += 1
+            except Exception as e:
+                print(f"Error during parsing '{feed.url}' content: {e}")
+                metrics.count('feeds', outcome='parse_failed', source=feed.source)
+                fetch_cache.forget(feed.cache_key)
+            finally:
+                if path.startswith(download_dir):
+                    os.remove(path)
+    return changed
+
+def merge_feeds(feeds, cache_dir, output_file):
+    """
+    Merge the cached IPs of every feed into the output file.
+
+    Candidates are deduplicated on IP and port; a duplicate fills in the ASN, TLS
+    flag and country still unknown from the sources before it, in configuration
+    order, and adds its source to the record.
+    """
+    merger = CandidateMerger()
+    for feed in feeds:
+        cache_path = feed_cache_path(cache_dir, feed)
+        if not os.path.exists(cache_path):
+            continue
+        for candidate in read_candidates(cache_path):
+            try:
+                merger.add(candidate, feed.source)
+            except ValueError as e:
+                print(f"Skipping a candidate of {feed.url}: {e}")
+
+    count = write_candidates(output_file, merger)
+    print(f"Combined content ({count} IPs) saved to: {output_file}")
+    return count
+
+def collect_ips(feeds, output_file, timeout=10, retries=3, workers=16, parse_workers=None, cache_dir='.cache/getIPs', metrics=None):
+    """Main function to fetch, parse, and merge the IPs of every feed."""
+    metrics = metrics or RunMetrics('getIPs')
+    os.makedirs(cache_dir, exist_ok=True)
+    session = create_session(retries, workers)
+    fetch_cache = FetchCache(os.path.join(cache_dir, 'fetch-cache.json'))
+
+    print(f"Fetching {len(feeds)} feeds...")
+    with metrics.stage('fetch'):
+        changed = update_feeds(feeds, session, fetch_cache, cache_dir, timeout, workers, parse_workers, metrics)
+
+    # The feeds of the last merge; adding or removing a source also needs a new merge
+    manifest_path = os.path.join(cache_dir, 'merged.json')
+    manifest = {'output_file': output_file, 'feeds': [feed.cache_key for feed in feeds]}
+    try:
+        with open(manifest_path, 'r') as file:
+            unchanged_feeds = json.load(file) == manifest
+    except (OSError, ValueError):
+        unchanged_feeds = False
+
+    if not changed and unchanged_feeds and os.path.exists(output_file):
+        print(f"No upstream changes, keeping {output_file}")
+    else:
+        print(f"{changed} feeds changed, merging...")
+        with metrics.stage('merge'):
+            metrics.count('candidates_merged', merge_feeds(feeds, cache_dir, output_file))
+        with open(manifest_path, 'w') as file:
+            json.dump(manifest, file)
+    # Saved last, so an interrupted run never marks a feed as unchanged without its cached IPs
+    fetch_cache.save()
 
 def load_config(config_file):
     """Load configuration from a file."""
     config = configparser.ConfigParser()
     config.read(config_file)
-    return config['getIPs']
+    return config
 
 # Usage example
 if __name__ == "__main__":
-    config_file = "config.ini"  # Path to your config file
+    parser = argparse.ArgumentParser(description="Collect candidate IPs from the configured sources.")
+    parser.add_argument('--config', default="config.ini", help="Path to the config file")
+    args = parser.parse_args()
 
+    metrics = None
     try:
         # Load configuration
-        config = load_config(config_file)
-        url = config.get('url')
-        file_pattern = config.get('file_pattern')
+        full_config = load_config(args.config)
+        metrics = RunMetrics.from_config(full_config, 'getIPs')
+        feeds = load_feeds(full_config)
+        config = full_config['getIPs']
         output_file = config.get('output_file')
+        timeout = config.getfloat('timeout', 10)
+        retries = config.getint('retries', 3)
+        workers = config.getint('workers', 16)
+        parse_workers = config.getint('parse_workers', os.cpu_count() or 1)
+        cache_dir = config.get('cache_dir', '.cache/getIPs')
 
-        # Process the ZIP file
-        process_zip_file(url, file_pattern, output_file)
+        # Fetch, parse and merge the sources
+        collect_ips(feeds, output_file, timeout, retries, workers, parse_workers, cache_dir, metrics)
     except Exception as e:
         print(e)
+    finally:
+        if metrics:
+            metrics.write()
@@ -0,0 +1,300 @@
+"""
+Candidate IP Sources
+
+This module declares the upstream sources of candidate IPs. A source is
+configured in a `[getIPs.source.<name>]` section of `config.ini` and
+expands into one or more feeds; each feed is fetched (over HTTP or from a
+local file) and then parsed into a candidate shard by one of the parsers
+below. Parsers are plain module-level functions, so they can run in a
+process pool.
+
+Source types:
+
+    zip           ZIP archive of `<asn>-<tls>-<port>.txt` files with one IP per line
+    country_list  One `ip:port|...` list per country, `url` containing `{country}`
+    file          A single list in the given `format` (`ip_port`, `ip` or `candidates`)
+"""
+
+import io
+import re
+import json
+import fnmatch
+import hashlib
+import zipfile
+import configparser
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterator, List, Optional
+
+from candidateStore import Candidate, read_candidates, write_candidates
+
+SECTION_PREFIX = 'getIPs.source.'
+
+countries = {
+    "ID": "Indonesia",
+    "SG": "Singapore",
+    "JP": "Japan",
+    "AT": "Austria",
+    "US": "United States",
+    "MY": "Malaysia",
+    "CA": "Canada",
+    "GB": "United Kingdom",
+    "IN": "India",
+    "IR": "Iran",
+    "AE": "United Arab Emirates",
+    "FI": "Finland",
+    "TR": "Turkey",
+    "MD": "Moldova",
+    "TW": "Taiwan",
+    "CH": "Switzerland",
+    "SE": "Sweden",
+    "NL": "Netherlands",
+    "ES": "Spain",
+    "RU": "Russia",
+    "RO": "Romania",
+    "PL": "Poland",
+    "MX": "Mexico",
+    "AL": "Albania",
+    "IT": "Italy",
+    "DE": "Germany",
+    "NZ": "New Zealand",
+    "FR": "France",
+    "AM": "Armenia",
+    "CY": "Cyprus",
+    "DK": "Denmark",
+    "BR": "Brazil",
+    "KR": "South Korea",
+    "VN": "Vietnam",
+    "TH": "Thailand",
+    "HK": "Hong Kong",
+    "CN": "China",
+    "AU": "Australia",
+    "AR": "Argentina",
+    "BE": "Belgium",
+    "BG": "Bulgaria",
+    "AZ": "Azerbaijan",
+    "CO": "Colombia",
+    "CZ": "Czech Republic",
+    "EE": "Estonia",
+    "GI": "Gibraltar",
+    "IE": "Ireland",
+    "HU": "Hungary",
+    "IL": "Israel",
+    "KZ": "Kazakhstan",
+    "LT": "Lithuania",
+    "LU": "Luxembourg",
+    "LV": "Latvia",
+    "PH": "Philippines",
+    "PT": "Portugal",
+    "PR": "Puerto Rico",
+    "QA": "Qatar",
+    "RS": "Serbia",
+    "SC": "Seychelles",
+    "SA": "Saudi Arabia",
+    "SK": "Slovakia",
+    "UA": "Ukraine",
+    "UZ": "Uzbekistan",
+    "T1": "Unknown"
+}
+tls_ports = {
+    443,
+    2053,
+    2083,
+    2087,
+    2096,
+    8443
+}
+nontls_ports = {
+    80,
+    2052,
+    2082,
+    2086,
+    2095,
+    8080
+}
+
+
+def tls_of_port(port: Optional[int]) -> str:
+    """Guess whether a port speaks TLS from the ports Cloudflare proxies."""
+    return 'YES' if port in tls_ports else 'NO' if port in nontls_ports else 'Unknown'
+
+
+@dataclass(frozen=True)
+class Feed:
+    """
+    Data class to store one fetch and parse unit of a source.
+    """
+    name: str
+    source: str
+    url: str
+    parser: str
+    options: Dict[str, str] = field(default_factory=dict, hash=False)
+
+    @property
+    def cache_key(self) -> str:
+        """Fetch cache key; it changes with the URL, parser or options, so their shard is rebuilt."""
+        signature = json.dumps([self.url, self.parser, self.options], sort_keys=True)
+        return f"{self.name}:{hashlib.sha256(signature.encode()).hexdigest()[:12]}"
+
+
+def parse_archive(path: str, options: Dict[str, str]) -> Iterator[Candidate]:
+    """
+    Parse a ZIP archive of `<asn>-<tls>-<port>.txt` files.
+
+    :param path: Path to the archive
+    :param options: `file_pattern` selecting the archive members
+    :return: Iterator of candidates; duplicates are merged later
+    """
+    file_pattern = options.get('file_pattern', '*.txt')
+    with zipfile.ZipFile(path) as zip_file:
+        matching_files = fnmatch.filter(zip_file.namelist(), file_pattern)
+        if not matching_files:
+            raise FileNotFoundError(f"No files matching {file_pattern} found in the ZIP archive.")
+
+        for file_name in matching_files:
+            match = re.match(r"(\d+)-([0-1])-(\d+)\.txt", file_name)
+            if not match:
+                continue
+            asn, tls, port = match.groups()
+            with zip_file.open(file_name) as file:
+                for line in io.TextIOWrapper(file, encoding='utf-8'):
+                    ip = line.strip()
+                    if ip:
+                        yield Candidate(ip=ip, port=int(port), tls='YES' if tls == '1' else 'NO', asn=asn)
+
+
+def parse_ip_port_lines(path: str, options: Dict[str, str]) -> Iterator[Candidate]:
+    """
+    Parse `ip:port|...` lines.
+
+    :param path: Path to the list
+    :param options: `country` of the listed IPs (optional)
+    :return: Iterator of candidates
+    """
+    country = options.get('country')
+    with open(path, 'r', encoding='utf-8', errors='replace') as file:
+        for line in file:
+            address = line.split('|')[0].strip()
+            if not address:
+                continue
+            try:
+                ip, port = address.rsplit(':', 1)
+                port = int(port)
+            except ValueError:
+                print(f"Skipping malformed line in '{path}': {line.rstrip()!r}")
+                continue
+            yield Candidate(ip=ip, port=port, tls=tls_of_port(port), asn=None, country=country)
+
+
+def parse_ip_lines(path: str, options: Dict[str, str]) -> Iterator[Candidate]:
+    """
+    Parse lines holding one IP each.
+
+    :param path: Path to the list
+    :param options: `port`, `asn` and `country` shared by the listed IPs (optional)
+    :return: Iterator of candidates
+    """
+    port = int(options.get('port', 443))
+    with open(path, 'r', encoding='utf-8', errors='replace') as file:
+        for line in file:
+            ip = line.strip()
+            if ip and not ip.startswith('#'):
+                yield Candidate(
+                    ip=ip,
+                    port=port,
+                    tls=tls_of_port(port),
+                    asn=options.get('asn'),
+                    country=options.get('country')
+                )
+
+
+def parse_candidate_file(path: str, options: Dict[str, str]) -> Iterator[Candidate]:
+    """
+    Parse a binary or JSON candidate file.
+
+    :param path: Path to the candidate file
+    :param options: Unused
+    :return: Iterator of candidates
+    """
+    yield from read_candidates(path)
+
+
+PARSERS: Dict[str, Callable[[str, Dict[str, str]], Iterator[Candidate]]] = {
+    'archive': parse_archive,
+    'ip_port': parse_ip_port_lines,
+    'ip': parse_ip_lines,
+    'candidates': parse_candidate_file
+}
+
+
+def parse_feed(parser: str, path: str, options: Dict[str, str], shard_path: str) -> int:
+    """
+    Parse a fetched feed into a candidate shard; runs in a worker process.
+
+    :param parser: Name of the parser in `PARSERS`
+    :param path: Path to the fetched content
+    :param options: Parser options
+    :param shard_path: Path of the candidate shard to write
+    :return: Number of candidates written
+    """
+    return write_candidates(shard_path, PARSERS[parser](path, options))
+
+
+def zip_source(name: str, options: Dict[str, str]) -> List[Feed]:
+    """Feeds of a `zip` source."""
+    return [Feed(name, name, options['url'], 'archive', {'file_pattern': options.get('file_pattern', '*.txt')})]
+
+
+def country_list_source(name: str, options: Dict[str, str]) -> List[Feed]:
+    """Feeds of a `country_list` source, one per country."""
+    codes = [code.strip().upper() for code in options.get('countries', '').split(',') if code.strip()]
+    return [
+        Feed(f"{name}-{code}", name, options['url'].format(country=code), 'ip_port', {'country': code})
+        for code in codes or countries
+    ]
+
+
+def file_source(name: str, options: Dict[str, str]) -> List[Feed]:
+    """Feeds of a `file` source."""
+    parser = options.get('format', 'ip_port')
+    if parser not in PARSERS:
+        raise ValueError(f"Unknown format '{parser}' of source '{name}'")
+    parser_options = {key: options[key] for key in ('port', 'asn', 'country', 'file_pattern') if key in options}
+    return [Feed(name, name, options.get('url') or options['path'], parser, parser_options)]
+
+
+SOURCE_TYPES: Dict[str, Callable[[str, Dict[str, str]], List[Feed]]] = {
+    'zip': zip_source,
+    'country_list': country_list_source,
+    'file': file_source
+}
+
+
+def load_feeds(config: configparser.ConfigParser) -> List[Feed]:
+    """
+    Load the feeds of every `[getIPs.source.<name>]` section, in file order.
+
+    Without source sections, the legacy `url` and `file_pattern` settings of
+    `[getIPs]` are used together with the per-country lists.
+
+    :param config: Parsed configuration
+    :return: Feeds in merge order; earlier sources take precedence
+    """
+    sections = [section for section in config.sections() if section.startswith(SECTION_PREFIX)]
+    if not sections:
+        legacy = config['getIPs']
+        return (
+            country_list_source('ashrvpn', {'url': 'https://cfip.ashrvpn.v6.army/?country={country}'})
+            + zip_source('baipiao', {'url': legacy.get('url'), 'file_pattern': legacy.get('file_pattern', '*.txt')})
+        )
+
+    feeds = []
+    for section in sections:
+        name = section[len(SECTION_PREFIX):]
+        if not config[section].getboolean('enabled', True):
+            continue
+        options = {key: value for key, value in config[section].items() if key not in ('type', 'enabled')}
+        source_type = config[section].get('type')
+        if source_type not in SOURCE_TYPES:
+            raise ValueError(f"Unknown type '{source_type}' of source '{name}'")
+        feeds.extend(SOURCE_TYPES[source_type](name, options))
+    return feeds
@@ -0,0 +1,301 @@
+"""
+Batch Latency Prober
+
+This module measures the round-trip time of many IP:port pairs from one
+asyncio event loop, without a thread or a TLS handshake per IP. Each IP
+is sampled several times, either with a TCP connect to its port or with
+an ICMP echo where the system allows unprivileged ICMP sockets. ICMP
+replies of all IPs arrive on one socket and are matched to their request
+by source address and sequence number.
+"""
+
+import os
+import time
+import math
+import errno
+import socket
+import struct
+import asyncio
+import logging
+import statistics
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+ICMPV6_ECHO_REQUEST = 128
+ICMPV6_ECHO_REPLY = 129
+
+
+@dataclass(slots=True)
+class LatencyStats:
+    """
+    Data class to store the latency summary of an IP, in whole milliseconds.
+    """
+    ping: int
+    ping_min: int
+    ping_p95: int
+    jitter: float
+    loss: float
+
+
+@dataclass(slots=True)
+class LatencyResult:
+    """
+    Data class to store the round-trip time samples of an IP:port.
+    """
+    ip: str
+    port: int
+    samples: List[Optional[float]] = field(default_factory=list)
+
+    @property
+    def received(self) -> List[float]:
+        """Round-trip times in milliseconds of the samples that got a reply."""
+        return [sample for sample in self.samples if sample is not None]
+
+    @property
+    def min(self) -> Optional[float]:
+        """Lowest round-trip time in milliseconds."""
+        return min(self.received, default=None)
+
+    @property
+    def median(self) -> Optional[float]:
+        """Median round-trip time in milliseconds."""
+        received = self.received
+        return statistics.median(received) if received else None
+
+    def percentile(self, percent: float) -> Optional[float]:
+        """
+        Nearest-rank percentile of the round-trip times in milliseconds.
+
+        :param percent: Percentile between 0 and 100
+        :return: Round-trip time, or None without replies
+        """
+        received = sorted(self.received)
+        if not received:
+            return None
+        rank = max(math.ceil(percent / 100 * len(received)), 1)
+        return received[rank - 1]
+
+    @property
+    def jitter(self) -> Optional[float]:
+        """Mean difference between consecutive round-trip times in milliseconds."""
+        received = self.received
+        if len(received) < 2:
+            return 0.0 if received else None
+        return statistics.fmean(abs(b - a) for a, b in zip(received, received[1:]))
+
+    @property
+    def loss(self) -> float:
+        """Share of samples without a reply."""
+        return 1 - len(self.received) / len(self.samples) if self.samples else 1.0
+
+    def stats(self) -> Optional[LatencyStats]:
+        """
+        Summarize the samples.
+
+        :return: Median (as the ping), minimum, 95th percentile, jitter and loss, or None without replies
+        """
+        if not self.received:
+            return None
+        return LatencyStats(
+            ping=max(round(self.median), 1),
+            ping_min=max(round(self.min), 1),
+            ping_p95=max(round(self.percentile(95)), 1),
+            jitter=round(self.jitter, 1),
+            loss=round(self.loss, 3)
+        )
+
+
+def icmp_checksum(data: bytes) -> int:
+    """Internet checksum of an ICMP message."""
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+class IcmpEcho:
+    """
+    Unprivileged ICMP echo sockets shared by every probe of an event loop.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        """
+        Open the ICMP sockets.
+
+        :param loop: Event loop the replies are read on
+        :raises OSError: If unprivileged ICMP sockets are not permitted
+        """
+        self.loop = loop
+        self._sequence = 0
+        self._pending: Dict[Tuple[str, int], asyncio.Future] = {}
+        self._sockets: Dict[int, socket.socket] = {}
+        for family, protocol in ((socket.AF_INET, socket.IPPROTO_ICMP), (socket.AF_INET6, socket.IPPROTO_ICMPV6)):
+            try:
+                sock = socket.socket(family, socket.SOCK_DGRAM, protocol)
+            except OSError:
+                if family == socket.AF_INET:
+                    raise
+                continue
+            sock.setblocking(False)
+            loop.add_reader(sock.fileno(), self._receive, sock, family)
+            self._sockets[family] = sock
+
+    def _receive(self, sock: socket.socket, family: int) -> None:
+        """Resolve the request matching each reply read from a socket."""
+        while True:
+            try:
+                data, address = sock.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logging.debug(f"ICMP receive failed: {e}")
+                return
+            reply_type = ICMP_ECHO_REPLY if family == socket.AF_INET else ICMPV6_ECHO_REPLY
+            if len(data) < 8 or data[0] != reply_type:
+                continue
+            sequence = struct.unpack('!H', data[6:8])[0]
+            future = self._pending.pop((address[0], sequence), None)
+            if future is not None and not future.done():
+                future.set_result(time.perf_counter())
+
+    async def ping(self, ip: str, timeout: float) -> Optional[float]:
+        """
+        Send one echo request.
+
+        :param ip: IP address
+        :param timeout: Seconds to wait for the reply
+        :return: Round-trip time in milliseconds, or None without a reply
+        """
+        family = socket.AF_INET6 if ':' in ip else socket.AF_INET
+        sock = self._sockets.get(family)
+        if sock is None:
+            return None
+
+        self._sequence = (self._sequence + 1) & 0xFFFF
+        sequence = self._sequence
+        request_type = ICMP_ECHO_REQUEST if family == socket.AF_INET else ICMPV6_ECHO_REQUEST
+        # The kernel replaces the identifier with the socket's own; replies are matched by sequence
+        header = struct.pack('!BBHHH', request_type, 0, 0, 0, sequence)
+        payload = os.urandom(16)
+        packet = struct.pack('!BBHHH', request_type, 0, icmp_checksum(header + payload), 0, sequence) + payload
+
+        future = self.loop.create_future()
+        self._pending[(ip, sequence)] = future
+        try:
+            started = time.perf_counter()
+            sock.sendto(packet, (ip, 0))
+            received = await asyncio.wait_for(future, timeout)
+            return (received - started) * 1000
+        except (asyncio.TimeoutError, OSError):
+            return None
+        finally:
+            self._pending.pop((ip, sequence), None)
+
+    def close(self) -> None:
+        """Close the sockets."""
+        for sock in self._sockets.values():
+            self.loop.remove_reader(sock.fileno())
+            sock.close()
+        self._sockets.clear()
+
+
+class LatencyProber:
+    """
+    Samples the round-trip time of IP:port pairs with TCP connects or ICMP echoes.
+    """
+    def __init__(
+        self,
+        method: str = 'tcp',
+        timeout: float = 1.0,
+        samples: int = 3,
+        interval: float = 0.05,
+        concurrency: int = 512,
+        slots: Optional[asyncio.Semaphore] = None
+    ):
+        """
+        Initialize the prober.
+
+        :param method: `tcp` to time TCP connects, or `icmp` to send echo requests
+        :param timeout: Seconds to wait for each sample
+        :param samples: Number of samples per IP
+        :param interval: Seconds between the samples of one IP
+        :param concurrency: Maximum number of samples in flight
+        :param slots: Semaphore shared with other probes to cap the connections in flight
+            instead of `concurrency`; it must belong to the loop the prober runs on
+        """
+        self.method = method
+        self.timeout = timeout
+        self.samples = samples
+        self.interval = interval
+        self.concurrency = concurrency
+        self._shared_slots = slots
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._icmp: Optional[IcmpEcho] = None
+
+    def _start(self) -> None:
+        """Create the loop-bound state on first use."""
+        if self._slots is not None:
+            return
+        self._slots = self._shared_slots or asyncio.Semaphore(self.concurrency)
+        if self.method == 'icmp':
+            try:
+                self._icmp = IcmpEcho(asyncio.get_running_loop())
+            except OSError as e:
+                logging.warning(f"ICMP sockets are not permitted ({e}), timing TCP connects instead.")
+                self.method = 'tcp'
+
+    async def _tcp_connect(self, ip: str, port: int) -> Optional[float]:
+        """Time one TCP connect in milliseconds; None if it failed or timed out."""
+        loop = asyncio.get_running_loop()
+        sock = socket.socket(socket.AF_INET6 if ':' in ip else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            started = time.perf_counter()
+            await asyncio.wait_for(loop.sock_connect(sock, (ip, port)), self.timeout)
+            return (time.perf_counter() - started) * 1000
+        except (asyncio.TimeoutError, OSError) as e:
+            if getattr(e, 'errno', None) not in (None, errno.ECONNREFUSED, errno.ETIMEDOUT, errno.EHOSTUNREACH, errno.ENETUNREACH):
+                logging.debug(f"TCP connect to {ip}:{port} failed: {e}")
+            return None
+        finally:
+            sock.close()
+
+    async def probe(self, ip: str, port: Optional[int] = None) -> LatencyResult:
+        """
+        Sample the round-trip time of one IP:port.
+
+        :param ip: IP address
+        :param port: TCP port (defaults to 443)
+        :return: Latency samples
+        """
+        self._start()
+        result = LatencyResult(ip, port or 443)
+        for index in range(self.samples):
+            if index:
+                await asyncio.sleep(self.interval)
+            async with self._slots:
+                if self._icmp is not None:
+                    result.samples.append(await self._icmp.ping(ip, self.timeout))
+                else:
+                    result.samples.append(await self._tcp_connect(ip, result.port))
+        return result
+
+    async def probe_many(self, targets: Iterable[Tuple[str, Optional[int]]]) -> Dict[Tuple[str, int], LatencyResult]:
+        """
+        Sample the round-trip time of many IP:port pairs at once.
+
+        :param targets: IP addresses and ports
+        :return: Dictionary mapping (IP, port) to its samples
+        """
+        results = await asyncio.gather(*(self.probe(ip, port) for ip, port in targets))
+        return {(result.ip, result.port): result for result in results}
+
+    def close(self) -> None:
+        """Close the ICMP sockets, if any."""
+        if self._icmp is not None:
+            self._icmp.close()
+            self._icmp = None
+        self._slots = None
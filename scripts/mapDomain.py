@@ -1,67 +1,125 @@
 import csv
+import logging
 import configparser
 from operator import itemgetter
+from runMetrics import RunMetrics, configure_logging
+
+def load_domain_map(config):
+    """Load the domain and max IPs of each region from [mapDomain.map], keyed by lower-case region."""
+    domain_map = {}
+    max_ips = {}
+    for region, mapping in config.items('mapDomain.map'):
+        domain, max_ip = mapping.split(',')
+        region_lower = region.strip().lower()  # Make region case-insensitive
+        domain_map[region_lower] = domain.strip()
+        max_ips[region_lower] = int(max_ip.strip())
+    return domain_map, max_ips
+
+def column_float(row, column, default=0.0):
+    """Read a numeric CSV column, using the default when it is missing or empty (results of older runs)."""
+    value = (row.get(column) or '').strip()
+    return float(value) if value else default
+
+def stable_latency(row):
+    """Rank key of a row by latency: least loss first, then lowest median ping plus jitter, then fastest download."""
+    return (row['Domain'], row['Loss'], row['Ping'] + row['Jitter'], -row['Download'])
 
 def filter_ips():
     # Load configuration
     print("Loading configuration...")
     config = configparser.ConfigParser()
     config.read('config.ini')
+    # Per-row lines are logged at DEBUG
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    configure_logging(config)
+    metrics = RunMetrics.from_config(config, 'mapDomain')
+    try:
+        map_ips(config, metrics)
+    finally:
+        metrics.write()
 
+def map_ips(config, metrics):
+    """Map the tested IPs of `input_csv` to their domains, counting the kept and skipped rows in `metrics`."""
     input_csv = config.get('mapDomain', 'input_csv')
     output_csv = config.get('mapDomain', 'output_csv')
+    sort_by = config.get('mapDomain', 'sort_by', fallback='download').strip().lower()
     print(f"Input CSV path: {input_csv}")
     print(f"Output CSV path: {output_csv}")
 
     # Load domain mapping and max IPs per domain (case-insensitive)
     print("Loading domain mapping and max IP limits (case-insensitive)...")
-    domain_map = {}
-    max_ips = {}
-    for region, mapping in config.items('mapDomain.map'):
-        domain, max_ip = mapping.split(',')
-        region_lower = region.strip().lower()  # Make region case-insensitive
-        domain_map[region_lower] = domain.strip()
-        max_ips[region_lower] = int(max_ip.strip())
-        print(f"Mapped region '{region.strip()}' to domain '{domain.strip()}' with max IPs: {max_ip.strip()}")
+    domain_map, max_ips = load_domain_map(config)
+    for region, domain in domain_map.items():
+        print(f"Mapped region '{region}' to domain '{domain}' with max IPs: {max_ips[region]}")
 
     # Read and filter input CSV
     print("Reading and filtering input CSV...")
     filtered_data = []
-    with open(input_csv, 'r') as infile:
+    seen_regions = set()
+    with metrics.stage('read'), open(input_csv, 'r') as infile:
         reader = csv.DictReader(infile)
         for row in reader:
             region = row['Region'].strip().lower()  # Normalize region to lower case
-            if region in domain_map:
-                print(f"Processing row: IP={row['IP']}, Region={row['Region']}, Download={row['Download (Mbps)']}")
+            seen_regions.add(region)
+            if column_float(row, 'Failures') > 0:
+                # Kept in the results until it expires, but failed its last test
+                logging.debug(f"Skipping IP '{row['IP']}' that failed its last test")
+                metrics.count('rows', outcome='failing', region=region)
+            elif region in domain_map:
+                logging.debug(f"Processing row: IP={row['IP']}, Region={row['Region']}, Download={row['Download (Mbps)']}")
+                metrics.count('rows', outcome='mapped', region=region)
                 filtered_data.append({
                     'Domain': domain_map[region],
                     'IP': row['IP'],
                     'Download': float(row['Download (Mbps)']),
+                    'Ping': column_float(row, 'Ping (ms)'),
+                    'Jitter': column_float(row, 'Jitter (ms)'),
+                    'Loss': column_float(row, 'Loss (%)'),
                     'Region': region
                 })
             else:
-                print(f"Skipping row with Region '{row['Region']}' (no mapping found)")
+                logging.debug(f"Skipping row with Region '{row['Region']}' (no mapping found)")
+                metrics.count('rows', outcome='unmapped', region=region)
 
-    # Sort data by Download (Mbps) and then by Domain
-    print("Sorting data by Domain and Download speed...")
-    filtered_data.sort(key=itemgetter('Domain', 'Download'), reverse=True)
+    # A mapped region without rows usually means the results are grouped differently, e.g. by GeoIP country
+    unmatched = sorted(set(domain_map) - seen_regions)
+    if unmatched:
+        logging.warning(f"Regions {unmatched} of [mapDomain.map] match none of the regions in {input_csv}: {sorted(seen_regions)}")
+
+    with metrics.stage('sort'):
+        if sort_by == 'latency':
+            # Sort data by Domain and then by stable latency
+            print("Sorting data by Domain and stable latency...")
+            filtered_data.sort(key=stable_latency)
+        else:
+            # Sort data by Download (Mbps) and then by Domain
+            print("Sorting data by Domain and Download speed...")
+            filtered_data.sort(key=itemgetter('Domain', 'Download'), reverse=True)
 
     # Limit the number of IPs per domain
     print("Limiting the number of IPs per domain...")
     domain_ip_count = {domain: 0 for domain in domain_map.values()}
+    domain_ips = set()
     final_data = []
     for row in filtered_data:
         domain = row['Domain']
-        if domain_ip_count[domain] < max_ips[row['Region']]:
-            print(f"Adding IP '{row['IP']}' to domain '{domain}'")
+        if (domain, row['IP']) in domain_ips:
+            # The same IP passed on another port; the rows are sorted, so its best port was kept
+            logging.debug(f"Skipping IP '{row['IP']}' already added to domain '{domain}'")
+            metrics.count('ips', outcome='duplicate', domain=domain)
+        elif domain_ip_count[domain] < max_ips[row['Region']]:
+            logging.debug(f"Adding IP '{row['IP']}' to domain '{domain}'")
             final_data.append({'Domain': domain, 'IP': row['IP']})
+            domain_ips.add((domain, row['IP']))
             domain_ip_count[domain] += 1
+            metrics.count('ips', outcome='kept', domain=domain)
         else:
-            print(f"Skipping IP '{row['IP']}' for domain '{domain}' (max limit reached)")
+            logging.debug(f"Skipping IP '{row['IP']}' for domain '{domain}' (max limit reached)")
+            metrics.count('ips', outcome='over_limit', domain=domain)
 
     # Write to output CSV
     print("Writing data to output CSV...")
-    with open(output_csv, 'w', newline='') as outfile:
+    with metrics.stage('write'), open(output_csv, 'w', newline='') as outfile:
         writer = csv.DictWriter(outfile, fieldnames=['Domain', 'IP'])
         writer.writeheader()
         writer.writerows(final_data)
@@ -0,0 +1,99 @@
+"""
+Shard Merger
+
+This script combines the results files written by the shards of a sharded
+`cfSpeedTest.py` run (see `sharding.py`) into the output file, the way a
+single run would have written it: merged into the results of earlier runs
+with `incremental_results`, replacing them otherwise. Every row keeps the
+vantage point of the shard that tested it. The shard files are removed
+once they are merged.
+"""
+
+import os
+import logging
+import configparser
+from typing import Dict, List, Set, Tuple
+
+from resultStore import FAILURES_COLUMN, TESTED_AT_COLUMN, load_results, merge_results, parse_time, write_results
+from runMetrics import RunMetrics, configure_logging
+from sharding import shard_files
+
+Key = Tuple[str, str]
+
+
+def merge_shards(config: configparser.ConfigParser, metrics: RunMetrics) -> int:
+    """
+    Merge the shard files of `[cfSpeedTest] output_file` into it.
+
+    :param config: Parsed configuration
+    :param metrics: Run metrics the merged rows are counted in
+    :return: Number of shard files merged
+    """
+    output_file = config.get('cfSpeedTest', 'output_file', fallback='ip_performance.csv')
+    files = shard_files(output_file)
+    if not files:
+        logging.warning(f"No shard files of {output_file} found, nothing to merge.")
+        return 0
+
+    counts = {count for _, count in files.values()}
+    for count in sorted(counts):
+        missing = sorted(set(range(count)) - {index for index, shard_count in files.values() if shard_count == count})
+        if missing:
+            logging.warning(f"Shards {missing} of {count} are missing; their IPs keep the results of earlier runs.")
+    if len(counts) > 1:
+        logging.warning(f"Shard files of different shard counts {sorted(counts)} are merged together.")
+
+    header: List[str] = []
+    passed: Dict[Key, Dict[str, str]] = {}
+    failed: Set[Key] = set()
+    with metrics.stage('read'):
+        for path, (index, count) in files.items():
+            columns, rows = load_results(path)
+            header += [column for column in columns if column not in header and column not in (TESTED_AT_COLUMN, FAILURES_COLUMN)]
+            for key, row in rows.items():
+                vantage = row.get('Vantage') or ''
+                if row.get(FAILURES_COLUMN) != '0':
+                    failed.add(key)
+                    metrics.count('rows', outcome='failed', vantage=vantage)
+                    continue
+                metrics.count('rows', outcome='passed', vantage=vantage)
+                # An IP tested by two shards, e.g. after the shard count changed, keeps its latest result
+                previous = passed.get(key)
+                if previous is None or parse_time(row[TESTED_AT_COLUMN], 0) > parse_time(previous[TESTED_AT_COLUMN], 0):
+                    passed[key] = row
+            logging.info(f"Read shard {index + 1} of {count} from {path}: {len(rows)} IPs.")
+
+    with metrics.stage('write'):
+        if config.getboolean('cfSpeedTest', 'incremental_results', fallback=True):
+            merge_results(
+                output_file,
+                header,
+                passed.values(),
+                failed,
+                config.getfloat('cfSpeedTest', 'results_half_life', fallback=6.0) * 3600,
+                config.getfloat('cfSpeedTest', 'results_max_age', fallback=48.0) * 3600,
+                config.getint('cfSpeedTest', 'results_max_failures', fallback=2)
+            )
+        else:
+            write_results(output_file, header, passed.values())
+    logging.info(f"Merged {len(files)} shard files into {output_file}: {len(passed)} passed, {len(failed)} failed.")
+
+    for path in files:
+        os.remove(path)
+    return len(files)
+
+
+def main():
+    config = configparser.ConfigParser()
+    config.read('config.ini')
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    configure_logging(config)
+    metrics = RunMetrics.from_config(config, 'mergeShards')
+    try:
+        merge_shards(config, metrics)
+    finally:
+        metrics.write()
+
+
+if __name__ == '__main__':
+    main()
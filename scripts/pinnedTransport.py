@@ -0,0 +1,154 @@
+"""
+IP-Pinned HTTPS Transport
+
+This module dials a candidate IP address directly while presenting the
+real hostname in the TLS SNI, certificate verification and the Host
+header. Connections are pooled per (IP, hostname, port), so consecutive
+probes against the same IP reuse one TLS connection. Ports that do not
+serve TLS, such as 80 or 8080, are requested over plain HTTP with the
+same Host header.
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple, Union
+
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool, HTTPResponse, Timeout
+from urllib3.exceptions import HTTPError
+from requests.certs import where as default_ca_bundle
+
+# Exceptions raised by the transport for connection, TLS and protocol failures
+TRANSPORT_ERRORS = (HTTPError, OSError)
+
+
+class PinnedTransport:
+    """
+    Connection pools that send requests for a hostname to a fixed IP address.
+    """
+    def __init__(
+        self,
+        timeout: float = 4.0,
+        max_pools: int = 256,
+        pool_size: int = 2,
+        ca_certs: Optional[str] = None
+    ):
+        """
+        Initialize the transport.
+
+        :param timeout: Default connect and read timeout in seconds
+        :param max_pools: Maximum number of pools kept open; the least recently used one is closed first
+        :param pool_size: Maximum number of idle connections kept per pool
+        :param ca_certs: CA bundle used to verify server certificates (defaults to certifi)
+        """
+        self.timeout = timeout
+        self.max_pools = max_pools
+        self.pool_size = pool_size
+        self.ca_certs = ca_certs or default_ca_bundle()
+        self._pools: "OrderedDict[Tuple[str, str, int, bool], HTTPConnectionPool]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_pool(self, ip: str, host: str, port: int, tls: bool = True) -> HTTPConnectionPool:
+        """Get or create the pool for an (IP, hostname, port) triple, with or without TLS."""
+        key = (ip, host, port, tls)
+        evicted = None
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is not None:
+                self._pools.move_to_end(key)
+                return pool
+
+            options = dict(
+                port=port,
+                maxsize=self.pool_size,
+                block=False,
+                retries=False,
+                timeout=Timeout(connect=self.timeout, read=self.timeout)
+            )
+            if tls:
+                pool = HTTPSConnectionPool(
+                    ip,
+                    cert_reqs='CERT_REQUIRED',
+                    ca_certs=self.ca_certs,
+                    server_hostname=host,
+                    assert_hostname=host,
+                    **options
+                )
+            else:
+                pool = HTTPConnectionPool(ip, **options)
+            self._pools[key] = pool
+            if len(self._pools) > self.max_pools:
+                _, evicted = self._pools.popitem(last=False)
+
+        if evicted is not None:
+            evicted.close()
+        return pool
+
+    def request(
+        self,
+        method: str,
+        ip: str,
+        host: str,
+        path: str,
+        port: int = 443,
+        tls: bool = True,
+        body: Optional[Union[bytes, object]] = None,
+        headers: Optional[Dict[str, str]] = None,
+        timeout: Optional[Union[float, Timeout]] = None,
+        preload_content: bool = True,
+        chunked: bool = False
+    ) -> HTTPResponse:
+        """
+        Send a request for `host` to the given IP address.
+
+        :param method: HTTP method
+        :param ip: IP address to connect to
+        :param host: Hostname used for SNI, certificate verification and the Host header
+        :param path: Request path including the query string
+        :param port: TCP port to connect to
+        :param tls: Connect with TLS; False for plain-HTTP ports
+        :param body: Request body, or an iterable of chunks when `chunked` is set
+        :param headers: Extra request headers
+        :param timeout: Timeout overriding the transport default
+        :param preload_content: Read the whole body before returning
+        :param chunked: Send the body with chunked transfer encoding
+        :return: urllib3 response; release it when `preload_content` is False
+        """
+        request_headers = {'Host': host, 'User-Agent': 'proxyip-tracker'}
+        if headers:
+            request_headers.update(headers)
+
+        pool = self._get_pool(ip, host, port, tls)
+        return pool.urlopen(
+            method,
+            path,
+            body=body,
+            headers=request_headers,
+            timeout=timeout if timeout is not None else pool.timeout,
+            redirect=False,
+            preload_content=preload_content,
+            chunked=chunked
+        )
+
+    def release(self, ip: str) -> None:
+        """
+        Close every pool connected to an IP address.
+
+        :param ip: IP address whose connections are no longer needed
+        """
+        with self._lock:
+            keys = [key for key in self._pools if key[0] == ip]
+            pools = [self._pools.pop(key) for key in keys]
+
+        for pool in pools:
+            pool.close()
+
+    def close(self) -> None:
+        """Close all pools."""
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools.clear()
+
+        for pool in pools:
+            pool.close()
+        logging.debug(f"Closed {len(pools)} pinned connection pools")
@@ -0,0 +1,209 @@
+"""
+Probe Result Cache
+
+This module keeps the last probe results of every IP:port in a SQLite
+database, so results measured by a recent run can be reused instead of
+testing the same IPs again.
+"""
+
+import os
+import time
+import sqlite3
+import logging
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+# Number of writes batched into one transaction
+COMMIT_INTERVAL = 200
+
+# Version stored in `PRAGMA user_version`; bump it with a migration in `_migrate`
+SCHEMA_VERSION = 3
+
+
+@dataclass
+class ProbeRecord:
+    """
+    Data class to store the cached probe results of an IP:port.
+    """
+    ip: str
+    port: int
+    ping: Optional[int]
+    download_speed: Optional[float]
+    upload_speed: Optional[float]
+    ttfb: Optional[int]
+    last_success: Optional[float]
+    last_failure: Optional[float]
+    attempts: int = 0
+    successes: int = 0
+    colo: Optional[str] = None
+    ping_min: Optional[int] = None
+    ping_p95: Optional[int] = None
+    jitter: Optional[float] = None
+    loss: Optional[float] = None
+
+
+class ProbeCache:
+    """
+    SQLite store of probe results keyed by IP and port.
+    """
+    GOOD = 'good'
+    DEAD = 'dead'
+
+    def __init__(self, path: str, good_ttl: float, dead_ttl: float):
+        """
+        Open or create the cache database.
+
+        :param path: Path to the SQLite database file
+        :param good_ttl: Seconds a passing result stays fresh
+        :param dead_ttl: Seconds a failing result stays fresh
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.good_ttl = good_ttl
+        self.dead_ttl = dead_ttl
+        self._pending = 0
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS probes (
+                ip TEXT NOT NULL,
+                port INTEGER NOT NULL,
+                ping INTEGER,
+                download_speed REAL,
+                upload_speed REAL,
+                ttfb INTEGER,
+                last_success REAL,
+                last_failure REAL,
+                PRIMARY KEY (ip, port)
+            )
+        """)
+        self._migrate()
+        self._conn.commit()
+
+    def _migrate(self) -> None:
+        """Upgrade a database created by an older version of the cache."""
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1:
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(probes)")}
+            for column in ('attempts', 'successes'):
+                if column not in columns:
+                    self._conn.execute(f"ALTER TABLE probes ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0")
+        if version < 2:
+            self._conn.execute("ALTER TABLE probes ADD COLUMN colo TEXT")
+        if version < 3:
+            for column, column_type in (('ping_min', 'INTEGER'), ('ping_p95', 'INTEGER'), ('jitter', 'REAL'), ('loss', 'REAL')):
+                self._conn.execute(f"ALTER TABLE probes ADD COLUMN {column} {column_type}")
+        self._conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def load(self) -> Dict[Tuple[str, int], ProbeRecord]:
+        """
+        Load every cached record.
+
+        :return: Dictionary mapping (IP, port) to its record
+        """
+        rows = self._conn.execute(
+            "SELECT ip, port, ping, download_speed, upload_speed, ttfb, last_success, last_failure, attempts, successes, colo,"
+            " ping_min, ping_p95, jitter, loss"
+            " FROM probes"
+        )
+        return {(row[0], row[1]): ProbeRecord(*row) for row in rows}
+
+    def freshness(self, record: Optional[ProbeRecord], now: Optional[float] = None) -> Optional[str]:
+        """
+        Classify a record by the age of its latest result.
+
+        :param record: Cached record, if any
+        :param now: Reference time (defaults to the current time)
+        :return: `GOOD` or `DEAD` if the latest result is still fresh, None otherwise
+        """
+        if record is None:
+            return None
+        now = now or time.time()
+        last_success = record.last_success or 0
+        last_failure = record.last_failure or 0
+
+        if last_success >= last_failure:
+            return self.GOOD if last_success and now - last_success < self.good_ttl else None
+        return self.DEAD if now - last_failure < self.dead_ttl else None
+
+    def record_success(
+        self,
+        ip: str,
+        port: int,
+        ping: int,
+        download_speed: float,
+        upload_speed: float,
+        ttfb: int,
+        ping_min: Optional[int] = None,
+        ping_p95: Optional[int] = None,
+        jitter: Optional[float] = None,
+        loss: Optional[float] = None
+    ) -> None:
+        """Store the results of an IP that passed every test."""
+        self._conn.execute("""
+            INSERT INTO probes (
+                ip, port, ping, download_speed, upload_speed, ttfb, last_success, attempts, successes,
+                ping_min, ping_p95, jitter, loss
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, 1, 1, ?, ?, ?, ?)
+            ON CONFLICT (ip, port) DO UPDATE SET
+                ping = excluded.ping,
+                download_speed = excluded.download_speed,
+                upload_speed = excluded.upload_speed,
+                ttfb = excluded.ttfb,
+                last_success = excluded.last_success,
+                attempts = attempts + 1,
+                successes = successes + 1,
+                ping_min = excluded.ping_min,
+                ping_p95 = excluded.ping_p95,
+                jitter = excluded.jitter,
+                loss = excluded.loss
+        """, (ip, port, ping, download_speed, upload_speed, ttfb, time.time(), ping_min, ping_p95, jitter, loss))
+        self._written()
+
+    def record_failure(
+        self,
+        ip: str,
+        port: int,
+        ping: Optional[int] = None,
+        download_speed: Optional[float] = None,
+        upload_speed: Optional[float] = None
+    ) -> None:
+        """Store the results of an IP that failed a test; results not measured are kept."""
+        self._conn.execute("""
+            INSERT INTO probes (ip, port, ping, download_speed, upload_speed, last_failure, attempts)
+            VALUES (?, ?, ?, ?, ?, ?, 1)
+            ON CONFLICT (ip, port) DO UPDATE SET
+                ping = COALESCE(excluded.ping, ping),
+                download_speed = COALESCE(excluded.download_speed, download_speed),
+                upload_speed = COALESCE(excluded.upload_speed, upload_speed),
+                last_failure = excluded.last_failure,
+                attempts = attempts + 1
+        """, (ip, port, ping, download_speed, upload_speed, time.time()))
+        self._written()
+
+    def record_colo(self, ip: str, port: int, colo: str) -> None:
+        """Store the Cloudflare colo an IP:port is served from."""
+        self._conn.execute("""
+            INSERT INTO probes (ip, port, colo) VALUES (?, ?, ?)
+            ON CONFLICT (ip, port) DO UPDATE SET colo = excluded.colo
+        """, (ip, port, colo))
+        self._written()
+
+    def _written(self) -> None:
+        """Commit once enough writes are pending."""
+        self._pending += 1
+        if self._pending >= COMMIT_INTERVAL:
+            self.commit()
+
+    def commit(self) -> None:
+        """Commit pending writes."""
+        self._conn.commit()
+        self._pending = 0
+
+    def close(self) -> None:
+        """Commit pending writes and close the database."""
+        self.commit()
+        self._conn.close()
+        logging.info("Probe cache saved.")
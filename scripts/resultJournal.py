@@ -0,0 +1,153 @@
+"""
+Result Journal
+
+This module streams the outcome of every tested IP:port to an append-only
+JSON Lines file while the speed test runs, so an interrupted run loses at
+most the lines written since its last fsync. The journal doubles as the
+checkpoint of the run: a rerun loads it, takes over the recent outcomes
+instead of testing those IPs again, and continues with the others. The
+journal is removed once the run's results are exported.
+
+The first line of the journal is a header holding the version of the
+format of the entries' results. A journal written with another version,
+e.g. by an older build whose results had other fields, is not resumed.
+"""
+
+import os
+import json
+import time
+import logging
+from typing import Dict, Optional, Tuple
+
+from atomicFile import atomic_write
+
+Key = Tuple[str, int]
+
+# Port written for candidates listed without one, as they are tested on it
+DEFAULT_PORT = 443
+
+
+def _port(port: Optional[int]) -> int:
+    """Port of a journal entry; candidates listed without one use `DEFAULT_PORT`."""
+    return DEFAULT_PORT if port is None else int(port)
+
+
+class ResultJournal:
+    """
+    Append-only log of the outcome of each tested IP:port.
+    """
+    def __init__(self, path: str, fsync_interval: float = 5.0, max_age: float = 6 * 3600, version: int = 1):
+        """
+        Open the journal, keeping the entries of an interrupted run that are still recent.
+
+        :param path: Path to the JSON Lines file
+        :param fsync_interval: Seconds between two fsyncs of the file; 0 syncs every entry
+        :param max_age: Seconds an entry is resumed from; older entries are discarded
+        :param version: Version of the format of the entries' results; a journal of another version is discarded
+        """
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.version = version
+        self.entries = self._load(max_age)
+
+        # Rewrite the kept entries, dropping stale, duplicate and torn lines
+        with atomic_write(path, sync=True) as file:
+            file.write(json.dumps({'version': version}) + '\n')
+            for entry in self.entries.values():
+                file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+
+        self._file = open(path, 'a')
+        self._synced = time.monotonic()
+        if self.entries:
+            logging.info(f"Resuming an interrupted run: {len(self.entries)} IPs already tested.")
+
+    def _load(self, max_age: float) -> Dict[Key, dict]:
+        """
+        Read the entries of the journal.
+
+        :param max_age: Seconds an entry is kept
+        :return: Latest recent entry of each IP and port
+        """
+        entries: Dict[Key, dict] = {}
+        unreadable = 0
+        now = time.time()
+        try:
+            with open(self.path, 'r') as file:
+                header = file.readline()
+                if not header:
+                    return entries
+                try:
+                    version = json.loads(header).get('version')
+                except (ValueError, AttributeError):
+                    # Journals of older builds have no header
+                    version = None
+                if version != self.version:
+                    logging.warning(f"Not resuming the result journal {self.path}: written with version {version}, not {self.version}")
+                    return entries
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                        key = (entry['ip'], _port(entry.get('port')))
+                        tested_at = float(entry['tested_at'])
+                    except (ValueError, KeyError, TypeError):
+                        # Most likely the last line, cut short when the run was killed
+                        unreadable += 1
+                        continue
+                    if now - tested_at <= max_age:
+                        entries[key] = entry
+        except OSError:
+            pass
+        if unreadable:
+            logging.warning(f"Ignored {unreadable} unreadable lines of the result journal {self.path}")
+        return entries
+
+    def get(self, ip: str, port: int) -> Optional[dict]:
+        """
+        Entry of an IP:port tested by the interrupted run.
+
+        :param ip: IP address
+        :param port: Port
+        :return: Entry, or None if the IP was not tested
+        """
+        return self.entries.get((ip, _port(port)))
+
+    def append(self, ip: str, port: int, passed: bool, result: Optional[dict] = None) -> None:
+        """
+        Write the outcome of a test.
+
+        Every entry is handed to the operating system at once; the file is
+        synced to disk at most every `fsync_interval` seconds.
+
+        :param ip: IP address
+        :param port: Port
+        :param passed: Whether the IP passed every test
+        :param result: Measured results of a passing IP
+        """
+        entry = {'ip': ip, 'port': _port(port), 'passed': passed, 'tested_at': time.time()}
+        if result is not None:
+            entry['result'] = result
+        self._file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        self._file.flush()
+        if time.monotonic() - self._synced >= self.fsync_interval:
+            self.sync()
+
+    def sync(self) -> None:
+        """Sync the written entries to disk."""
+        os.fsync(self._file.fileno())
+        self._synced = time.monotonic()
+
+    def close(self) -> None:
+        """Sync and close the journal; it is kept until `discard` is called."""
+        if self._file.closed:
+            return
+        self._file.flush()
+        self.sync()
+        self._file.close()
+
+    def discard(self) -> None:
+        """Close and remove the journal once the run's results are safely exported."""
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
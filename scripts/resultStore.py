@@ -0,0 +1,183 @@
+"""
+Incremental Results Store
+
+This module keeps `tested-ips.csv` across runs instead of rewriting it
+from the last run alone. New measurements of an IP:port are merged into
+its previous ones with a weight that decays with the age of the previous
+measurement, IPs not tested in a run are kept until they expire, and IPs
+are dropped after failing several runs in a row. The file is written
+through a temporary file and renamed, so readers never see a partial one.
+"""
+
+import os
+import csv
+import time
+import logging
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from atomicFile import atomic_write
+
+TESTED_AT_COLUMN = 'Tested At'
+FAILURES_COLUMN = 'Failures'
+
+# Measurement columns that are averaged across runs, with their number of decimals
+NUMERIC_COLUMNS = {
+    'Ping (ms)': 0,
+    'Upload (Mbps)': 2,
+    'Download (Mbps)': 2,
+    'TTFB (ms)': 0,
+    'Ping Min (ms)': 0,
+    'Ping P95 (ms)': 0,
+    'Jitter (ms)': 1,
+    'Loss (%)': 0
+}
+
+Row = Dict[str, str]
+Key = Tuple[str, str]
+
+
+def format_time(timestamp: float) -> str:
+    """UTC ISO 8601 form of a timestamp, as stored in the `Tested At` column."""
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def parse_time(value: Optional[str], default: float) -> float:
+    """Timestamp of a `Tested At` value, or the default when missing or malformed."""
+    try:
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc).timestamp()
+    except (TypeError, ValueError):
+        return default
+
+
+def row_key(row: Row) -> Key:
+    """IP and port of a row."""
+    return row.get('IP', '').strip(), row.get('Port', '').strip()
+
+
+def load_results(path: str) -> Tuple[List[str], Dict[Key, Row]]:
+    """
+    Load the rows of a results file.
+
+    Rows written before the file had a `Tested At` column get the time of
+    the file's last modification.
+
+    :param path: Path to the CSV file
+    :return: Header and rows keyed by IP and port; empty when the file does not exist
+    """
+    try:
+        modified = format_time(os.path.getmtime(path))
+        with open(path, 'r', newline='') as file:
+            reader = csv.DictReader(file)
+            rows = {}
+            for row in reader:
+                row[TESTED_AT_COLUMN] = row.get(TESTED_AT_COLUMN) or modified
+                rows[row_key(row)] = row
+            return list(reader.fieldnames or []), rows
+    except OSError:
+        return [], {}
+
+
+def write_results(path: str, header: List[str], rows: Iterable[Row]) -> None:
+    """
+    Write rows sorted by region and download speed, through a temporary file.
+
+    :param path: Path to the CSV file
+    :param header: Columns of the rows, without `Tested At` and `Failures`
+    :param rows: Rows to write
+    """
+    columns = list(header) + [TESTED_AT_COLUMN, FAILURES_COLUMN]
+    ordered = sorted(rows, key=lambda row: (row.get('Region') or '', -float(row.get('Download (Mbps)') or 0)))
+
+    with atomic_write(path, newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=columns, extrasaction='ignore')
+        writer.writeheader()
+        for row in ordered:
+            writer.writerow({column: row.get(column) or '' for column in columns})
+
+
+def merge_row(previous: Row, current: Row, half_life: float) -> Row:
+    """
+    Merge a new measurement of an IP into its previous one.
+
+    The previous value weighs `0.5 ** (age / half_life)` against the new one,
+    so a measurement made just before counts as much as the new one and an
+    old one hardly counts. Descriptive columns (region, ASN, colo) take the
+    new value.
+
+    :param previous: Previous row
+    :param current: New row
+    :param half_life: Seconds after which the previous value weighs half as much
+    :return: Merged row
+    """
+    now = parse_time(current.get(TESTED_AT_COLUMN), time.time())
+    age = max(now - parse_time(previous.get(TESTED_AT_COLUMN), now), 0.0)
+    weight = 0.5 ** (age / half_life) if half_life > 0 else 0.0
+
+    merged = dict(current)
+    for column, decimals in NUMERIC_COLUMNS.items():
+        try:
+            old, new = float(previous[column]), float(current[column])
+        except (KeyError, TypeError, ValueError):
+            continue
+        value = (new + weight * old) / (1 + weight)
+        merged[column] = f"{value:.{decimals}f}" if decimals else str(round(value))
+    return merged
+
+
+def merge_results(
+    path: str,
+    header: List[str],
+    rows: Iterable[Row],
+    failed: Set[Key],
+    half_life: float,
+    max_age: float,
+    max_failures: int,
+    now: Optional[float] = None
+) -> int:
+    """
+    Merge the rows of a run into the results file and write it atomically.
+
+    :param path: Path to the CSV file
+    :param header: Columns of the run's rows, without `Tested At` and `Failures`
+    :param rows: Rows of the IPs that passed in this run, with `Tested At` set
+    :param failed: IPs and ports that failed a test in this run
+    :param half_life: Seconds after which a previous measurement weighs half as much
+    :param max_age: Seconds after which an IP not tested again is dropped
+    :param max_failures: Consecutive failed runs after which an IP is dropped
+    :param now: Current timestamp (defaults to the current time)
+    :return: Number of rows written
+    """
+    now = time.time() if now is None else now
+    _, stored = load_results(path)
+
+    merged: Dict[Key, Row] = {}
+    for row in rows:
+        key = row_key(row)
+        previous = stored.pop(key, None)
+        if previous and parse_time(previous[TESTED_AT_COLUMN], 0) < parse_time(row[TESTED_AT_COLUMN], now):
+            row = merge_row(previous, row, half_life)
+        elif previous:
+            # A result reused from the probe cache that is already in the file
+            row = {**row, **{column: previous[column] for column in NUMERIC_COLUMNS if previous.get(column)}}
+        row[FAILURES_COLUMN] = '0'
+        merged[key] = row
+
+    kept = expired = dropped = 0
+    for key, row in stored.items():
+        if now - parse_time(row[TESTED_AT_COLUMN], 0) > max_age:
+            expired += 1
+            continue
+        failures = int(row.get(FAILURES_COLUMN) or 0) + (key in failed)
+        if failures >= max_failures:
+            dropped += 1
+            continue
+        merged[key] = {**row, FAILURES_COLUMN: str(failures)}
+        kept += 1
+
+    write_results(path, header, merged.values())
+    logging.info(
+        f"Merged results: {len(merged)} IPs ({kept} kept from earlier runs, "
+        f"{expired} expired, {dropped} dropped after {max_failures} failed runs)"
+    )
+    return len(merged)
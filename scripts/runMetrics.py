@@ -0,0 +1,257 @@
+"""
+Run Metrics
+
+This module collects the instrumentation of one script run: stage timers,
+labelled counters (probes, records, bytes) and histograms (ping, TTFB,
+throughput). At the end of the run they are written as a JSON report and,
+optionally, as a Prometheus text file for a node exporter's textfile
+collector. Collection is thread-safe and cheap enough for the hot loops,
+so the per-IP log lines can stay at DEBUG.
+
+Settings are read from the `[metrics]` section of `config.ini`:
+
+    report_dir   Directory of the `<script>.json` reports; empty disables them
+    prometheus   Also write `<script>.prom` (True/False)
+    log_level    Level of the scripts' logs; per-IP lines are logged at DEBUG
+"""
+
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+import configparser
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from atomicFile import atomic_write
+
+METRIC_PREFIX = 'proxyip'
+
+# Upper bounds of the histogram buckets, by histogram name
+BUCKETS: Dict[str, Tuple[float, ...]] = {
+    'ping_ms': (10, 25, 50, 75, 100, 150, 200, 300, 500, 1000),
+    'ttfb_ms': (10, 25, 50, 75, 100, 150, 200, 300, 500, 1000),
+    'download_mbps': (1, 2, 5, 10, 25, 50, 100, 200, 500, 1000),
+    'upload_mbps': (1, 2, 5, 10, 25, 50, 100, 200, 500, 1000),
+    'request_ms': (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+}
+DEFAULT_BUCKETS = (0.01, 0.1, 1, 10, 100, 1000)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _number(value: float) -> str:
+    """Prometheus sample value; whole numbers are written without an exponent."""
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _labels(labels: Dict[str, object]) -> Labels:
+    """Hashable, sorted form of a label set; None values become empty strings."""
+    return tuple(sorted((key, '' if value is None else str(value)) for key, value in labels.items()))
+
+
+class Histogram:
+    """
+    Bucketed distribution of observed values.
+    """
+    def __init__(self, buckets: Sequence[float]):
+        """
+        :param buckets: Upper bounds of the buckets, ascending
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        """Add a value."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> Iterator[Tuple[str, int]]:
+        """Cumulative count per upper bound, ending with `+Inf`."""
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield ('+Inf' if bound == float('inf') else f"{bound:g}"), total
+
+
+class RunMetrics:
+    """
+    Instrumentation of one script run.
+    """
+    def __init__(self, job: str, report_dir: str = '', prometheus: bool = False):
+        """
+        Initialize the metrics.
+
+        :param job: Name of the script, used as the report name and `job` label
+        :param report_dir: Directory the reports are written to; empty disables them
+        :param prometheus: Also write a Prometheus text file
+        """
+        self.job = job
+        self.report_dir = report_dir
+        self.prometheus = prometheus
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+        self.stages: Dict[str, float] = {}
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+
+    @classmethod
+    def from_config(cls, config: configparser.ConfigParser, job: str) -> 'RunMetrics':
+        """
+        Create the metrics of a script from the `[metrics]` section.
+
+        :param config: Parsed configuration
+        :param job: Name of the script
+        :return: Run metrics
+        """
+        return cls(
+            job,
+            report_dir=config.get('metrics', 'report_dir', fallback='result/metrics'),
+            prometheus=config.getboolean('metrics', 'prometheus', fallback=False)
+        )
+
+    def add_time(self, stage: str, seconds: float) -> None:
+        """
+        Add busy time to a stage; stages running concurrently add up their busy time.
+
+        :param stage: Stage name
+        :param seconds: Elapsed seconds
+        """
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, stage: str) -> Iterator[None]:
+        """Time the enclosed block as part of a stage."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - started)
+
+    def count(self, name: str, value: float = 1, **labels) -> None:
+        """
+        Increase a counter.
+
+        :param name: Counter name, e.g. `probes`
+        :param value: Amount to add
+        :param labels: Labels of the counter, e.g. `stage='ping', outcome='timeout'`
+        """
+        key = (name, _labels(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """
+        Add a value to a histogram.
+
+        :param name: Histogram name; its buckets come from `BUCKETS`
+        :param value: Observed value
+        :param labels: Labels of the histogram
+        """
+        key = (name, _labels(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(BUCKETS.get(name, DEFAULT_BUCKETS))
+            histogram.observe(value)
+
+    def report(self) -> Dict[str, object]:
+        """
+        Build the JSON run report.
+
+        :return: Report with the run's duration, stages, counters and histograms
+        """
+        with self._lock:
+            return {
+                'job': self.job,
+                'started_at': round(self.started_at, 3),
+                'duration_s': round(time.perf_counter() - self._started, 3),
+                'stages_s': {stage: round(seconds, 3) for stage, seconds in self.stages.items()},
+                'counters': [
+                    {'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+                'histograms': [
+                    {
+                        'name': name,
+                        'labels': dict(labels),
+                        'count': histogram.count,
+                        'sum': round(histogram.sum, 3),
+                        'buckets': dict(histogram.cumulative())
+                    }
+                    for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0])
+                ]
+            }
+
+    def _prometheus_lines(self) -> List[str]:
+        """Lines of the Prometheus text exposition format."""
+        def escape(value: str) -> str:
+            return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        def series(name: str, labels: Labels, extra: Labels = ()) -> str:
+            pairs = (('job', self.job),) + labels + extra
+            return f"{METRIC_PREFIX}_{name}{{" + ','.join(f'{key}="{escape(value)}"' for key, value in pairs) + "}"
+
+        report = self.report()
+        lines = [
+            f"# TYPE {METRIC_PREFIX}_run_duration_seconds gauge",
+            f"{series('run_duration_seconds', ())} {report['duration_s']}",
+            f"# TYPE {METRIC_PREFIX}_run_started_seconds gauge",
+            f"{series('run_started_seconds', ())} {report['started_at']}",
+            f"# TYPE {METRIC_PREFIX}_stage_seconds gauge"
+        ]
+        lines += [f"{series('stage_seconds', (('stage', stage),))} {seconds}" for stage, seconds in report['stages_s'].items()]
+
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {METRIC_PREFIX}_{name}_total counter")
+                typed.add(name)
+            lines.append(f"{series(f'{name}_total', labels)} {_number(value)}")
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {METRIC_PREFIX}_{name} histogram")
+                typed.add(name)
+            for bound, count in histogram.cumulative():
+                lines.append(f"{series(f'{name}_bucket', labels, (('le', bound),))} {count}")
+            lines.append(f"{series(f'{name}_sum', labels)} {_number(histogram.sum)}")
+            lines.append(f"{series(f'{name}_count', labels)} {histogram.count}")
+        return lines
+
+    def write(self) -> Optional[str]:
+        """
+        Write the JSON report, and the Prometheus file if enabled, atomically.
+
+        :return: Path of the JSON report, or None when reports are disabled
+        """
+        if not self.report_dir:
+            return None
+        report_path = os.path.join(self.report_dir, f"{self.job}.json")
+        with atomic_write(report_path) as file:
+            json.dump(self.report(), file, indent=2)
+        if self.prometheus:
+            with atomic_write(os.path.join(self.report_dir, f"{self.job}.prom")) as file:
+                file.write('\n'.join(self._prometheus_lines()) + '\n')
+        logging.info(f"Run report written to {report_path}")
+        return report_path
+
+
+def configure_logging(config: configparser.ConfigParser, default: str = 'INFO') -> None:
+    """
+    Set the level of the root logger from `[metrics] log_level`.
+
+    :param config: Parsed configuration
+    :param default: Level used when not configured
+    """
+    level = config.get('metrics', 'log_level', fallback=default).strip().upper()
+    logging.getLogger().setLevel(getattr(logging, level, logging.INFO))
@@ -0,0 +1,101 @@
+"""
+Candidate Sharding
+
+This module splits the speed test across several runs, e.g. the jobs of a
+GitHub Actions matrix or local processes. Every IP is assigned to one
+shard by a hash of its address, so each shard tests the same IPs no
+matter which runner or process picks it up, and every port of an IP stays
+on one shard. Each shard writes its own results file next to the output
+file; `mergeShards.py` combines them.
+"""
+
+import os
+import re
+import hashlib
+from typing import Dict, Tuple
+
+Shard = Tuple[int, int]
+
+
+def parse_shard(value: str) -> Shard:
+    """
+    Parse a shard given as `INDEX/COUNT`, with INDEX counted from 0.
+
+    :param value: Shard, e.g. `1/4`; empty for a single shard
+    :return: Index and count of the shard
+    :raises ValueError: If the value is malformed or the index is out of range
+    """
+    value = (value or '').strip()
+    if not value:
+        return 0, 1
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise ValueError(f"Invalid shard '{value}', expected INDEX/COUNT such as 0/4")
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Invalid shard '{value}', the index must be between 0 and {count - 1}")
+    return index, count
+
+
+def shard_of(ip: str, count: int) -> int:
+    """
+    Shard an IP address belongs to.
+
+    :param ip: IP address
+    :param count: Number of shards
+    :return: Index of the shard
+    """
+    digest = hashlib.blake2b(ip.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % count
+
+
+def shard_path(path: str, shard: Shard) -> str:
+    """
+    Path of a shard's copy of a per-run file, e.g. `result/tested-ips.csv`
+    becomes `result/shards/tested-ips.1-of-4.csv`. A single shard keeps the path.
+
+    :param path: Path of the file
+    :param shard: Index and count of the shard
+    :return: Path of the shard's file
+    """
+    index, count = shard
+    if count == 1 or not path:
+        return path
+    directory, name = os.path.split(path)
+    root, extension = os.path.splitext(name)
+    return os.path.join(directory, 'shards', f"{root}.{index}-of-{count}{extension}")
+
+
+def shard_name(name: str, shard: Shard) -> str:
+    """
+    Name of a shard's run, e.g. its metrics report; a single shard keeps the name.
+
+    :param name: Name of the run
+    :param shard: Index and count of the shard
+    :return: Name of the shard's run
+    """
+    index, count = shard
+    return name if count == 1 else f"{name}.{index}-of-{count}"
+
+
+def shard_files(path: str) -> Dict[str, Shard]:
+    """
+    Find the shard files written for a per-run file by `shard_path`.
+
+    :param path: Path of the file, e.g. `result/tested-ips.csv`
+    :return: Dictionary mapping the path of each shard file to its shard
+    """
+    directory, name = os.path.split(path)
+    root, extension = os.path.splitext(name)
+    pattern = re.compile(rf"{re.escape(root)}\.(\d+)-of-(\d+){re.escape(extension)}")
+    shard_directory = os.path.join(directory, 'shards')
+    try:
+        names = sorted(os.listdir(shard_directory))
+    except OSError:
+        return {}
+    files = {}
+    for name in names:
+        match = pattern.fullmatch(name)
+        if match:
+            files[os.path.join(shard_directory, name)] = (int(match.group(1)), int(match.group(2)))
+    return files
@@ -0,0 +1,30 @@
+import os
+import sys
+import configparser
+
+import pytest
+
+# The scripts import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
+
+
+@pytest.fixture
+def tester(tmp_path):
+    """Factory of speed testers writing every file under `tmp_path`, with extra `[cfSpeedTest]` settings."""
+    from cfSpeedTest import CloudflareIPTester
+
+    def make(shard=None, **settings):
+        config = configparser.ConfigParser()
+        config['cfSpeedTest'] = {
+            'output_file': str(tmp_path / 'tested-ips.csv'),
+            'cache_file': '',
+            'journal_file': '',
+            'colo_file': str(tmp_path / 'colos.csv'),
+            **settings
+        }
+        config['metrics'] = {'report_dir': ''}
+        path = tmp_path / 'config.ini'
+        with open(path, 'w') as file:
+            config.write(file)
+        return CloudflareIPTester(str(path), shard=shard)
+    return make
@@ -0,0 +1,47 @@
+import os
+import threading
+
+import pytest
+
+from atomicFile import atomic_write
+
+
+def test_writes_and_creates_the_directory(tmp_path):
+    path = str(tmp_path / 'nested' / 'file.txt')
+    with atomic_write(path) as file:
+        file.write('content')
+    assert open(path).read() == 'content'
+    assert os.listdir(tmp_path / 'nested') == ['file.txt']
+
+
+def test_failed_write_keeps_the_file(tmp_path):
+    path = str(tmp_path / 'file.txt')
+    with atomic_write(path) as file:
+        file.write('old')
+    with pytest.raises(RuntimeError):
+        with atomic_write(path) as file:
+            file.write('new')
+            raise RuntimeError('interrupted')
+    assert open(path).read() == 'old'
+    assert os.listdir(tmp_path) == ['file.txt']
+
+
+def test_concurrent_writers_do_not_share_a_temporary_file(tmp_path):
+    path = str(tmp_path / 'file.txt')
+    errors = []
+
+    def write(content):
+        try:
+            for _ in range(200):
+                with atomic_write(path) as file:
+                    file.write(content * 1000)
+        except OSError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(letter,)) for letter in 'ab']
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert open(path).read() in ('a' * 1000, 'b' * 1000)
@@ -0,0 +1,95 @@
+import struct
+
+import pytest
+
+from candidateStore import (
+    HEADER, MAGIC, Candidate, CandidateFile, CandidateMerger, export_json, is_candidate_file,
+    read_candidates, read_json_candidates, write_candidates
+)
+
+CANDIDATES = [
+    Candidate(ip='104.16.1.2', port=443, tls='YES', asn='13335', country='US', sources=('zip',)),
+    Candidate(ip='2606:4700::6810:102', port=8443, tls='NO', asn=None, country=None, sources=('zip', 'countries')),
+    Candidate(ip='172.64.0.1', port=None, tls=None, asn='209242', country='DE', sources=None),
+]
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'ips.bin')
+    assert write_candidates(path, iter(CANDIDATES)) == 3
+    assert is_candidate_file(path)
+
+    read = list(read_candidates(path))
+    assert [(c.ip, c.port, c.asn, c.country, c.sources) for c in read] == [
+        (c.ip, c.port, c.asn, c.country, c.sources) for c in CANDIDATES
+    ]
+    # An unknown TLS flag is stored as such
+    assert [c.tls for c in read] == ['YES', 'NO', 'Unknown']
+
+
+def test_invalid_ips_are_skipped(tmp_path):
+    path = str(tmp_path / 'ips.bin')
+    assert write_candidates(path, [Candidate('not-an-ip', 443, 'YES', None), CANDIDATES[0]]) == 1
+    assert [c.ip for c in read_candidates(path)] == ['104.16.1.2']
+
+
+def test_empty_file(tmp_path):
+    path = str(tmp_path / 'ips.bin')
+    assert write_candidates(path, []) == 0
+    with CandidateFile(path) as candidate_file:
+        assert len(candidate_file) == 0
+        assert list(candidate_file) == []
+
+
+def test_reads_version_1(tmp_path):
+    # Version 1 has no sources column and no source names
+    path = tmp_path / 'ips.bin'
+    path.write_bytes(
+        HEADER.pack(MAGIC, 1, 0, 1, 0)
+        + b'\x00' * 10 + b'\xff\xff' + bytes([1, 1, 1, 1])
+        + struct.pack('<I', 13335)
+        + struct.pack('<H', 2053)
+        + bytes([0])
+        + b'SG'
+    )
+    with CandidateFile(str(path)) as candidate_file:
+        assert candidate_file.source_names == []
+        (candidate,) = candidate_file
+    assert (candidate.ip, candidate.port, candidate.tls, candidate.asn, candidate.country, candidate.sources) == (
+        '1.1.1.1', 2053, 'NO', '13335', 'SG', None
+    )
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / 'ips.bin'
+    path.write_bytes(HEADER.pack(MAGIC, 99, 0, 0, 0))
+    with pytest.raises(ValueError):
+        CandidateFile(str(path))
+
+
+def test_json_export_round_trip(tmp_path):
+    path, json_path = str(tmp_path / 'ips.bin'), str(tmp_path / 'ips.json')
+    write_candidates(path, CANDIDATES)
+    assert export_json(path, json_path) == 3
+    assert not is_candidate_file(json_path)
+    assert [(c.ip, c.port, c.sources) for c in read_json_candidates(json_path)] == [
+        (c.ip, c.port, c.sources) for c in CANDIDATES
+    ]
+
+
+def test_merger_fills_in_unknown_fields():
+    merger = CandidateMerger()
+    assert merger.add(Candidate('104.16.1.2', 443, None, None), 'first')
+    assert not merger.add(Candidate('104.16.1.2', 443, 'YES', '13335', country='US'), 'second')
+    assert not merger.add(Candidate('104.16.1.2', 443, 'NO', '1', country='DE'), 'third')
+    # The same IP on another port is another candidate
+    assert merger.add(Candidate('104.16.1.2', 80, 'NO', None), 'second')
+
+    first, other_port = merger
+    assert (first.tls, first.asn, first.country, first.sources) == ('YES', '13335', 'US', ('first', 'second', 'third'))
+    assert (other_port.port, other_port.sources) == (80, ('second',))
+
+
+def test_merger_rejects_invalid_ips():
+    with pytest.raises(ValueError):
+        CandidateMerger().add(Candidate('999.1.1.1', 443, 'YES', None), 'source')
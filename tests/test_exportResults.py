@@ -0,0 +1,28 @@
+from cfSpeedTest import IPPerformanceMetrics
+from resultStore import FAILURES_COLUMN, load_results
+from sharding import shard_path
+
+
+def result(ip, **fields):
+    values = dict(ip=ip, region='US', ping=40, upload_speed=10.0, download_speed=50.0, port=None, tls=None, asn=None,
+                  asn_name=None, ttfb=100, tested_at=1_700_000_000.0)
+    values.update(fields)
+    return IPPerformanceMetrics(**values)
+
+
+def test_unknown_fields_are_empty_cells(tmp_path, tester):
+    tester().export_results([result('1.1.1.1'), result('2.2.2.2', port=443, tls='YES', asn='13335', asn_name='CLOUDFLARENET')])
+    _, rows = load_results(str(tmp_path / 'tested-ips.csv'))
+    unknown = rows[('1.1.1.1', '')]
+    assert [unknown[column] for column in ('Port', 'TLS', 'ASN', 'ASN Name', 'Colo')] == ['', '', '', '', '']
+    known = rows[('2.2.2.2', '443')]
+    assert [known[column] for column in ('Port', 'TLS', 'ASN', 'ASN Name')] == ['443', 'YES', '13335', 'CLOUDFLARENET']
+
+
+def test_shard_file_keys_failures_like_results(tmp_path, tester):
+    shard_tester = tester('0/2')
+    shard_tester.failed.add(('3.3.3.3', ''))
+    shard_tester.export_results([result('1.1.1.1')])
+    _, rows = load_results(shard_path(str(tmp_path / 'tested-ips.csv'), (0, 2)))
+    assert rows[('1.1.1.1', '')]['ASN'] == ''
+    assert rows[('3.3.3.3', '')][FAILURES_COLUMN] == '1'
@@ -0,0 +1,39 @@
+import csv
+import configparser
+
+from mapDomain import map_ips
+from runMetrics import RunMetrics
+
+HEADER = ['IP', 'Port', 'Region', 'Download (Mbps)', 'Ping (ms)', 'Failures']
+
+
+def run(tmp_path, rows, max_ips=2, sort_by='download'):
+    input_csv, output_csv = tmp_path / 'tested-ips.csv', tmp_path / 'domains-ips.csv'
+    with open(input_csv, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=HEADER)
+        writer.writeheader()
+        writer.writerows(dict(zip(HEADER, row)) for row in rows)
+    config = configparser.ConfigParser()
+    config.read_dict({
+        'mapDomain': {'input_csv': str(input_csv), 'output_csv': str(output_csv), 'sort_by': sort_by},
+        'mapDomain.map': {'US': f"us.example.com,{max_ips}"}
+    })
+    map_ips(config, RunMetrics('mapDomain'))
+    with open(output_csv, newline='') as file:
+        return [(row['Domain'], row['IP']) for row in csv.DictReader(file)]
+
+
+def test_ip_passing_on_two_ports_is_mapped_once(tmp_path):
+    rows = [
+        ('1.1.1.1', '443', 'US', '50.00', '40', '0'),
+        ('1.1.1.1', '8443', 'US', '40.00', '30', '0'),
+        ('2.2.2.2', '443', 'US', '30.00', '20', '0'),
+    ]
+    # The duplicate does not take the slot of the next IP
+    assert run(tmp_path, rows) == [('us.example.com', '1.1.1.1'), ('us.example.com', '2.2.2.2')]
+    assert run(tmp_path, rows, sort_by='latency') == [('us.example.com', '2.2.2.2'), ('us.example.com', '1.1.1.1')]
+
+
+def test_failing_rows_are_skipped(tmp_path):
+    rows = [('1.1.1.1', '443', 'US', '50.00', '40', '1'), ('2.2.2.2', '443', 'US', '30.00', '20', '0')]
+    assert run(tmp_path, rows) == [('us.example.com', '2.2.2.2')]
@@ -0,0 +1,43 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from pinnedTransport import PinnedTransport, TRANSPORT_ERRORS
+
+
+class EchoHost(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = self.headers['Host'].encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def plain_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), EchoHost)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def test_plain_http_port(plain_server):
+    transport = PinnedTransport(timeout=2)
+    try:
+        response = transport.request('GET', '127.0.0.1', 'speed.cloudflare.com', '/', port=plain_server, tls=False)
+        assert response.status == 200
+        assert response.data == b'speed.cloudflare.com'
+        # The TLS pool of the same port fails the handshake against a plain-HTTP server
+        with pytest.raises(TRANSPORT_ERRORS):
+            transport.request('GET', '127.0.0.1', 'speed.cloudflare.com', '/', port=plain_server)
+    finally:
+        transport.close()
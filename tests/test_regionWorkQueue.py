@@ -0,0 +1,107 @@
+import asyncio
+
+from candidateStore import Candidate
+from cfSpeedTest import RegionWorkQueue
+
+
+def candidates(region, count):
+    return [Candidate(ip=f"10.0.{index}.1", port=443, tls='YES', asn=None, region=region) for index in range(count)]
+
+
+def drain(queue):
+    """Regions of the candidates handed out, admitting and passing each one."""
+    async def run():
+        regions = []
+        while True:
+            candidate = await queue.get()
+            if candidate is None:
+                return regions
+            regions.append(candidate.region)
+            if queue.admit(candidate.region):
+                await queue.resolve(candidate.region, True)
+    return asyncio.run(run())
+
+
+def test_weights_interleave_regions():
+    queue = RegionWorkQueue({'A': candidates('A', 20), 'B': candidates('B', 20)}, {}, 20, {'A': 2.0, 'B': 1.0})
+    order = drain(queue)
+    # Smooth weighted round-robin: two A for every B, spread out rather than in bursts
+    assert order[:6] == ['A', 'B', 'A', 'A', 'B', 'A']
+
+
+def test_equal_weights_alternate():
+    queue = RegionWorkQueue({'A': candidates('A', 3), 'B': candidates('B', 3)}, {}, 10)
+    assert drain(queue) == ['A', 'B', 'A', 'B', 'A', 'B']
+
+
+def test_quotas_stop_a_region():
+    queue = RegionWorkQueue({'A': candidates('A', 10), 'B': candidates('B', 10)}, {'A': 2, 'B': 4}, 10)
+    order = drain(queue)
+    assert order.count('A') == 2
+    assert order.count('B') == 4
+    assert queue.passed == {'A': 2, 'B': 4}
+
+
+def test_max_attempts_caps_failing_regions():
+    queue = RegionWorkQueue({'A': candidates('A', 10)}, {'A': 5}, 3)
+
+    async def run():
+        handed = 0
+        while (candidate := await queue.get()) is not None:
+            handed += 1
+            if queue.admit(candidate.region):
+                await queue.resolve(candidate.region, False)
+        return handed
+
+    assert asyncio.run(run()) == 3
+    assert queue.attempts['A'] == 3
+
+
+def test_failure_reopens_the_quota():
+    queue = RegionWorkQueue({'A': candidates('A', 3)}, {'A': 1}, 10)
+
+    async def run():
+        first = await queue.get()
+        assert queue.admit('A')
+        # The quota is taken by the IP under test, so the next get waits for its outcome
+        waiting = asyncio.create_task(queue.get())
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        await queue.resolve('A', False)
+        second = await waiting
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert second is not None and second.ip != first.ip
+
+
+def test_cached_passes_count_against_the_quota():
+    queue = RegionWorkQueue({'A': candidates('A', 3)}, {'A': 1}, 10)
+    queue.add_passed('A')
+    assert drain(queue) == []
+
+
+def test_rehome_moves_the_ip_to_its_traced_region():
+    queue = RegionWorkQueue({'DE': candidates('DE', 3), 'Europe': candidates('Europe', 3)}, {'DE': 1, 'Europe': 1, 'Asia': 1}, 10)
+
+    async def run():
+        candidate = await queue.get()
+        assert candidate.region == 'DE' and queue.admit('DE')
+        # Traced to another region: the pass is charged there and DE needs an IP again
+        assert await queue.rehome('DE', 'Europe')
+        await queue.resolve('Europe', True)
+        assert queue.passed == {'DE': 0, 'Europe': 1}
+        assert queue.needs('DE') and not queue.needs('Europe')
+
+        # A region no candidate was grouped under takes its quota when first seen
+        assert queue.admit('DE')
+        assert await queue.rehome('DE', 'Asia')
+        assert queue.quotas['Asia'] == 1 and queue.in_flight['Asia'] == 1
+        await queue.resolve('Asia', True)
+
+        # A full region refuses the IP, which leaves the old region's slot free
+        assert queue.admit('DE')
+        assert not await queue.rehome('DE', 'Europe')
+        assert queue.in_flight == {'DE': 0, 'Europe': 0, 'Asia': 0}
+
+    asyncio.run(run())
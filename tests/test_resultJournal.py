@@ -0,0 +1,93 @@
+import json
+
+from candidateStore import Candidate
+from cfSpeedTest import JOURNAL_VERSION, DownloadMeasurement
+from latencyProbe import LatencyResult
+from resultJournal import ResultJournal
+
+
+class FakeProbes:
+    """Probe methods of a tester that pass every IP but those listed as failing its download."""
+    def __init__(self, tester, failing=()):
+        self.tested = []
+        self.failing = set(failing)
+        tester.sample_latency = self.sample_latency
+        tester.get_download_speed = self.get_download_speed
+        tester.get_upload_speed = self.get_upload_speed
+
+    def sample_latency(self, ip, port=443, tls=True):
+        self.tested.append(ip)
+        return LatencyResult(ip, port, [20.0, 21.0, 22.0])
+
+    def get_download_speed(self, ip, port=443, tls=True):
+        return DownloadMeasurement(1.0 if ip in self.failing else 50.0, 30, 1024, True)
+
+    def get_upload_speed(self, ip, port=443, tls=True, rtt=None):
+        return 20.0
+
+
+def candidates(*ips):
+    return {'US': [Candidate(ip=ip, port=443, tls='YES', asn='13335', region='US') for ip in ips]}
+
+
+def run(tester, journal_path, ips, failing=()):
+    tester.journal = ResultJournal(journal_path, 0, 3600, JOURNAL_VERSION)
+    probes = FakeProbes(tester, failing)
+    try:
+        results = tester.test_candidates(candidates(*ips))
+    finally:
+        # Closed but kept, as after a run killed before exporting its results
+        tester.journal.close()
+    return probes.tested, {result.ip for result in results}
+
+
+def test_resumed_run_takes_over_the_interrupted_one(tmp_path, tester):
+    journal_path = str(tmp_path / 'journal.jsonl')
+    settings = dict(ping_method='https', min_download_speed='5', min_upload_speed='2', max_ips='10')
+
+    tested, passed = run(tester(**settings), journal_path, ['1.1.1.1', '2.2.2.2'], failing={'2.2.2.2'})
+    assert sorted(tested) == ['1.1.1.1', '2.2.2.2'] and passed == {'1.1.1.1'}
+
+    resumed = tester(**settings)
+    tested, passed = run(resumed, journal_path, ['1.1.1.1', '2.2.2.2', '3.3.3.3'])
+    # Only the IP the interrupted run did not reach is tested; the others keep their outcome
+    assert tested == ['3.3.3.3']
+    assert passed == {'1.1.1.1', '3.3.3.3'}
+    assert resumed.failed == {('2.2.2.2', '443')}
+
+
+def test_unreadable_result_is_tested_again(tmp_path, tester):
+    journal_path = str(tmp_path / 'journal.jsonl')
+    run(tester(ping_method='https'), journal_path, ['1.1.1.1'])
+    # A result field renamed since the journal was written
+    with open(journal_path) as file:
+        header, line = file.read().splitlines()
+    entry = json.loads(line)
+    entry['result']['download'] = entry['result'].pop('download_speed')
+    with open(journal_path, 'w') as file:
+        file.write(f"{header}\n{json.dumps(entry)}\n")
+
+    tested, passed = run(tester(ping_method='https'), journal_path, ['1.1.1.1'])
+    assert tested == ['1.1.1.1'] and passed == {'1.1.1.1'}
+
+
+def test_journal_of_another_version_is_not_resumed(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    journal = ResultJournal(path, version=1)
+    journal.append('1.1.1.1', 443, False)
+    journal.close()
+    assert ResultJournal(path, version=1).get('1.1.1.1', 443) is not None
+    assert ResultJournal(path, version=2).get('1.1.1.1', 443) is None
+
+    # Journals of older builds have no header
+    with open(path, 'w') as file:
+        file.write(json.dumps({'ip': '1.1.1.1', 'port': 443, 'passed': False, 'tested_at': 0}) + '\n')
+    assert ResultJournal(path, version=1).entries == {}
+
+
+def test_entries_without_port_use_443(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    journal = ResultJournal(path)
+    journal.append('1.1.1.1', None, False)
+    journal.close()
+    assert ResultJournal(path).get('1.1.1.1', None)['port'] == 443
@@ -0,0 +1,80 @@
+import csv
+
+import pytest
+
+from resultStore import FAILURES_COLUMN, TESTED_AT_COLUMN, format_time, load_results, merge_results
+
+HEADER = ['IP', 'Port', 'Region', 'Download (Mbps)', 'Ping (ms)']
+NOW = 1_700_000_000.0
+HOUR = 3600.0
+
+
+def row(ip, download, ping, tested_at, failures=None):
+    values = {'IP': ip, 'Port': '443', 'Region': 'US', 'Download (Mbps)': download, 'Ping (ms)': ping,
+              TESTED_AT_COLUMN: format_time(tested_at)}
+    if failures is not None:
+        values[FAILURES_COLUMN] = failures
+    return values
+
+
+def write(path, rows):
+    with open(path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=HEADER + [TESTED_AT_COLUMN, FAILURES_COLUMN])
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def merge(path, rows, failed=(), half_life=6 * HOUR, max_age=48 * HOUR, max_failures=2):
+    merge_results(str(path), HEADER, rows, set(failed), half_life, max_age, max_failures, now=NOW)
+    return load_results(str(path))[1]
+
+
+def test_first_run_writes_rows(tmp_path):
+    stored = merge(tmp_path / 'results.csv', [row('1.1.1.1', '10.00', '50', NOW)])
+    assert stored[('1.1.1.1', '443')][FAILURES_COLUMN] == '0'
+    assert stored[('1.1.1.1', '443')]['Download (Mbps)'] == '10.00'
+
+
+def test_previous_measurement_decays_with_age(tmp_path):
+    path = tmp_path / 'results.csv'
+    # Tested one half-life ago: the previous value weighs 0.5 against the new one
+    write(path, [row('1.1.1.1', '40.00', '80', NOW - 6 * HOUR, '0')])
+    stored = merge(path, [row('1.1.1.1', '10.00', '50', NOW)])
+    assert float(stored[('1.1.1.1', '443')]['Download (Mbps)']) == pytest.approx((10 + 0.5 * 40) / 1.5, abs=0.01)
+    assert stored[('1.1.1.1', '443')]['Ping (ms)'] == '60'
+
+
+def test_measurement_of_the_same_time_is_not_merged_twice(tmp_path):
+    path = tmp_path / 'results.csv'
+    # A result reused from the probe cache keeps the averaged values already in the file
+    write(path, [row('1.1.1.1', '25.00', '70', NOW - HOUR, '0')])
+    stored = merge(path, [row('1.1.1.1', '10.00', '50', NOW - HOUR)])
+    assert stored[('1.1.1.1', '443')]['Download (Mbps)'] == '25.00'
+
+
+def test_untested_rows_are_kept_until_they_expire(tmp_path):
+    path = tmp_path / 'results.csv'
+    write(path, [
+        row('1.1.1.1', '10.00', '50', NOW - 47 * HOUR, '0'),
+        row('2.2.2.2', '10.00', '50', NOW - 49 * HOUR, '0'),
+    ])
+    stored = merge(path, [])
+    assert set(stored) == {('1.1.1.1', '443')}
+    assert stored[('1.1.1.1', '443')][FAILURES_COLUMN] == '0'
+
+
+def test_failures_accumulate_and_drop_the_row(tmp_path):
+    path = tmp_path / 'results.csv'
+    write(path, [row('1.1.1.1', '10.00', '50', NOW - HOUR, '0')])
+
+    stored = merge(path, [], failed={('1.1.1.1', '443')})
+    assert stored[('1.1.1.1', '443')][FAILURES_COLUMN] == '1'
+
+    assert merge(path, [], failed={('1.1.1.1', '443')}) == {}
+
+
+def test_passing_again_resets_failures(tmp_path):
+    path = tmp_path / 'results.csv'
+    write(path, [row('1.1.1.1', '10.00', '50', NOW - HOUR, '1')])
+    stored = merge(path, [row('1.1.1.1', '10.00', '50', NOW)])
+    assert stored[('1.1.1.1', '443')][FAILURES_COLUMN] == '0'
@@ -0,0 +1,86 @@
+import configparser
+import csv
+import os
+
+import pytest
+
+from resultStore import FAILURES_COLUMN, TESTED_AT_COLUMN, format_time, load_results
+from runMetrics import RunMetrics
+from sharding import parse_shard, shard_files, shard_name, shard_of, shard_path
+from mergeShards import merge_shards
+
+IPS = [f"104.{a}.{b}.1" for a in range(16, 20) for b in range(0, 250, 5)]
+
+
+def test_parse_shard():
+    assert parse_shard('') == (0, 1)
+    assert parse_shard(' 1/4 ') == (1, 4)
+    for value in ('4/4', '-1/4', '0/0', '1', 'a/b'):
+        with pytest.raises(ValueError):
+            parse_shard(value)
+
+
+def test_shard_of_is_stable_and_partitions():
+    # Known assignments, so a change of the hash is noticed: it would move IPs between shards
+    assert [shard_of(ip, 4) for ip in ('104.16.0.1', '104.16.5.1', '172.64.1.1', '2606:4700::1')] == [2, 2, 3, 3]
+    counts = [0] * 4
+    for ip in IPS:
+        index = shard_of(ip, 4)
+        assert 0 <= index < 4
+        counts[index] += 1
+    assert sum(counts) == len(IPS)
+    # Every shard gets a fair share of the IPs
+    assert min(counts) > len(IPS) / 4 * 0.5
+    assert all(shard_of(ip, 1) == 0 for ip in IPS)
+
+
+def test_shard_paths():
+    assert shard_path('result/tested-ips.csv', (0, 1)) == 'result/tested-ips.csv'
+    assert shard_path('result/tested-ips.csv', (1, 4)) == os.path.join('result', 'shards', 'tested-ips.1-of-4.csv')
+    assert shard_name('cfSpeedTest', (0, 1)) == 'cfSpeedTest'
+    assert shard_name('cfSpeedTest', (2, 4)) == 'cfSpeedTest.2-of-4'
+
+
+def test_shard_files(tmp_path):
+    output = str(tmp_path / 'tested-ips.csv')
+    os.makedirs(tmp_path / 'shards')
+    for shard in ((0, 2), (1, 2)):
+        open(shard_path(output, shard), 'w').close()
+    open(tmp_path / 'shards' / 'other.0-of-2.csv', 'w').close()
+    assert shard_files(output) == {shard_path(output, (0, 2)): (0, 2), shard_path(output, (1, 2)): (1, 2)}
+
+
+def write_shard(path, rows):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=['IP', 'Port', 'Region', 'Download (Mbps)', 'Vantage', TESTED_AT_COLUMN, FAILURES_COLUMN])
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def shard_row(ip, tested_at, failures='0', vantage='github-hosted'):
+    return {'IP': ip, 'Port': '443', 'Region': 'US', 'Download (Mbps)': '10.00', 'Vantage': vantage,
+            TESTED_AT_COLUMN: format_time(tested_at), FAILURES_COLUMN: failures}
+
+
+def test_merge_shards(tmp_path):
+    output = str(tmp_path / 'tested-ips.csv')
+    config = configparser.ConfigParser()
+    config.read_dict({'cfSpeedTest': {'output_file': output, 'incremental_results': 'False'}})
+
+    write_shard(shard_path(output, (0, 2)), [shard_row('1.1.1.1', 1000), shard_row('3.3.3.3', 1000, failures='1')])
+    # The same IP tested by two shards keeps its latest result
+    write_shard(shard_path(output, (1, 2)), [shard_row('2.2.2.2', 1000, vantage='eu'), shard_row('1.1.1.1', 2000, vantage='eu')])
+
+    assert merge_shards(config, RunMetrics('mergeShards')) == 2
+    _, rows = load_results(output)
+    assert set(rows) == {('1.1.1.1', '443'), ('2.2.2.2', '443')}
+    assert rows[('1.1.1.1', '443')]['Vantage'] == 'eu'
+    # Merged shard files are removed
+    assert shard_files(output) == {}
+
+
+def test_merge_without_shards(tmp_path):
+    config = configparser.ConfigParser()
+    config.read_dict({'cfSpeedTest': {'output_file': str(tmp_path / 'tested-ips.csv')}})
+    assert merge_shards(config, RunMetrics('mergeShards')) == 0